@@ -0,0 +1,138 @@
+import json
+import os
+import random
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+# formats of the synthetic attachments. scanned_pdf and image need tesseract and poppler to be converted
+FORMATS = ["digital_pdf", "scanned_pdf", "image", "docx", "xlsx"]
+VENDORS = ["ACME Industrial Supplies GmbH", "Nordic Fasteners AB", "Iberia Logistics SL", "Shanghai Precision Parts Co Ltd", "Great Lakes Tooling Inc"]
+ENTITIES = [("Volvo", "Car", "Sweden"), ("Volvo", "Car", "Germany"), ("Volvo", "Car", "Belgium"), ("Volvo", "Car", "China"), ("Volvo", "Car", "USA")]
+REGIONS = ["EMEA (Europe Middle East and Africa)", "APAC (Asia Pacific And China)", "Americas (North and South America)"]
+SUBCATEGORIES = ["Invoice Payment Status", "Invoice Payment Status", "Invoice Payment Status", "Vendor Master Data", "Other"]
+# text without entities, so documents have the length and noise of real attachments
+BOILERPLATE = [
+    "Payment terms: 60 days net from the invoice date. Late payments are subject to interest.",
+    "All deliveries are subject to our general terms and conditions of sale available on request.",
+    "Please quote our reference in all correspondence regarding this document.",
+    "Goods remain our property until payment has been received in full.",
+    "Bank: Example Bank, IBAN SE00 0000 0000 0000 0000 0000, BIC EXAMSESS.",
+    "Thank you for your business. For questions contact accounts receivable.",
+]
+
+
+def document_lines(rng: random.Random, vendor: str, entity: str, invoices: list, po_number: str, delivery_note: str, filler_lines: int) -> list:
+    """Lines of a synthetic invoice/statement with the entities the extractor looks for, surrounded by filler text."""
+    lines = [vendor, "Accounts Receivable Department", "", f"Bill to: {entity}", f"Purchase order: {po_number}", f"Delivery note: {delivery_note}", ""]
+    lines += ["Invoice no.      Date         Amount EUR"]
+    for invoice in invoices:
+        lines.append(f"{invoice}      2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}   {rng.randint(100, 99999)}.{rng.randint(0, 99):02d}")
+    lines.append("")
+    lines += [rng.choice(BOILERPLATE) for _ in range(filler_lines)]
+    return lines
+
+def _pdf_escape(line: str) -> str:
+    return line.encode("latin-1", "replace").decode("latin-1").replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_text_pdf(path: str, pages: list):
+    """Writes a PDF with a text layer (one list of lines per page), without any PDF library."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for lines in pages:
+        stream = "BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({_pdf_escape(line)}) '" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {len(page_ids)} >>"
+    content = b"%PDF-1.4\n"
+    offsets = []
+    for n, obj in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f"{n} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(content)
+    content += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    content += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    content += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as file:
+        file.write(content)
+
+def render_scan(rng: random.Random, lines: list, dpi: int = 200) -> Image.Image:
+    """A4 page with the lines as an image, slightly rotated, blurred and noisy like a scan."""
+    width, height = int(8.27 * dpi), int(11.69 * dpi)
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=dpi // 8)
+    y = dpi // 2
+    for line in lines:
+        draw.text((dpi // 2, y), line, fill=0, font=font)
+        y += dpi // 6
+    for _ in range(width * height // 2000):
+        draw.point((rng.randrange(width), rng.randrange(height)), fill=rng.randint(0, 120))
+    return image.rotate(rng.uniform(-1.5, 1.5), fillcolor=255, expand=False).filter(ImageFilter.GaussianBlur(0.6))
+
+def write_attachment(rng: random.Random, file_format: str, path_without_extension: str, lines: list, pages: int) -> str:
+    """Writes one attachment in the given format. Returns its file name."""
+    if file_format == "digital_pdf":
+        path = path_without_extension + ".pdf"
+        write_text_pdf(path, [lines] * pages)
+    elif file_format == "scanned_pdf":
+        path = path_without_extension + ".pdf"
+        images = [render_scan(rng, lines) for _ in range(pages)]
+        images[0].save(path, save_all=True, append_images=images[1:], resolution=200)
+    elif file_format == "image":
+        path = path_without_extension + rng.choice([".png", ".jpg"])
+        render_scan(rng, lines, dpi=150).save(path)
+    elif file_format == "docx":
+        from docx import Document
+        path = path_without_extension + ".docx"
+        document = Document()
+        for line in lines:
+            document.add_paragraph(line)
+        document.save(path)
+    elif file_format == "xlsx":
+        import pandas as pd
+        path = path_without_extension + ".xlsx"
+        rows = [line.split(maxsplit=2) for line in lines if line[:1].isalnum()]
+        pd.DataFrame([row + [""] * (3 - len(row)) for row in rows], columns=["Reference", "Date", "Amount"]).to_excel(path, index=False)
+    else:
+        raise ValueError(f"Unknown attachment format {file_format}. Pick between {', '.join(FORMATS)}")
+    return os.path.basename(path)
+
+
+def generate_corpus(corpus_dir: str, n_tickets: int = 50, attachments_per_ticket: int = 2, formats: list = FORMATS, pages: int = 2, filler_lines: int = 40, seed: int = 0) -> list:
+    """
+    Generates n_tickets synthetic SNOW tickets with their attachments in corpus_dir (tickets.json + files/).
+    The same parameters always give the same corpus, and an existing corpus with the same parameters is reused.
+    Returns the tickets, each one with the list of its attachments.
+    """
+    params = {"n_tickets": n_tickets, "attachments_per_ticket": attachments_per_ticket, "formats": list(formats), "pages": pages, "filler_lines": filler_lines, "seed": seed}
+    tickets_path = os.path.join(corpus_dir, "tickets.json")
+    if os.path.exists(tickets_path):
+        with open(tickets_path, "r", encoding="utf-8") as file:
+            corpus = json.load(file)
+        if corpus["params"] == params:
+            return corpus["tickets"]
+    files_dir = os.path.join(corpus_dir, "files")
+    os.makedirs(files_dir, exist_ok=True)
+    rng = random.Random(seed)
+    tickets = []
+    for n in range(n_tickets):
+        vendor = rng.choice(VENDORS)
+        entity = rng.choice(ENTITIES)
+        invoices = [f"INV-2025/{rng.randint(1000, 99999)}" for _ in range(rng.randint(1, 4))]
+        po_number, delivery_note = f"45{rng.randint(10000000, 99999999)}", f"DN{rng.randint(100000, 999999)}"
+        ticket = {
+            "number": f"INC{n:07d}", "sys_id": f"ticket{n:07d}", "short_description": f"Payment status of invoice {invoices[0]}",
+            "description": f"Hello, we have not received the payment of the invoices {', '.join(invoices)} sent to {' '.join(entity)}. Please advise.",
+            "u_vendor_id": f"V{rng.randint(10000, 99999)}", "u_type_of_entity": entity[0], "u_entity": entity[1], "u_subentity": entity[2],
+            "u_region": rng.choice(REGIONS), "u_subcategory": rng.choice(SUBCATEGORIES), "sys_created_on": f"2025-06-{n % 28 + 1:02d} 10:{n // 60 % 60:02d}:{n % 60:02d}",
+            "attachments": [],
+        }
+        lines = document_lines(rng, vendor, " ".join(entity), invoices, po_number, delivery_note, filler_lines)
+        for m in range(attachments_per_ticket):
+            attachment_id = f"att{n:07d}{m:02d}"
+            file_name = write_attachment(rng, formats[(n + m) % len(formats)], os.path.join(files_dir, attachment_id), lines, pages)
+            ticket["attachments"].append({"sys_id": attachment_id, "file_name": file_name})
+        tickets.append(ticket)
+    with open(tickets_path, "w", encoding="utf-8") as file:
+        json.dump({"params": params, "tickets": tickets}, file, indent=2)
+    return tickets
@@ -0,0 +1,228 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+INVOICE_PATTERN = re.compile(r"INV-\d{4}/\d+")
+PO_PATTERN = re.compile(r"\b45\d{8}\b")
+DELIVERY_NOTE_PATTERN = re.compile(r"\bDN\d{6}\b")
+TICKET_ID_PATTERN = re.compile(r"Ticket ID: (\S+)")
+
+
+class _FakeServer:
+    """HTTP server answering in background threads on a free local port (see url)."""
+    handler = None
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.server.daemon_threads = True
+        self.server.owner = self
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.thread = None
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}"
+
+    def count(self, key: str, n: int = 1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _SnowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        snow = self.server.owner
+        time.sleep(snow.latency)
+        # paths of utils/snowAPI.py: <vcc-endpoint-with{KEY}+{start}+{end}>&sysparm_... for the tickets, <vcc-ticket-endpoint-with{KEY}+{sys_id}>
+        # for a single ticket, <vcc-endpoint-with{KEY}+{sys_id}> otherwise
+        match = re.match(r"<vcc-(ticket-)?endpoint-with[^+>]*\+([^>]*)>(.*)", self.path)
+        if match is None:
+            return self._send(404, b'{"error": "unknown path"}')
+        # ORDERBY clauses appended to the query of the tickets endpoint (see snowAPI.TICKET_ORDER)
+        arguments, order_by = match.group(2).split("^")[0].split("+"), match.group(2).split("^ORDERBY")[1:]
+        query = parse_qs(match.group(3).lstrip("&?"))
+        if match.group(1):
+            ticket = snow.tickets_by_id.get(arguments[0])
+            snow.count("ticket_lookups")
+            if ticket is None:
+                return self._send(404, b'{"error": "not found"}')
+            return self._send(200, json.dumps({"result": {key: value for key, value in ticket.items() if key != "attachments"}}).encode("utf-8"))
+        if len(arguments) == 2:
+            limit, offset = int(query.get("sysparm_limit", ["500"])[0]), int(query.get("sysparm_offset", ["0"])[0])
+            snow.count("ticket_pages")
+            tickets = sorted(snow.tickets, key=lambda ticket: [ticket.get(field, "") for field in order_by]) if order_by else snow.tickets
+            page = [{key: value for key, value in ticket.items() if key != "attachments"} for ticket in tickets[offset:offset + limit]]
+            return self._send(200, json.dumps({"result": page}).encode("utf-8"))
+        sys_id = arguments[0]
+        if sys_id in snow.tickets_by_id:
+            snow.count("attachment_lists")
+            return self._send(200, json.dumps({"result": snow.tickets_by_id[sys_id]["attachments"]}).encode("utf-8"))
+        if sys_id in snow.attachments:
+            snow.count("attachment_downloads")
+            with open(snow.attachments[sys_id], "rb") as file:
+                body = file.read()
+            snow.count("attachment_bytes", len(body))
+            return self._send(200, body, "application/octet-stream")
+        return self._send(404, b'{"error": "not found"}')
+
+
+class FakeSnowServer(_FakeServer):
+    """
+    Local stand-in of the SNOW API serving the tickets and attachments of a corpus (see corpus.generate_corpus).
+    It answers the placeholder endpoints of utils/snowAPI.py, so SNOW_API_HOST and SNOW_API_SCHEME=http are enough to use it.
+    latency: seconds added to every request.
+    """
+    handler = _SnowHandler
+
+    def __init__(self, tickets: list, files_dir: str, latency: float = 0.0):
+        super().__init__()
+        self.tickets = tickets
+        self.tickets_by_id = {ticket["sys_id"]: ticket for ticket in tickets}
+        self.attachments = {attachment["sys_id"]: os.path.join(files_dir, attachment["file_name"]) for ticket in tickets for attachment in ticket["attachments"]}
+        self.latency = latency
+
+
+def fake_completion(messages: list, response_format: dict = None) -> str:
+    """
+    Plausible answer to a request of the entity extractor or the subcategory classifier: the entities are the
+    invoice/PO/delivery note numbers found in the prompt, so the output grows with the input like a real one.
+    """
+    user_content = messages[-1]["content"] if messages else ""
+    ticket_ids = TICKET_ID_PATTERN.findall(user_content)
+    if ticket_ids:
+        return json.dumps({ticket_id: "Invoice Payment Status" for ticket_id in ticket_ids})
+    if not user_content.startswith("TICKET DESCRIPTION:"):
+        return "Invoice Payment Status"
+    invoices = list(dict.fromkeys(INVOICE_PATTERN.findall(user_content)))
+    entities = {"vendor_code": "NaN", "vendor_name": "NaN", "invoices": [], "po_numbers": list(dict.fromkeys(PO_PATTERN.findall(user_content))),
+                "delivery_notes": list(dict.fromkeys(DELIVERY_NOTE_PATTERN.findall(user_content)))}
+    if response_format is not None:
+        entities["invoices"] = [{"invoice_reference_number": invoice, "invoice_fiscal_year": "2025", "volvo_cars_invoice_entity": "NaN"} for invoice in invoices]
+    else:
+        entities["invoices"] = [[invoice, "2025", "NaN"] for invoice in invoices]
+    return json.dumps(entities, indent=4)
+
+def _tokens(text: str) -> int:
+    # rough count (4 characters per token), good enough for latencies and usage
+    return max(1, len(text) // 4)
+
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        service = self.server.owner
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"code": "404", "message": f"{self.path} not implemented"}})
+        service.count("requests")
+        if service.error_ratio and service.rng_random() < service.error_ratio:
+            service.count("server_errors")
+            return self._send_json(500, {"error": {"code": "500", "message": "The server had an error while processing your request."}})
+        if service.rng_random() < service.rate_limit_ratio:
+            service.count("rate_limited")
+            return self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded. Try again later."}},
+                                   {"retry-after-ms": str(int(service.retry_after * 1000)), "retry-after": str(max(1, round(service.retry_after)))})
+        content = fake_completion(request.get("messages", []), request.get("response_format"))
+        max_tokens = request.get("max_tokens")
+        finish_reason = "stop"
+        if max_tokens is not None and _tokens(content) > max_tokens:
+            content, finish_reason = content[:max_tokens * 4], "length"
+        prompt_tokens = sum(_tokens(str(message.get("content", ""))) for message in request.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": _tokens(content), "total_tokens": prompt_tokens + _tokens(content)}
+        service.count("prompt_tokens", usage["prompt_tokens"])
+        service.count("completion_tokens", usage["completion_tokens"])
+        base = {"id": f"chatcmpl-{service.count_id()}", "created": int(time.time()), "model": request.get("model", "gpt-4o")}
+        time.sleep(service.latency + service.jitter * service.rng_random())
+        if not request.get("stream"):
+            time.sleep(usage["completion_tokens"] * service.seconds_per_token)
+            return self._send_json(200, {**base, "object": "chat.completion", "usage": usage,
+                                         "choices": [{"index": 0, "finish_reason": finish_reason, "message": {"role": "assistant", "content": content}}]})
+        # server-sent events, one chunk every ~16 characters
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+        for n, piece in enumerate(pieces):
+            time.sleep(_tokens(piece) * service.seconds_per_token)
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": finish_reason if n == len(pieces) - 1 else None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self.wfile.write(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class FakeOpenAIServer(_FakeServer):
+    """
+    Local stand-in of the Azure OpenAI chat completions endpoint (plain and streamed), to use as AZURE_OPENAI_ENDPOINT.
+    latency: seconds before the first token, plus up to jitter seconds. seconds_per_token: generation time of every output token.
+    rate_limit_ratio: share of requests answered with a 429 and a Retry-After of retry_after seconds.
+    error_ratio: share of requests answered with a 500 (a degraded deployment).
+    """
+    handler = _OpenAIHandler
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, seconds_per_token: float = 0.01, rate_limit_ratio: float = 0.0, retry_after: float = 1.0, seed: int = 0, error_ratio: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.seconds_per_token = seconds_per_token
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.error_ratio = error_ratio
+        self.rng = random.Random(seed)
+        self.n_ids = 0
+
+    def rng_random(self) -> float:
+        with self.lock:
+            return self.rng.random()
+
+    def count_id(self) -> int:
+        with self.lock:
+            self.n_ids += 1
+            return self.n_ids
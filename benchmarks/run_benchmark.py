@@ -0,0 +1,247 @@
+import sys
+from pathlib import Path
+# Set sys.path to include the project root (and entity_extraction, for the imports of classify_tickets.py)
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / "entity_extraction"))
+import argparse
+import glob
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+import pandas as pd
+from benchmarks.corpus import FORMATS, generate_corpus
+from benchmarks.fake_services import FakeOpenAIServer, FakeSnowServer
+
+DEFAULT_CORPUS_DIR = str(ROOT / "benchmarks" / "corpus")
+DEFAULT_RESULTS_DIR = str(ROOT / "benchmarks" / "results")
+
+
+class ResourceMonitor:
+    """
+    Peak RSS (MB) and CPU utilization of the process and its children (OCR pool) while it is running.
+    RSS is sampled with psutil when installed, otherwise the peak reported by the OS (resource module, not on Windows) is used.
+    """
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+        self.stop_event = threading.Event()
+        try:
+            import psutil
+            self.process = psutil.Process(os.getpid())
+        except ImportError:
+            self.process = None
+
+    def _sample(self):
+        while not self.stop_event.is_set():
+            rss = 0
+            for process in [self.process] + self.process.children(recursive=True):
+                try:
+                    rss += process.memory_info().rss
+                except Exception:
+                    # child finished between listing and reading it
+                    continue
+            self.peak_rss_mb = max(self.peak_rss_mb, rss / 2**20)
+            self.stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.start_times, self.start_wall = os.times(), time.perf_counter()
+        if self.process is not None:
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        times, self.wall_seconds = os.times(), time.perf_counter() - self.start_wall
+        self.stop_event.set()
+        if self.process is not None:
+            self.thread.join()
+        else:
+            try:
+                import resource
+                # ru_maxrss is in KB on Linux
+                self.peak_rss_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+            except ImportError:
+                self.peak_rss_mb = None
+        self.cpu_seconds = sum(times[:4]) - sum(self.start_times[:4])
+        return False
+
+    def results(self) -> dict:
+        return {"wall_seconds": round(self.wall_seconds, 3), "cpu_seconds": round(self.cpu_seconds, 3),
+                "cpu_utilization": round(self.cpu_seconds / self.wall_seconds / (os.cpu_count() or 1), 3) if self.wall_seconds else None,
+                "cores_busy": round(self.cpu_seconds / self.wall_seconds, 2) if self.wall_seconds else None,
+                "peak_rss_mb": round(self.peak_rss_mb, 1) if self.peak_rss_mb is not None else None}
+
+
+def write_env_file(path: str, snow: FakeSnowServer, llm: FakeOpenAIServer):
+    """Secrets file pointing the SNOW and Azure OpenAI clients to the fake services."""
+    env = {"SNOW_API_KEY": "benchmark", "SNOW_API_HOST": snow.host, "SNOW_ATTACHMENT_HOST": snow.host, "SNOW_API_SCHEME": "http",
+           "AZURE_OPENAI_ENDPOINT": llm.url, "AZURE_OPENAI_API_KEY": "benchmark", "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+           "AZURE_OPENAI_DEPLOYMENT": "gpt-4o", "AZURE_OPENAI_BATCH_DEPLOYMENT": "gpt-4o", "AZURE_OPENAI_MODEL": "gpt-4o"}
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("\n".join(f"{key}={value}" for key, value in env.items()) + "\n")
+
+def write_deployments_file(path: str, llms: list):
+    """Deployments file (see utils/deployment_pool.py) with one deployment per fake Azure OpenAI server."""
+    deployments = [{"name": f"deployment-{n}", "endpoint": llm.url, "deployment": "gpt-4o"} for n, llm in enumerate(llms)]
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(deployments, file, indent=2)
+
+def latest_run(outputs_dir: str) -> str:
+    runs = sorted(glob.glob(os.path.join(outputs_dir, "*_run")))
+    if not runs:
+        raise FileNotFoundError(f"No run folder found in {outputs_dir}")
+    return runs[-1]
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+def summarize_run(target: str, run_path: str) -> dict:
+    """Per-stage times of the run: the stage timers of extract_entities (stage_timings_*.json) and the totals of the metrics file."""
+    metrics = pd.read_excel(glob.glob(os.path.join(run_path, "metrics_*.xlsx"))[0])
+    if target == "extract":
+        stages = {}
+        for path in glob.glob(os.path.join(run_path, "stage_timings_*.json")):
+            with open(path, "r", encoding="utf-8") as file:
+                stages = json.load(file)
+        totals = {column: round(float(metrics[column].sum()), 3) for column in ["time_to_ticket_to_text", "time_to_extract_entities"]}
+        return {"tickets": len(metrics), "errors": int(metrics["error"].sum()), "stages": stages, "ticket_totals": totals,
+                "input_tokens": int(metrics["input_tokens"].sum()), "output_tokens": int(metrics["output_tokens"].sum())}
+    return {"tickets": len(metrics), "errors": 0, "stages": {}, "ticket_totals": {"time_to_get_subcategory": round(float(metrics["time_to_get_subcategory"].sum()), 3)},
+            "input_tokens": int(metrics["input_tokens"].sum()), "output_tokens": int(metrics["output_tokens"].sum())}
+
+
+def run_benchmark(target: str = "extract", n_tickets: int = 50, attachments_per_ticket: int = 2, formats: list = FORMATS, pages: int = 2, seed: int = 0,
+                  corpus_dir: str = DEFAULT_CORPUS_DIR, results_dir: str = DEFAULT_RESULTS_DIR, snow_latency: float = 0.05, llm_latency: float = 0.5,
+                  llm_jitter: float = 0.2, llm_seconds_per_token: float = 0.01, rate_limit_ratio: float = 0.0, retry_after: float = 1.0, name: str = None, options: dict = None,
+                  llm_deployments: int = 1, llm_error_ratio: float = 0.0) -> dict:
+    """
+    Runs extract_entities (target="extract") or classify_tickets_by_subcategory (target="classify") end to end on a synthetic
+    corpus, against local stand-ins of SNOW and Azure OpenAI. options are passed to the function (e.g. {"pipeline": True}).
+    With llm_deployments > 1, one fake Azure OpenAI server is started per deployment and used through a deployments file;
+    the first one answers llm_error_ratio of its requests with a 500 (a degraded deployment).
+    Returns the results (throughput, per-stage times, peak RSS, CPU), also saved as JSON in results_dir.
+    """
+    options = options or {}
+    print(f"Generating corpus of {n_tickets} tickets in {corpus_dir}")
+    tickets = generate_corpus(corpus_dir, n_tickets=n_tickets, attachments_per_ticket=attachments_per_ticket, formats=formats, pages=pages, seed=seed)
+    snow = FakeSnowServer(tickets, os.path.join(corpus_dir, "files"), latency=snow_latency).start()
+    llms = [FakeOpenAIServer(latency=llm_latency, jitter=llm_jitter, seconds_per_token=llm_seconds_per_token, rate_limit_ratio=rate_limit_ratio, retry_after=retry_after,
+                             seed=seed + n, error_ratio=llm_error_ratio if n == 0 else 0.0).start() for n in range(llm_deployments)]
+    llm = llms[0]
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    env_path = os.path.join(work_dir, "secrets.txt")
+    write_env_file(env_path, snow, llm)
+    if llm_deployments > 1:
+        options = {**options, "deployments_path": os.path.join(work_dir, "deployments.json")}
+        write_deployments_file(options["deployments_path"], llms)
+    current_dir = os.getcwd()
+    # outputs of the run go to work_dir/data/outputs, not to the repository
+    os.chdir(work_dir)
+    try:
+        with ResourceMonitor() as monitor:
+            if target == "extract":
+                from entity_extraction.extract_entities import extract_entities
+                extract_entities("2025-06-01", "2025-07-01", None, env_path, str(ROOT / "data" / "inputs" / "system_prompts" / "default_system_prompt_v6.txt"), **options)
+            elif target == "classify":
+                from classify_tickets import classify_tickets_by_subcategory
+                classify_tickets_by_subcategory("2025-06-01", "2025-07-01", None, env_path, str(ROOT / "data" / "inputs" / "system_prompts" / "subcategory_classifier_v2.txt"), **options)
+            else:
+                raise ValueError(f"Unknown target {target}. Pick between extract and classify")
+        run_path = latest_run(os.path.join(work_dir, "data", "outputs", "entity_extraction" if target == "extract" else "ticket_classification"))
+    finally:
+        os.chdir(current_dir)
+        snow.stop()
+        for llm in llms:
+            llm.stop()
+    resources = monitor.results()
+    summary = summarize_run(target, run_path)
+    results = {
+        "name": name or target,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "target": target,
+        "options": options,
+        "corpus": {"n_tickets": n_tickets, "attachments_per_ticket": attachments_per_ticket, "formats": list(formats), "pages": pages, "seed": seed},
+        "services": {"snow_latency": snow_latency, "llm_latency": llm_latency, "llm_jitter": llm_jitter, "llm_seconds_per_token": llm_seconds_per_token,
+                     "rate_limit_ratio": rate_limit_ratio, "retry_after": retry_after, "llm_deployments": llm_deployments, "llm_error_ratio": llm_error_ratio},
+        "tickets_per_minute": round(60 * summary["tickets"] / resources["wall_seconds"], 2) if resources["wall_seconds"] else None,
+        **summary,
+        "resources": resources,
+        "snow_requests": dict(snow.counters),
+        "llm_requests": dict(llms[0].counters) if llm_deployments == 1 else {f"deployment-{n}": dict(llm.counters) for n, llm in enumerate(llms)},
+        "run_path": run_path,
+    }
+    os.makedirs(results_dir, exist_ok=True)
+    results_path = os.path.join(results_dir, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['name']}.json")
+    with open(results_path, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print_results(results)
+    print(f"Results saved in {results_path}")
+    return results
+
+def print_results(results: dict):
+    resources = results["resources"]
+    print(f"\n{results['name']}: {results['tickets']} tickets ({results['errors']} errors) in {resources['wall_seconds']:.1f} s -> {results['tickets_per_minute']} tickets/min")
+    print(f"CPU: {resources['cpu_seconds']:.1f} s ({resources['cores_busy']} cores busy, {resources['cpu_utilization']:.0%} of the machine), peak RSS: {resources['peak_rss_mb']} MB")
+    print(f"LLM requests: {results['llm_requests']}")
+    for stage, row in results["stages"].items():
+        print(f"  {stage:<30} count {row['count']:>6}  total {row['total']:>9.2f} s  p50 {row['p50']:.3f}  p95 {row['p95']:.3f}  p99 {row['p99']:.3f}")
+
+def compare_results(baseline_path: str, candidate_path: str):
+    """Prints the throughput, resources and stage totals of two benchmark results side by side."""
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(candidate_path, "r", encoding="utf-8") as file:
+        candidate = json.load(file)
+    rows = [("tickets_per_minute", baseline["tickets_per_minute"], candidate["tickets_per_minute"])]
+    rows += [(key, baseline["resources"][key], candidate["resources"][key]) for key in ["wall_seconds", "cpu_seconds", "peak_rss_mb"]]
+    for stage in sorted(set(baseline["stages"]) | set(candidate["stages"])):
+        rows.append((f"{stage} total", baseline["stages"].get(stage, {}).get("total"), candidate["stages"].get(stage, {}).get("total")))
+        rows.append((f"{stage} p95", baseline["stages"].get(stage, {}).get("p95"), candidate["stages"].get(stage, {}).get("p95")))
+    print(f"{'':<32}{baseline['name'] + ' (' + str(baseline['commit']) + ')':>24}{candidate['name'] + ' (' + str(candidate['commit']) + ')':>24}{'change':>10}")
+    for key, before, after in rows:
+        change = f"{(after - before) / before:+.0%}" if before and after is not None else ""
+        print(f"{key:<32}{str(before):>24}{str(after):>24}{change:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the entity extraction and classification, against local stand-ins of SNOW and Azure OpenAI.")
+    parser.add_argument("target", nargs="?", choices=["extract", "classify"], default="extract", help="extract: extract_entities.py. classify: classify_tickets.py")
+    parser.add_argument("--tickets", type=int, default=50, help="number of synthetic tickets")
+    parser.add_argument("--attachments_per_ticket", type=int, default=2, help="attachments of every ticket")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS, help="formats of the attachments, used in rotation. scanned_pdf and image need tesseract and poppler")
+    parser.add_argument("--pages", type=int, default=2, help="pages of every PDF attachment")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus and of the 429s of the fake LLM")
+    parser.add_argument("--corpus_dir", default=DEFAULT_CORPUS_DIR, help="folder of the synthetic corpus, reused by runs with the same corpus parameters")
+    parser.add_argument("--results_dir", default=DEFAULT_RESULTS_DIR, help="folder where the results are saved as JSON")
+    parser.add_argument("--snow_latency", type=float, default=0.05, help="seconds added to every request to the fake SNOW")
+    parser.add_argument("--llm_latency", type=float, default=0.5, help="seconds before the fake LLM answers")
+    parser.add_argument("--llm_jitter", type=float, default=0.2, help="up to this many seconds added at random to the latency of the fake LLM")
+    parser.add_argument("--llm_seconds_per_token", type=float, default=0.01, help="generation time of every output token of the fake LLM")
+    parser.add_argument("--rate_limit_ratio", type=float, default=0.0, help="share of the requests to the fake LLM answered with a 429")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After in seconds of the injected 429s")
+    parser.add_argument("--llm_deployments", type=int, default=1, help="number of fake Azure OpenAI deployments, used through a deployments file when more than 1")
+    parser.add_argument("--llm_error_ratio", type=float, default=0.0, help="share of the requests answered with a 500 by the first fake deployment")
+    parser.add_argument("--name", default=None, help="name of the benchmark in the results file. Example: pipeline_8_workers")
+    parser.add_argument("--options", default="{}", help="json with the keyword arguments of extract_entities/classify_tickets_by_subcategory. Example: '{\"pipeline\": true, \"llm_workers\": 8}'")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"), default=None, help="compare two results files instead of running a benchmark")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare_results(*args.compare)
+    else:
+        run_benchmark(target=args.target, n_tickets=args.tickets, attachments_per_ticket=args.attachments_per_ticket, formats=args.formats, pages=args.pages, seed=args.seed,
+                      corpus_dir=args.corpus_dir, results_dir=args.results_dir, snow_latency=args.snow_latency, llm_latency=args.llm_latency, llm_jitter=args.llm_jitter,
+                      llm_seconds_per_token=args.llm_seconds_per_token, rate_limit_ratio=args.rate_limit_ratio, retry_after=args.retry_after, name=args.name,
+                      options=json.loads(args.options), llm_deployments=args.llm_deployments, llm_error_ratio=args.llm_error_ratio)
+
+# example how to run: python benchmarks/run_benchmark.py extract --tickets 100 --options '{"pipeline": true}' --name pipeline
+# compare two runs: python benchmarks/run_benchmark.py --compare benchmarks/results/20250706_143022_sequential.json benchmarks/results/20250706_150112_pipeline.json
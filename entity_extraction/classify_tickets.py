@@ -6,7 +6,11 @@ from utils.snowAPI import get_tickets,filter_tickets,Region
 from utils.openAI_cost import calculate_openai_cost
 from utils.processing import post_process_extracted_text
 from utils.load_env_vars import load_env_vars
+from utils.cache import ResponseCache
+from utils.deployment_pool import DeploymentPool
+from utils.batch_api import write_batch_file, submit_batch, wait_for_batch, read_batch_results
 from core import SnowTicket, SubcategoryClassifier
+from local_classifier import LocalSubcategoryClassifier
 import json
 import numpy as np
 import pandas as pd
@@ -17,7 +21,7 @@ import argparse
 from datetime import datetime
 
 
-def classify_tickets_by_subcategory(start_date, end_date,selected_regions,path_to_env_var, path_to_system_prompt):
+def classify_tickets_by_subcategory(start_date, end_date,selected_regions,path_to_env_var, path_to_system_prompt, batch=False, batch_poll_interval=60, cache_dir=None, llm_cache="use", llm_cache_ttl_days=30, llm_cache_max_mb=1024, tickets_per_request=1, max_request_tokens=4096, local_classifier_path=None, local_threshold=0.9, deployments_path=None):
     current_dir = os.getcwd()
     # Get api keys and other secrets
     load_env_vars(path_to_env_var)
@@ -37,25 +41,83 @@ def classify_tickets_by_subcategory(start_date, end_date,selected_regions,path_t
         print(f"Filtered to a total of {len(tickets)} Snow tickets from the following markets: {selected_regions}\n")
     print(f"Start to classify {len(tickets)} Snow tickets:\n\n")
     # tickets = tickets[:10]
-    subcategory_classifier = SubcategoryClassifier(system_prompt)
-    metrics = {"ticket":[],"input_tokens":[], "output_tokens":[], "costs_gpt4o":[], "time_to_get_subcategory":[], "description":[], "assigned_subcategory":[],"selected_subcategory":[]}
+    # cache of LLM responses, reused across runs (same deployment, prompt, description and parameters)
+    response_cache = None
+    if cache_dir is not None and llm_cache != "off":
+        response_cache = ResponseCache(cache_dir, max_size_bytes=llm_cache_max_mb * 1024 * 1024, ttl_seconds=llm_cache_ttl_days * 24 * 3600, refresh=llm_cache == "refresh")
+    # several Azure OpenAI deployments used as one (see utils/deployment_pool.py), otherwise the one of the environment variables
+    deployment_pool = DeploymentPool.from_file(deployments_path) if deployments_path is not None else None
+    subcategory_classifier = SubcategoryClassifier(system_prompt, response_cache=response_cache, deployment_pool=deployment_pool)
+    metrics = {"ticket":[],"input_tokens":[], "output_tokens":[], "costs_gpt4o":[], "time_to_get_subcategory":[], "tickets_in_request":[], "llm_cache_hit":[], "classified_by":[], "llm_deployment":[], "local_confidence":[], "description":[], "assigned_subcategory":[],"selected_subcategory":[]}
+    # create SnowTicket from ticket
+    snow_tickets = {ticket['number']: SnowTicket(ticket,results_path) for ticket in tickets}
+    # local classifier: tickets predicted with a confidence over the threshold are not sent to the LLM
+    local_predictions = {}
+    llm_tickets = list(snow_tickets.values())
+    if local_classifier_path is not None:
+        local_classifier = LocalSubcategoryClassifier.load(local_classifier_path)
+        start_time = time.time()
+        predictions = local_classifier.predict([snow_ticket.description for snow_ticket in llm_tickets])
+        local_time_per_ticket = (time.time() - start_time) / max(len(llm_tickets), 1)
+        local_predictions = {snow_ticket.ticket['number']: prediction for snow_ticket, prediction in zip(llm_tickets, predictions)}
+        llm_tickets = [snow_ticket for snow_ticket in llm_tickets if local_predictions[snow_ticket.ticket['number']][1] < local_threshold]
+        print(f"Local classifier: {len(tickets) - len(llm_tickets)} tickets classified with confidence >= {local_threshold}, {len(llm_tickets)} sent to the LLM\n")
+    # Batch API: all descriptions are sent in a single batch job, the outputs are read back by ticket number
+    if batch:
+        requests = [subcategory_classifier.build_batch_request(snow_ticket.ticket['number'], snow_ticket.description, few_shot=True) for snow_ticket in llm_tickets]
+        batch_path = os.path.join(results_path, "batch_input.jsonl")
+        write_batch_file(batch_path, requests)
+        start_time = time.time()
+        batch_id = submit_batch(subcategory_classifier.client, batch_path)
+        batch_job = wait_for_batch(subcategory_classifier.client, batch_id, poll_interval=batch_poll_interval)
+        batch_outputs = read_batch_results(subcategory_classifier.client, batch_job)
+        # time of the batch shared between its tickets
+        time_per_ticket = (time.time() - start_time) / max(len(llm_tickets), 1)
+    # several descriptions per request: the tickets are classified upfront and the cost of every request is split between its tickets
+    elif tickets_per_request > 1:
+        multi_outputs = subcategory_classifier.get_subcategories({snow_ticket.ticket['number']: snow_ticket.description for snow_ticket in llm_tickets},
+                                                                 max_request_tokens=max_request_tokens, max_tickets_per_request=tickets_per_request)
+        print(f"Classified {len(llm_tickets)} tickets, {sum(output['fallback'] for output in multi_outputs.values())} of them one by one after an invalid response\n")
     for i,ticket in enumerate(tickets):
-        # create SnowTicket from ticket
-        snow_ticket = SnowTicket(ticket,results_path)
+        snow_ticket = snow_tickets[ticket['number']]
         selected_subcategory = snow_ticket.ticket["u_subcategory"]
         print(f"Processing ticket number:{snow_ticket.ticket['number']}. Selected subcategory: {selected_subcategory}")
         start_time = time.time()
         # Download attachments, process attachments, convert attachments to text and combine with ticket description and title. (preprocess ticket)
         desc = snow_ticket.description
-        assigned_subcategory, input_tokens, output_tokens = subcategory_classifier.get_subcategory(desc,few_shot=True)
+        batch_error = None
+        stats = {}
+        tickets_in_request = 1
+        classified_by = "llm"
+        local_subcategory, local_confidence = local_predictions.get(snow_ticket.ticket['number'], (None, None))
+        if local_confidence is not None and local_confidence >= local_threshold:
+            assigned_subcategory, input_tokens, output_tokens = local_subcategory, 0, 0
+            time_to_get_subcategory = local_time_per_ticket
+            tickets_in_request = 0
+            classified_by = "local"
+        elif batch:
+            assigned_subcategory, input_tokens, output_tokens, batch_error = batch_outputs.get(snow_ticket.ticket['number'], ("", 0, 0, f"no output (batch {batch_job.status})"))
+            time_to_get_subcategory = time_per_ticket
+        elif tickets_per_request > 1:
+            output = multi_outputs[snow_ticket.ticket['number']]
+            assigned_subcategory, input_tokens, output_tokens, time_to_get_subcategory = output["subcategory"], output["input_tokens"], output["output_tokens"], output["seconds"]
+            tickets_in_request = output["tickets_in_request"]
+            stats["llm_cache_hits"] = int(output["cache_hit"])
+            stats["llm_deployment"] = [output["deployment"]] if output["deployment"] else []
+        else:
+            assigned_subcategory, input_tokens, output_tokens = subcategory_classifier.get_subcategory(desc,few_shot=True,stats=stats)
+            time_to_get_subcategory = time.time() - start_time
         print(f"Predicted subcategory:{assigned_subcategory}")
         selected_subcategory = snow_ticket.ticket["u_subcategory"]
-        time_to_get_subcategory = time.time() - start_time
 
         log = f"SYSTEM PROMPT: {system_prompt} \n DESCRIPTION: {desc} \n\n"
+        if batch_error is not None:
+            log += f"**ERROR IN BATCH REQUEST**: {batch_error}\n\n"
+        if local_confidence is not None:
+            log += f"LOCAL CLASSIFIER: {local_subcategory} (confidence {local_confidence:.2f})\n"
         log += f"ASSIGNED SUBCATEGORY: {assigned_subcategory}\nSELECTED SUBCATEGORY:{selected_subcategory}\n\n + INPUT TOKENS: {input_tokens}\n + OUTPUT TOKENS: {output_tokens}\n + TIME: {time_to_get_subcategory:.2f} seconds\n"
         
-        cost_gpt4o = calculate_openai_cost(input_tokens, output_tokens, model="gpt-4o")
+        cost_gpt4o = calculate_openai_cost(input_tokens, output_tokens, model=subcategory_classifier.model_name, batch=batch) if subcategory_classifier.priced else None
 
         # add metrics to dictionary
         metrics["ticket"].append(snow_ticket.ticket['number'])
@@ -63,6 +125,11 @@ def classify_tickets_by_subcategory(start_date, end_date,selected_regions,path_t
         metrics["input_tokens"].append(input_tokens)
         metrics["output_tokens"].append(output_tokens)
         metrics["costs_gpt4o"].append(cost_gpt4o)
+        metrics["tickets_in_request"].append(tickets_in_request)
+        metrics["llm_cache_hit"].append(stats.get("llm_cache_hits", 0) > 0)
+        metrics["classified_by"].append(classified_by)
+        metrics["llm_deployment"].append(", ".join(stats.get("llm_deployment", [])))
+        metrics["local_confidence"].append(local_confidence)
         metrics["description"].append(desc)
         metrics["assigned_subcategory"].append(assigned_subcategory)
         metrics["selected_subcategory"].append(selected_subcategory)
@@ -74,6 +141,12 @@ def classify_tickets_by_subcategory(start_date, end_date,selected_regions,path_t
             file.write(log)
         if i%5 == 0:
             print(f"\n{i+1} Tickets processed\n\n")
+    if local_classifier_path is not None:
+        print(f"Local classifier: {metrics['classified_by'].count('local')} LLM calls avoided out of {len(metrics['ticket'])} tickets")
+    subcategory_classifier.deployment_pool.print_summary()
+    if response_cache is not None:
+        print(f"LLM response cache: {sum(metrics['llm_cache_hit'])} hits out of {len(metrics['ticket'])} tickets")
+        response_cache.close()
     # save metrics in excel
     metrics_df = pd.DataFrame(metrics)
     metrics_df_path = os.path.join(results_path,"metrics_" + timestamp_str + ".xlsx")
@@ -82,7 +155,11 @@ def classify_tickets_by_subcategory(start_date, end_date,selected_regions,path_t
     params = {
     "regions": selected_regions,
     "start_date": start_date,
-    "end_date": end_date
+    "end_date": end_date,
+    "batch": batch,
+    "local_classifier": local_classifier_path,
+    "local_threshold": local_threshold if local_classifier_path is not None else None,
+    "deployments": deployments_path
     }
     params_path = os.path.join(results_path, f"parameters_{timestamp_str}.json")
     with open(params_path, "w", encoding="utf-8") as f:
@@ -97,10 +174,26 @@ if __name__ == "__main__":
     parser.add_argument("--regions", nargs='+', default=None, help="Space separated regions. Pick between APAC, EMEA and AMERICAS. Example: --regions APAC EMEA")
     parser.add_argument("--path_to_env_var", default="data/inputs/secrets/secrets.txt", help="path to file with env variables for Azure Open AI")
     parser.add_argument("--path_to_system_prompt", default="data/inputs/system_prompts/subcategory_classifier_v2.txt", help="path to file for the system prompt of the entity extractor")
+    parser.add_argument("--tickets_per_request", type=int, default=1, help="maximum number of ticket descriptions classified in the same request, sharing the system prompt (1 = one request per ticket)")
+    parser.add_argument("--max_request_tokens", type=int, default=4096, help="token budget of a request with several tickets (system prompt + descriptions + expected output)")
+    parser.add_argument("--local_classifier", default=None, help="path to a local classifier trained with entity_extraction/local_classifier.py. Tickets it classifies with enough confidence are not sent to the LLM")
+    parser.add_argument("--local_threshold", type=float, default=0.9, help="minimum confidence (0-1) of the local classifier to skip the LLM")
+    parser.add_argument("--cache_dir", default=None, help="folder of the cache of LLM responses, reused across runs (disabled if not given). Example: data/cache")
+    parser.add_argument("--llm_cache", choices=["use", "refresh", "off"], default="use", help="use: reuse cached responses. refresh: call the LLM again and overwrite them. off: bypass the cache")
+    parser.add_argument("--llm_cache_ttl_days", type=float, default=30, help="cached LLM responses older than this are discarded")
+    parser.add_argument("--llm_cache_max_mb", type=int, default=1024, help="maximum size of the LLM response cache in MB, least recently used entries are evicted")
+    parser.add_argument("--batch", action="store_true", help="send all tickets in one job to the Azure OpenAI Batch API (AZURE_OPENAI_BATCH_DEPLOYMENT) and wait for the results")
+    parser.add_argument("--batch_poll_interval", type=float, default=60, help="seconds between checks of the status of the batch")
+    parser.add_argument("--deployments", default=None, help="JSON file with several Azure OpenAI deployments (endpoint, deployment, quotas) used as one, see utils/deployment_pool.py")
 
 
     args = parser.parse_args()
-    classify_tickets_by_subcategory(start_date = args.start_date, end_date = args.end_date,selected_regions=args.regions, path_to_env_var = args.path_to_env_var, path_to_system_prompt = args.path_to_system_prompt)
+    if args.batch and args.tickets_per_request > 1:
+        parser.error("--tickets_per_request can't be combined with --batch")
+    classify_tickets_by_subcategory(start_date = args.start_date, end_date = args.end_date,selected_regions=args.regions, path_to_env_var = args.path_to_env_var, path_to_system_prompt = args.path_to_system_prompt, batch = args.batch, batch_poll_interval = args.batch_poll_interval,
+                                    cache_dir = args.cache_dir, llm_cache = args.llm_cache, llm_cache_ttl_days = args.llm_cache_ttl_days, llm_cache_max_mb = args.llm_cache_max_mb,
+                                    tickets_per_request = args.tickets_per_request, max_request_tokens = args.max_request_tokens,
+                                    local_classifier_path = args.local_classifier, local_threshold = args.local_threshold, deployments_path = args.deployments)
 
 # example how to run: ./.chatbot_env/Scripts/python.exe entity_extraction/classify_tickets.py "2025-05-01" "2025-06-01"
 # example how to run if env activated: python entity_extraction/classify_tickets.py "2025-05-01" "2025-06-01"
@@ -1,98 +1,260 @@
-from utils.snowAPI import get_attachments_from_ticket, download_attachment_from_id
-from utils.processing import pdf2text, image2text, word_to_text, tabular_to_text
+from utils.snowAPI import get_attachments_from_ticket, download_attachment_from_id, sanitize_filename, AttachmentDownloadError
+from utils.processing import merge_extracted_texts
+from utils.converters import CONVERTERS, is_non_convertible
+from utils.cache import ConversionCache, ResponseCache
+from utils.relevance import RelevanceFilter
+from utils.entity_resolver import EntityResolver
+from utils.page_dedup import PAGE_BREAK, PageDeduplicator
+from utils.stats import add_stat, append_stat, timer
+from utils.tokens import count_tokens, split_into_chunks, apportion
+from utils.rate_limiter import RateLimiter, estimate_tokens
+from utils.deployment_pool import Deployment, DeploymentPool
+from utils.batch_api import build_batch_request
+from utils.openAI_cost import is_priced
+from utils.structured_output import ENTITIES_RESPONSE_FORMAT, StreamingJSONParser, to_legacy_format
 import os
 import json
+import time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
 from openai import AzureOpenAI
 
+# appended to the system prompt of the classifier when several tickets are sent in the same request (see SubcategoryClassifier.get_subcategories)
+MULTI_TICKET_INSTRUCTIONS = """
+
+**Several tickets in one message:**
+- The message contains several tickets, each one starting with "Ticket ID: <id>" followed by its description.
+- Classify every ticket independently, following the instructions above.
+- Respond only with a JSON object mapping every ticket ID to its category, for example: {"INC0000001": "Invoice Payment Status", "INC0000002": "Other"}
+"""
+
 class SubcategoryClassifier:
-    def __init__(self, system_prompt: str):
+    def __init__(self, system_prompt: str, response_cache: ResponseCache = None, deployment_pool: DeploymentPool = None):
         self.system_prompt = system_prompt
         self.chat_history = [{"role": "system", "content": self.system_prompt}]
         self.model = os.environ["AZURE_OPENAI_DEPLOYMENT"] 
         self.api_version = os.environ["AZURE_OPENAI_API_VERSION"]
         self.api_key = os.environ["AZURE_OPENAI_API_KEY"]
         self.endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
-        self.initialize_client()
+        # model name used to count tokens (the deployment name can be anything)
+        self.model_name = os.environ.get("AZURE_OPENAI_MODEL", "gpt-4o")
+        # checked once here, so an unknown model never fails a ticket after its LLM call
+        self.priced = is_priced(self.model_name)
+        # Batch API requests need a deployment of type "Global Batch"
+        self.batch_model = os.environ.get("AZURE_OPENAI_BATCH_DEPLOYMENT", self.model)
+        # optional cache of responses shared between runs
+        self.response_cache = response_cache
+        # deployments the requests are sent to (by default the one of the environment variables)
+        self.deployment_pool = deployment_pool or DeploymentPool.from_env()
+        # client of the Batch API, created the first time it is used (the chat requests go through the clients of deployment_pool)
+        self._client = None
+
+    @property
+    def client(self) -> AzureOpenAI:
+        if self._client is None:
+            self.initialize_client()
+        return self._client
 
     def initialize_client(self):
-        self.client = AzureOpenAI(
+        self._client = AzureOpenAI(
             api_version=self.api_version,
             azure_endpoint=self.endpoint,
             api_key=self.api_key,
         )
 
-    def get_subcategory(self, desc: str, few_shot = False, max_output_tokens: int = 256, add_to_history: bool = False, max_input_tokens:int = 65536 ) -> tuple[str, int, int]:
+    def get_subcategory(self, desc: str, few_shot = False, max_output_tokens: int = 256, add_to_history: bool = False, max_input_tokens:int = 65536, stats: dict = None) -> tuple[str, int, int]:
 
-        if few_shot:
-            input_data = [
-             {"role": "system", "content": self.system_prompt},
-             {"role": "user", "content": f"Ticket description: {desc}\nYour response:" }
-            ]
-        
-        else:
-            input_data = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": desc}
-                ]
-        
-        response = self.client.chat.completions.create(
-            messages=input_data,
-            max_tokens=max_output_tokens,
-            temperature=1.0,
-            top_p=0.9,
-            model=self.model
-        )
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
-        
-        assigned_subcategory = response.choices[0].message.content.strip()
+        input_data = self.build_messages(desc, few_shot)
+        assigned_subcategory, input_tokens, output_tokens = self._chat(input_data, max_output_tokens, stats=stats)
         if add_to_history:
             self.chat_history.append({"role": "user", "content": desc})
             self.chat_history.append({"role": "assistant", "content": assigned_subcategory})
 
         return assigned_subcategory, input_tokens, output_tokens
+
+    def get_subcategories(self, descriptions: dict, max_request_tokens: int = 4096, max_tickets_per_request: int = 20, output_tokens_per_ticket: int = 24) -> dict:
+        """
+        Classifies several tickets ({ticket_id: description}) with one request per group of tickets, so the system prompt is paid once per group.
+        Groups are filled until max_request_tokens (prompt + descriptions + expected output) or max_tickets_per_request.
+        Tickets missing from the response (or all the tickets of a group if the response can't be parsed) are classified one by one.
+        The tokens and time of a request are apportioned to its tickets by the length of their description.
+        Returns {ticket_id: {"subcategory", "input_tokens", "output_tokens", "seconds", "tickets_in_request", "fallback", "cache_hit", "deployment"}}.
+        """
+        system_prompt_tokens = count_tokens(self.system_prompt + MULTI_TICKET_INSTRUCTIONS, self.model_name)
+        ticket_tokens = {ticket_id: count_tokens(self.format_ticket(ticket_id, desc), self.model_name) + output_tokens_per_ticket for ticket_id, desc in descriptions.items()}
+        # group the tickets in order, starting a new group when the next ticket doesn't fit
+        groups, group, group_tokens = [], [], system_prompt_tokens
+        for ticket_id in descriptions:
+            if group and (group_tokens + ticket_tokens[ticket_id] > max_request_tokens or len(group) >= max_tickets_per_request):
+                groups.append(group)
+                group, group_tokens = [], system_prompt_tokens
+            group.append(ticket_id)
+            group_tokens += ticket_tokens[ticket_id]
+        if group:
+            groups.append(group)
+
+        results = {}
+        for group in groups:
+            results.update(self._classify_group({ticket_id: descriptions[ticket_id] for ticket_id in group}, output_tokens_per_ticket))
+        return results
+
+    def _classify_group(self, descriptions: dict, output_tokens_per_ticket: int) -> dict:
+        results = {}
+        assigned = {}
+        if len(descriptions) > 1:
+            stats = {}
+            start_time = time.time()
+            text, input_tokens, output_tokens = self._chat(self.build_multi_messages(descriptions), output_tokens_per_ticket * len(descriptions) + 32, stats=stats)
+            seconds = time.time() - start_time
+            assigned = self.parse_multi_response(text, list(descriptions))
+            if len(assigned) < len(descriptions):
+                print(f"WARNING: {len(descriptions) - len(assigned)} of {len(descriptions)} tickets missing from the response, classifying them one by one")
+            # only the tickets of the response share the cost of the request
+            weights = [count_tokens(descriptions[ticket_id], self.model_name) + 1 for ticket_id in assigned]
+            for ticket_id, ticket_input, ticket_output, ticket_seconds in zip(assigned, apportion(input_tokens, weights), apportion(output_tokens, weights), apportion(seconds, weights)):
+                results[ticket_id] = {"subcategory": assigned[ticket_id], "input_tokens": ticket_input, "output_tokens": ticket_output, "seconds": ticket_seconds,
+                                      "tickets_in_request": len(descriptions), "fallback": False, "cache_hit": stats.get("llm_cache_hits", 0) > 0,
+                                      "deployment": ", ".join(stats.get("llm_deployment", []))}
+        for ticket_id, desc in descriptions.items():
+            if ticket_id in assigned:
+                continue
+            stats = {}
+            start_time = time.time()
+            subcategory, input_tokens, output_tokens = self.get_subcategory(desc, few_shot=True, stats=stats)
+            results[ticket_id] = {"subcategory": subcategory, "input_tokens": input_tokens, "output_tokens": output_tokens, "seconds": time.time() - start_time,
+                                  "tickets_in_request": 1, "fallback": len(descriptions) > 1, "cache_hit": stats.get("llm_cache_hits", 0) > 0,
+                                  "deployment": ", ".join(stats.get("llm_deployment", []))}
+        return results
+
+    def _chat(self, input_data: list, max_output_tokens: int, stats: dict = None) -> tuple[str, int, int]:
+        """Sends the chat completion request, or returns the response from the cache if available."""
+        params = {"max_tokens": max_output_tokens, "temperature": 1.0, "top_p": 0.9}
+
+        def _request(deployment: Deployment):
+            response = deployment.client.chat.completions.create(messages=input_data, model=deployment.deployment, **params)
+            return response.choices[0].message.content.strip(), response.usage.prompt_tokens, response.usage.completion_tokens, deployment.model
+
+        def _send():
+            return self.deployment_pool.complete(_request, estimate_tokens(input_data, max_output_tokens), used_tokens=lambda result: result[1] + result[2], stats=stats)
+
+        if self.response_cache is not None:
+            return self.response_cache.complete(self.deployment_pool.models(), input_data, params, _send, stats=stats)
+        return _send()[:3]
+
+    @staticmethod
+    def format_ticket(ticket_id: str, desc: str) -> str:
+        return f"Ticket ID: {ticket_id}\nTicket description: {desc.strip()}\n\n"
+
+    def build_multi_messages(self, descriptions: dict) -> list:
+        return [
+            {"role": "system", "content": self.system_prompt + MULTI_TICKET_INSTRUCTIONS},
+            {"role": "user", "content": "".join(self.format_ticket(ticket_id, desc) for ticket_id, desc in descriptions.items()) + "Your response:"}
+        ]
+
+    @staticmethod
+    def parse_multi_response(text: str, ticket_ids: list) -> dict:
+        """Returns {ticket_id: subcategory} for the tickets found in a multi-ticket response, or {} if it isn't a JSON object."""
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end < start:
+            return {}
+        try:
+            response = json.loads(text[start:end + 1])
+        except json.JSONDecodeError:
+            return {}
+        if not isinstance(response, dict):
+            return {}
+        response = {str(ticket_id).strip(): subcategory for ticket_id, subcategory in response.items()}
+        return {ticket_id: response[ticket_id].strip() for ticket_id in ticket_ids if isinstance(response.get(ticket_id), str) and response[ticket_id].strip()}
+
+    def build_messages(self, desc: str, few_shot = False) -> list:
+        user_content = f"Ticket description: {desc}\nYour response:" if few_shot else desc
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+
+    def build_batch_request(self, custom_id: str, desc: str, few_shot = False, max_output_tokens: int = 256) -> dict:
+        """Request of a ticket for the Batch API, with the same messages and sampling parameters as get_subcategory."""
+        return build_batch_request(custom_id, self.batch_model, self.build_messages(desc, few_shot), max_output_tokens)
     
 class EntityExtractor:
-    def __init__(self, system_prompt: str):
+    def __init__(self, system_prompt: str, rate_limiter: RateLimiter = None, max_retries: int = 5, max_chunk_workers: int = 4, max_input_tokens: int = 65536, response_cache: ResponseCache = None, structured_output: bool = False, max_output_tokens_limit: int = 8192, deployment_pool: DeploymentPool = None):
         self.system_prompt = system_prompt
         self.chat_history = [{"role": "system", "content": self.system_prompt}]
         self.model = os.environ["AZURE_OPENAI_DEPLOYMENT"] 
         self.api_version = os.environ["AZURE_OPENAI_API_VERSION"]
         self.api_key = os.environ["AZURE_OPENAI_API_KEY"]
         self.endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
-        self.initialize_client()
+        # deployments the requests are sent to: by default the one of the environment variables, with the quotas of rate_limiter
+        # (optional limiter shared by all the threads calling the deployment)
+        self.deployment_pool = deployment_pool or DeploymentPool.from_env(rate_limiter)
+        # number of times a request is sent again after a 429 or a deployment error before giving up
+        self.max_retries = max_retries
+        # model name used to count tokens (the deployment name can be anything)
+        self.model_name = os.environ.get("AZURE_OPENAI_MODEL", "gpt-4o")
+        # checked once here, so an unknown model never fails a ticket after its LLM call
+        self.priced = is_priced(self.model_name)
+        # number of chunks of a long ticket extracted at the same time
+        self.max_chunk_workers = max_chunk_workers
+        # default token budget of a request (system prompt + ticket)
+        self.max_input_tokens = max_input_tokens
+        # Batch API requests need a deployment of type "Global Batch"
+        self.batch_model = os.environ.get("AZURE_OPENAI_BATCH_DEPLOYMENT", self.model)
+        # optional cache of responses shared between runs
+        self.response_cache = response_cache
+        # request JSON-schema-constrained output (ENTITIES_SCHEMA) as a stream
+        self.structured_output = structured_output
+        # truncated outputs are requested again with twice the max_output_tokens, up to this limit
+        self.max_output_tokens_limit = max_output_tokens_limit
+        # client of the Batch API, created the first time it is used (the chat requests go through the clients of deployment_pool)
+        self._client = None
+
+    @property
+    def client(self) -> AzureOpenAI:
+        if self._client is None:
+            self.initialize_client()
+        return self._client
 
     def initialize_client(self):
-        self.client = AzureOpenAI(
+        self._client = AzureOpenAI(
             api_version=self.api_version,
             azure_endpoint=self.endpoint,
             api_key=self.api_key,
         )
         
-    def extract_entities(self, processed_ticket: str, max_output_tokens: int = 2048, add_to_history: bool = False,  max_input_tokens:int = 65536) -> tuple[str, int, int]:
-        # TODO: Truncate input to max_input tokens --> need to use tiktoken tokenizer
-        # TODO: Maybe change the temperature to 1 to make it deterministic "less creative", every time select most probable token
+    def split_input(self, processed_ticket: str, max_input_tokens: int = None, stats: dict = None) -> list:
+        """Counts the tokens of the ticket and returns it as a single chunk, or split in chunks if it is over max_input_tokens (system prompt included)."""
+        max_input_tokens = max_input_tokens or self.max_input_tokens
+        system_prompt_tokens = count_tokens(self.system_prompt, self.model_name)
+        ticket_tokens = count_tokens(processed_ticket, self.model_name)
+        add_stat(stats, "input_tokens_counted", system_prompt_tokens + ticket_tokens)
+        if system_prompt_tokens + ticket_tokens <= max_input_tokens:
+            chunks = [processed_ticket]
+            append_stat(stats, "llm_chunk_tokens", ticket_tokens)
+        else:
+            chunks = split_into_chunks(processed_ticket, max_input_tokens - system_prompt_tokens, self.model_name)
+            for chunk in chunks:
+                append_stat(stats, "llm_chunk_tokens", count_tokens(chunk, self.model_name))
+        add_stat(stats, "llm_chunks", len(chunks))
+        return chunks
 
+    def build_messages(self, user_content: str) -> list:
         # Format and build input from system prompt + formatted ticket
-        input_data = [
+        return [
             {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": processed_ticket}
+            {"role": "user", "content": user_content}
         ]
 
-        # generate text by providing the input and the deployed model we want to use
-        response = self.client.chat.completions.create(
-            messages=input_data,
-            max_tokens=max_output_tokens,
-            temperature=1.0,
-            top_p=0.9,
-            model=self.model
-        )
-        # count number of input and output tokens
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
+    def extract_entities(self, processed_ticket: str, max_output_tokens: int = 2048, add_to_history: bool = False,  max_input_tokens:int = None, stats: dict = None) -> tuple[str, int, int]:
+        # TODO: Maybe change the temperature to 1 to make it deterministic "less creative", every time select most probable token
 
-        # extract entities from the output
-        extracted_entities = response.choices[0].message.content.strip()
+        # count tokens before the call: inputs over max_input_tokens are split in chunks extracted separately
+        chunks = self.split_input(processed_ticket, max_input_tokens, stats=stats)
+        if len(chunks) > 1:
+            return self.extract_entities_in_chunks(chunks, max_output_tokens, stats=stats)
+
+        # generate text by providing the input and the deployed model we want to use
+        extracted_entities, input_tokens, output_tokens = self._complete(self.build_messages(processed_ticket), max_output_tokens, stats=stats)
 
         # by default we don't want to add to history, not relevant information of previous ticket to the next ticket
         if add_to_history:
@@ -100,6 +262,154 @@ class EntityExtractor:
             self.chat_history.append({"role": "assistant", "content": extracted_entities})
 
         return extracted_entities, input_tokens, output_tokens
+
+    def extract_entities_in_chunks(self, chunks: list, max_output_tokens: int, stats: dict = None) -> tuple[str, int, int]:
+        """
+        Map-reduce extraction for tickets over the token budget (split on FILE/page boundaries by split_input):
+        each chunk is extracted separately (concurrently, within the rate limit) and the outputs are merged.
+        """
+        print(f"Input over the token budget, extracting entities from {len(chunks)} chunks")
+        with ThreadPoolExecutor(max_workers=min(self.max_chunk_workers, len(chunks))) as executor:
+            outputs = list(executor.map(lambda chunk: self._complete(self.build_messages(chunk), max_output_tokens, stats=stats), chunks))
+        extracted_entities = merge_extracted_texts([output[0] for output in outputs])
+        input_tokens = sum(output[1] for output in outputs)
+        output_tokens = sum(output[2] for output in outputs)
+        return extracted_entities, input_tokens, output_tokens
+
+    def build_batch_requests(self, custom_id: str, processed_ticket: str, max_output_tokens: int = 2048, stats: dict = None) -> list:
+        """
+        Requests of a ticket for the Batch API (one per chunk if the ticket is over the token budget).
+        Chunks get the custom_id "{custom_id}#{n}"; their outputs are merged with merge_extracted_texts.
+        """
+        chunks = self.split_input(processed_ticket, stats=stats)
+        custom_ids = [custom_id] if len(chunks) == 1 else [f"{custom_id}#{n}" for n in range(1, len(chunks) + 1)]
+        response_format = ENTITIES_RESPONSE_FORMAT if self.structured_output else None
+        return [build_batch_request(chunk_id, self.batch_model, self.build_messages(chunk), max_output_tokens, response_format=response_format) for chunk_id, chunk in zip(custom_ids, chunks)]
+
+    def _complete(self, input_data: list, max_output_tokens: int, stats: dict = None) -> tuple[str, int, int]:
+        """Returns the response from the cache if available, otherwise sends the request (see _request_completion)."""
+        if self.response_cache is None:
+            return self._request_completion(input_data, max_output_tokens, stats=stats)[:3]
+        params = {"max_tokens": max_output_tokens, "temperature": 1.0, "top_p": 0.9, "structured_output": self.structured_output}
+        return self.response_cache.complete(self.deployment_pool.models(), input_data, params, lambda: self._request_completion(input_data, max_output_tokens, stats=stats), stats=stats)
+
+    def _request_completion(self, input_data: list, max_output_tokens: int, stats: dict = None) -> tuple[str, int, int, str]:
+        """
+        Sends the request, and sends it again with twice the max_output_tokens (up to max_output_tokens_limit) while the output is truncated.
+        The tokens of all the attempts are paid, so they are added up. Returns (text, input_tokens, output_tokens, model that answered last).
+        """
+        total_input_tokens, total_output_tokens = 0, 0
+        while True:
+            text, input_tokens, output_tokens, truncated, model = self._send_request(input_data, max_output_tokens, stats=stats)
+            total_input_tokens += input_tokens
+            total_output_tokens += output_tokens
+            if not truncated:
+                break
+            add_stat(stats, "llm_truncations")
+            if max_output_tokens >= self.max_output_tokens_limit:
+                print(f"WARNING: output still truncated with max_output_tokens={max_output_tokens}")
+                break
+            max_output_tokens = min(max_output_tokens * 2, self.max_output_tokens_limit)
+            add_stat(stats, "llm_truncation_retries")
+            print(f"Output truncated, retrying with max_output_tokens={max_output_tokens}")
+        return self.finalize_output(text, stats=stats), total_input_tokens, total_output_tokens, model
+
+    def _send_request(self, input_data: list, max_output_tokens: int, stats: dict = None) -> tuple[str, int, int, bool, str]:
+        """
+        Sends one chat completion request to a deployment of the pool, within its quota, and sends it again after 429 (rate limit)
+        or deployment errors (see DeploymentPool.complete). Returns (text, input_tokens, output_tokens, truncated, model of the deployment that answered).
+        """
+        reserved_tokens = estimate_tokens(input_data, max_output_tokens)
+
+        def _request(deployment: Deployment):
+            if self.structured_output:
+                with timer(stats, "time_llm_latency"):
+                    return *self._stream_request(input_data, max_output_tokens, deployment, stats=stats), deployment.model
+            start_time = time.time()
+            with timer(stats, "time_llm_latency"):
+                response = deployment.client.chat.completions.create(
+                    messages=input_data,
+                    max_tokens=max_output_tokens,
+                    temperature=1.0,
+                    top_p=0.9,
+                    model=deployment.deployment
+                )
+            add_stat(stats, "llm_generation_seconds", time.time() - start_time)
+            # count number of input and output tokens
+            truncated = response.choices[0].finish_reason == "length"
+            return response.choices[0].message.content.strip(), response.usage.prompt_tokens, response.usage.completion_tokens, truncated, deployment.model
+
+        return self.deployment_pool.complete(_request, reserved_tokens, used_tokens=lambda result: result[1] + result[2], max_retries=self.max_retries, stats=stats)
+
+    def _stream_request(self, input_data: list, max_output_tokens: int, deployment: Deployment, stats: dict = None) -> tuple[str, int, int, bool]:
+        """
+        Streams a completion constrained to ENTITIES_SCHEMA, feeding it to an incremental JSON parser.
+        The output is truncated if the stream stops before the JSON document is closed. Anything generated after the
+        document is closed (e.g. trailing whitespace) is not read. Time to first token and generation time are recorded separately.
+        """
+        start_time = time.time()
+        first_token_time = None
+        parser = StreamingJSONParser()
+        finish_reason, usage = None, None
+        stream = deployment.client.chat.completions.create(
+            messages=input_data,
+            max_tokens=max_output_tokens,
+            temperature=1.0,
+            top_p=0.9,
+            model=deployment.deployment,
+            response_format=ENTITIES_RESPONSE_FORMAT,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        closed = False
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                content = choice.delta.content if choice.delta is not None else None
+                if content:
+                    if parser.complete and content.strip():
+                        closed = True
+                        break
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    parser.feed(content)
+                if choice.finish_reason is not None:
+                    finish_reason = choice.finish_reason
+            if closed:
+                # the document is complete: stop reading and close the connection
+                stream.close()
+                break
+        end_time = time.time()
+        first_token_time = first_token_time or end_time
+        append_stat(stats, "llm_time_to_first_token", round(first_token_time - start_time, 3))
+        add_stat(stats, "llm_generation_seconds", end_time - first_token_time)
+        if usage is not None:
+            input_tokens, output_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            # stream closed before the usage chunk
+            input_tokens, output_tokens = estimate_tokens(input_data), count_tokens(parser.text, self.model_name)
+        truncated = finish_reason == "length" or not parser.complete
+        return parser.text.strip(), input_tokens, output_tokens, truncated
+
+    def finalize_output(self, text: str, stats: dict = None) -> str:
+        """
+        Converts a structured output to the format of the system prompt (see to_legacy_format). An output that is still
+        truncated is closed at its last complete value, so the invoices found before the cut are not lost.
+        """
+        if not self.structured_output:
+            return text
+        try:
+            return to_legacy_format(text)
+        except (json.JSONDecodeError, AttributeError):
+            pass
+        parser = StreamingJSONParser()
+        parser.feed(text)
+        repaired = parser.repair()
+        if repaired is None:
+            return text
+        add_stat(stats, "llm_outputs_repaired")
+        return to_legacy_format(repaired)
     
     def print_current_history(self):
         print(json.dumps(self.chat_history, indent=2))
@@ -108,7 +418,7 @@ class EntityExtractor:
 
 class SnowTicket:
 
-    def __init__(self, input_ticket:dict, dir_to_att:str="data/outputs/entity_extaction"):
+    def __init__(self, input_ticket:dict, dir_to_att:str="data/outputs/entity_extaction", ocr_pool=None, use_text_layer:bool=True, ocr_mode:str="full", min_ocr_confidence:float=60.0, conversion_cache:ConversionCache=None, download_pool=None, max_attachment_bytes:int=None, relevance_filter:RelevanceFilter=None, entity_resolver:EntityResolver=None, tabular_max_rows:int=5000, tabular_max_cols:int=50, ocr_dpi:int|str=200, max_pdf_pages:int=None, max_archive_depth:int=2, page_dedup:PageDeduplicator=None):
         self.ticket = input_ticket
         self.dir_att_path = dir_to_att + "/" + self.ticket['number']
         self.description = self.ticket['short_description'] + "\n" + self.ticket['description'] + "\n\n"
@@ -119,6 +429,38 @@ class SnowTicket:
         self.sanitized_att_names = []
         self.str_attachments = ""
         self.processed_ticket = ""
+        # optional process pool shared across tickets to OCR PDF pages in parallel
+        self.ocr_pool = ocr_pool
+        # use the embedded text of digital PDFs and OCR only scanned/image-only pages
+        self.use_text_layer = use_text_layer
+        # "full" (OSD + two OCR passes) or "fast" (single pass, re-run only on low confidence or language change)
+        self.ocr_mode = ocr_mode
+        self.min_ocr_confidence = min_ocr_confidence
+        # DPI of the pages rasterized for OCR ("adaptive" to choose it per page) and maximum number of pages converted per PDF
+        self.ocr_dpi = ocr_dpi
+        self.max_pdf_pages = max_pdf_pages
+        # optional on-disk cache of attachment conversions shared across tickets and runs
+        self.conversion_cache = conversion_cache
+        # optional thread pool shared across tickets to download attachments in parallel, and maximum size of an attachment
+        self.download_pool = download_pool
+        self.max_attachment_bytes = max_attachment_bytes
+        # attachments not downloaded (too large or failed download) with the reason
+        self.skipped_attachments = {}
+        # optional filter keeping only the regions of the attachments around invoice/PO/delivery note/vendor anchors
+        self.relevance_filter = relevance_filter
+        # optional index of entity_codes.json used to resolve the entities of the extracted invoices to their company codes
+        self.entity_resolver = entity_resolver
+        # rows and columns read from every sheet of CSV/Excel attachments
+        self.tabular_max_rows = tabular_max_rows
+        self.tabular_max_cols = tabular_max_cols
+        # levels of archives (zip, eml) expanded, 0 to not convert archives
+        self.max_archive_depth = max_archive_depth
+        # optional deduplication of the pages and images repeated across the attachments (OCR skipped, repeated pages dropped from the LLM input)
+        self.page_dedup = page_dedup
+        # counters and timings of the conversion of the ticket, reported in the run metrics
+        self.stats = {}
+        # error that stopped the download or conversion of the attachments (the ticket is not sent to the LLM), None if there was none
+        self.error = None
 
     def __str__(self):
         "Representation when printing"
@@ -129,7 +471,8 @@ class SnowTicket:
 
     def get_attachment_ids(self):
         # returns attachment ids + attachment names
-        attachment_ids, attachment_names = get_attachments_from_ticket(self.ticket['sys_id'])
+        with timer(self.stats, "time_attachment_list"):
+            attachment_ids, attachment_names = get_attachments_from_ticket(self.ticket['sys_id'])
         return attachment_ids, attachment_names
     
     def download_attachments(self):
@@ -137,36 +480,68 @@ class SnowTicket:
         if not os.path.exists(self.dir_att_path):
             os.makedirs(self.dir_att_path)
         self.sanitized_att_names = []
-        # download attachments
+        self.skipped_attachments = {}
+        # download attachments, in parallel if a download pool is given. Their type is detected from their content, not their extension,
+        # but clearly non-convertible files (video, executables, disk images, ...) are not downloaded
+        downloads = []
         for attachment_id, attachment_name in zip(self.attachment_ids, self.attachment_names):
-            self.sanitized_att_names += [download_attachment_from_id(attachment_id, attachment_name, dir=self.dir_att_path)]
+            if is_non_convertible(attachment_name):
+                sanitized_att_name = sanitize_filename(attachment_name)
+                self.skipped_attachments[sanitized_att_name] = "type not supported"
+                add_stat(self.stats, "attachments_skipped")
+                downloads.append(sanitized_att_name)
+            elif self.download_pool is not None:
+                downloads.append(self.download_pool.submit(self.download_attachment, attachment_id, attachment_name))
+            else:
+                downloads.append(self.download_attachment(attachment_id, attachment_name))
+        for download in downloads:
+            self.sanitized_att_names += [download if isinstance(download, str) else download.result()]
+
+    def download_attachment(self, attachment_id: str, attachment_name: str) -> str:
+        # download a single attachment, recording it as skipped if it is too large or the download fails
+        try:
+            with timer(self.stats, "time_download"):
+                sanitized_att_name = download_attachment_from_id(attachment_id, attachment_name, dir=self.dir_att_path, max_bytes=self.max_attachment_bytes)
+        except (AttachmentDownloadError, http.client.HTTPException, OSError) as e:
+            print(f"WARNING: attachment {attachment_name} of ticket {self.ticket['number']} skipped: {e}")
+            sanitized_att_name = sanitize_filename(attachment_name)
+            self.skipped_attachments[sanitized_att_name] = str(e)
+            add_stat(self.stats, "attachments_skipped")
+            return sanitized_att_name
+        add_stat(self.stats, "attachments_downloaded")
+        add_stat(self.stats, "download_bytes", os.path.getsize(self.dir_att_path + "/" + sanitized_att_name))
+        return sanitized_att_name
+
+    def converter_options(self) -> dict:
+        # settings of the attachment converters (see utils/converters.py)
+        return {"ocr_pool": self.ocr_pool, "use_text_layer": self.use_text_layer, "ocr_mode": self.ocr_mode, "min_confidence": self.min_ocr_confidence,
+                "dpi": self.ocr_dpi, "max_pages": self.max_pdf_pages, "max_rows": self.tabular_max_rows, "max_cols": self.tabular_max_cols,
+                "max_archive_depth": self.max_archive_depth, "max_member_bytes": self.max_attachment_bytes}
 
     def process_attachments(self):
         str_attachments = ""
-        i = 1
-        # convert attachments to text: depending on the file extension we need to use different functions to convert to text
-        for attachment_name in self.sanitized_att_names:
-            extension = (attachment_name.split(".")[-1]).lower()
-            if extension == "pdf":
-                str_att = f"FILE {i} - {attachment_name}:\n\n" + pdf2text(self.dir_att_path + "/" + attachment_name) + "\n\n"
-            elif extension in ["jpg", "jpeg", "png"]:
-                str_att = f"FILE {i} - {attachment_name}:\n\n" + image2text(self.dir_att_path + "/" + attachment_name) + "\n\n"
-            elif extension in ["txt"]:
-                with open(self.dir_att_path + "/" + attachment_name, "r") as file:
-                    str_att = f"FILE {i} - {attachment_name}:\n\n" + file.read() + "\n\n"
-            elif extension in ["docx"]:
-                str_att = f"FILE {i} - {attachment_name}:\n\n" + word_to_text(self.dir_att_path + "/" + attachment_name) + "\n\n"
-            elif extension in ["csv", "xls", "xlsx","xlsb"]:
-                str_att = f"FILE {i} - {attachment_name}:\n\n" + tabular_to_text(self.dir_att_path + "/" + attachment_name) + "\n\n"
+        options = self.converter_options()
+        # pages seen in the attachments of this ticket, not part of the converter settings (not in the cache key)
+        page_index = self.page_dedup.new_index() if self.page_dedup is not None else None
+        options["page_index"] = page_index
+        # convert attachments to text with the converter of their type, detected from their content (zip and eml attachments are expanded)
+        for i, attachment_name in enumerate(self.sanitized_att_names, start=1):
+            file_path = self.dir_att_path + "/" + attachment_name
+            if attachment_name in self.skipped_attachments:
+                text = f"File {attachment_name} not downloaded: {self.skipped_attachments[attachment_name]}"
+            elif CONVERTERS.converter_for(file_path) is None:
+                add_stat(self.stats, "attachments_skipped")
+                text = f"File {attachment_name} type not supported"
+            else:
+                # TODO: verify cases when the type is not supported and maybe don't include it in the str_attachments
+                text = CONVERTERS.convert(file_path, options, stats=self.stats, cache=self.conversion_cache)
+            if page_index is not None:
+                text = page_index.filter_pages(text, f"FILE {i} - {attachment_name}", stats=self.stats)
             else:
-                # TODO: verify cases when this happens and maybe set exception and don't include it in the str_attachments
-                # TODO: Print/log warning when this happens
-                str_att = f"FILE {i} - {attachment_name}:\n\n" + f"File {attachment_name} type not supported" + "\n\n"
-            i += 1
-            str_attachments += str_att
+                text = text.replace(PAGE_BREAK, "")
+            str_attachments += f"FILE {i} - {attachment_name}:\n\n" + text + "\n\n"
         return str_attachments
 
-    
     def process_ticket(self):
         # returns ticket structured to be input to LLM
         processed_ticket = f"TICKET DESCRIPTION: {self.description}\n\n"
@@ -175,12 +550,23 @@ class SnowTicket:
 
         return processed_ticket
     
-    def to_llm_input(self):
-
+    def fetch_attachments(self):
+        # get attachment ids and download the attachments (network bound)
         self.attachment_ids, self.attachment_names = self.get_attachment_ids()
         if self.attachment_ids != []:
             self.download_attachments()
+
+    def convert_attachments(self):
+        # convert downloaded attachments to text and build the LLM input (CPU bound)
+        if self.attachment_ids != []:
             self.str_attachments = self.process_attachments()
+            if self.relevance_filter is not None:
+                self.str_attachments = self.relevance_filter.apply(self.str_attachments, stats=self.stats)
         self.processed_ticket = self.process_ticket()
         return self.processed_ticket
+
+    def to_llm_input(self):
+
+        self.fetch_attachments()
+        return self.convert_attachments()
         
\ No newline at end of file
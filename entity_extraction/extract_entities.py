@@ -2,11 +2,25 @@ import sys
 from pathlib import Path
 # Set sys.path to include the project root
 sys.path.append(str(Path(__file__).resolve().parent.parent))
-from utils.snowAPI import get_tickets,filter_tickets, Region
+from utils.snowAPI import get_tickets, iter_tickets, filter_tickets, Region
 from utils.openAI_cost import calculate_openai_cost
-from utils.processing import post_process_extracted_text
+from utils.processing import post_process_extracted_text, merge_extracted_texts, create_ocr_pool
 from utils.load_env_vars import load_env_vars
+from utils.pipeline import Pipeline
+from utils.rate_limiter import RateLimiter
+from utils.deployment_pool import DeploymentPool
+from utils.cache import ConversionCache, ResponseCache
+from utils.relevance import RelevanceFilter
+from utils.page_dedup import PageDeduplicator
+from utils.metrics_sink import MetricsSink
+from utils.results_store import ResultsStore
+from utils.stats import append_stat
+from utils.entity_resolver import load_entity_resolver, DEFAULT_ENTITY_CODES_PATH
+from utils.run_state import RunManifest, load_watermark, save_watermark, watermark_before_failures
+from utils.batch_api import write_batch_file, submit_batch, wait_for_batch, read_batch_results
+from utils.converters import CONVERTERS
 from entity_extraction.core import SnowTicket, EntityExtractor
+from entity_extraction.local_classifier import LocalSubcategoryClassifier, ticket_text
 import json
 import numpy as np
 import pandas as pd
@@ -14,90 +28,415 @@ import os
 import json
 import time
 import argparse
-from datetime import datetime
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
+# per ticket counters collected in SnowTicket.stats that are added as columns of the metrics file
+TICKET_STATS = ["pdf_pages_text_layer", "pdf_pages_ocr", "pdf_pages_error", "pdf_pages_skipped", "pdf_page_dpi", "pdf_page_image_mb", "pdf_page_peak_rss_mb",
+                "ocr_passes", "ocr_reruns", "cache_hits", "cache_misses", "cache_seconds_saved",
+                "attachments_downloaded", "attachments_skipped", "download_bytes", "input_tokens_counted", "llm_chunks", "llm_chunk_tokens",
+                "llm_cache_hits", "llm_cache_misses", "llm_cache_tokens_saved", "llm_time_to_first_token", "llm_generation_seconds",
+                "llm_truncations", "llm_truncation_retries", "llm_outputs_repaired", "relevance_tokens_before", "relevance_tokens_after", "relevance_fallbacks",
+                "archive_members", "archive_members_skipped", "llm_deployment", "llm_failovers", "pdf_pages_duplicate", "images_duplicate",
+                "dedup_pages_dropped", "dedup_tokens_saved"]
+# per ticket stage timers (lists with the seconds of every event) streamed to the metrics sink. The metrics file has their total per ticket
+TIMING_STATS = ["time_attachment_list", "time_download", "time_rasterize", "time_osd", "time_ocr_pass", "time_tabular_parse",
+                "time_llm_queue_wait", "time_rate_limit_wait", "time_llm_latency", "time_converter_load", "time_page_fingerprint"] + CONVERTERS.timers()
 
-def extract_entities(start_date, end_date, selected_regions, path_to_env_var, path_to_system_prompt):
+def empty_metrics() -> dict:
+    """Columns of the metrics file (one list per column, one value per ticket)."""
+    metrics = {"ticket":[],"input_tokens":[], "output_tokens":[], "time_to_ticket_to_text":[], "time_to_extract_entities":[], "costs_gpt4o":[], "error":[]}
+    metrics.update({key: [] for key in TICKET_STATS + TIMING_STATS})
+    return metrics
+
+def build_ticket_options(model_name, ocr_pool=None, conversion_cache=None, download_pool=None, use_text_layer=True, ocr_mode="full", min_ocr_confidence=60.0, max_attachment_mb=250,
+                         relevance_filter=False, relevance_context_lines=3, relevance_max_reduction=0.95, relevance_min_tokens=2000, resolve_entities=False, entity_codes_path=DEFAULT_ENTITY_CODES_PATH,
+                         entity_min_score=0.75, tabular_max_rows=5000, tabular_max_cols=50, ocr_dpi=200, max_pdf_pages=None, max_archive_depth=2,
+                         page_dedup=False, page_dedup_similarity=0.9) -> dict:
+    """Options of the attachment download and conversion passed to every SnowTicket, sharing the given pools and cache."""
+    return {"ocr_pool": ocr_pool, "use_text_layer": use_text_layer, "ocr_mode": ocr_mode, "min_ocr_confidence": min_ocr_confidence, "conversion_cache": conversion_cache,
+            "download_pool": download_pool, "max_attachment_bytes": max_attachment_mb * 1024 * 1024 if max_attachment_mb is not None else None,
+            "relevance_filter": RelevanceFilter(context_lines=relevance_context_lines, max_reduction=relevance_max_reduction, min_tokens=relevance_min_tokens, model=model_name) if relevance_filter else None,
+            "entity_resolver": load_entity_resolver(entity_codes_path, entity_min_score) if resolve_entities else None,
+            "tabular_max_rows": tabular_max_rows, "tabular_max_cols": tabular_max_cols, "ocr_dpi": ocr_dpi, "max_pdf_pages": max_pdf_pages,
+            "max_archive_depth": max_archive_depth,
+            "page_dedup": PageDeduplicator(min_similarity=page_dedup_similarity, model=model_name) if page_dedup else None}
+
+def prepare_ticket(snow_ticket: SnowTicket) -> float:
+    """Downloads attachments, converts them to text and combines them with the ticket description. Returns the time spent."""
+    start_time = time.time()
+    snow_ticket.to_llm_input()
+    return time.time() - start_time
+
+def run_entity_extraction(snow_ticket: SnowTicket, entity_extractor: EntityExtractor, time_to_llm_input: float) -> dict:
+    """Extracts and post-processes the entities of a prepared ticket. Returns the results and metrics of the ticket (an error result if it could not be prepared)."""
+    if snow_ticket.error is not None:
+        return build_ticket_result(snow_ticket, "", 0, 0, f"**ERROR PREPARING TICKET**: {snow_ticket.error}\n\n", True, time_to_llm_input, 0.0, model=entity_extractor.model_name, priced=entity_extractor.priced)
+    time_to_process_attachments_str = str(time_to_llm_input//60) + " minutes " + str(time_to_llm_input%60) + " seconds"
+    print(f"Attachments processed in: {time_to_process_attachments_str}")
+    start_time = time.time()
+    error = False
+    # Initialize log
+    log = ""
+    # extract entities from processed tickets. If input is larger than max_content, it might exceed token rate limit
+    try:  
+        extracted_text, input_tokens, output_tokens = entity_extractor.extract_entities(snow_ticket.processed_ticket, stats=snow_ticket.stats)
+    except Exception as e:
+        extracted_text,input_tokens, output_tokens = "", 0 , 0
+        log+="**ERROR: Token rate limit exceded**\n\n"
+        print(f"ERROR extracting entities: {e}")
+        error = True
+    # calculate time spent in extracting entities
+    time_to_extract_entities = time.time() - start_time
+    return build_ticket_result(snow_ticket, extracted_text, input_tokens, output_tokens, log, error, time_to_llm_input, time_to_extract_entities, model=entity_extractor.model_name, priced=entity_extractor.priced)
+
+def build_ticket_result(snow_ticket: SnowTicket, extracted_text: str, input_tokens: int, output_tokens: int, log: str, error: bool, time_to_llm_input: float, time_to_extract_entities: float, batch: bool = False, model: str = "gpt-4o", priced: bool = True) -> dict:
+    """Post-processes the output of the LLM for a ticket and returns the results and metrics of the ticket."""
+    # post process extacted text:
+    try:    
+        extracted_text_post_processed = post_process_extracted_text(extracted_text, snow_ticket.vcc_entity, entity_resolver=snow_ticket.entity_resolver)
+    except Exception as e:
+        extracted_text_post_processed = "**ERROR IN LLM OUTPUT FORMAT**\n"
+        error = True
+        # this error usually is because output is longer than max_output_tokens in EntityExtractor.extract_entities, so the output is truncated and the dictionary is never closed with }
+    time_to_extract_entities_str = str(time_to_extract_entities//60) + " minutes " + str(time_to_extract_entities%60) + " seconds"
+    print(f"Entities extracted in: {time_to_extract_entities_str}")
+    # calculate cost (None if the price of the model is unknown)
+    cost_gpt4o = calculate_openai_cost(input_tokens, output_tokens, model=model, batch=batch) if priced else None
+    return {
+        "log": log,
+        "extracted_text": extracted_text,
+        "extracted_text_post_processed": extracted_text_post_processed,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "costs_gpt4o": cost_gpt4o,
+        "time_to_ticket_to_text": time_to_llm_input,
+        "time_to_extract_entities": time_to_extract_entities,
+        "error": error,
+    }
+
+def save_ticket_results(snow_ticket: SnowTicket, result: dict, metrics: dict, results_store: ResultsStore = None, keep_attachments: bool = True):
+    """
+    Adds the ticket results to the run metrics and writes the log and extracted entities of the ticket, to its folder
+    or as a row of the results store. Without keep_attachments, the downloaded attachments are deleted.
+    """
+    # add metrics to dictionary
+    metrics["ticket"].append(snow_ticket.ticket['number'])
+    metrics["input_tokens"].append(result["input_tokens"])
+    metrics["output_tokens"].append(result["output_tokens"])
+    metrics["costs_gpt4o"].append(result["costs_gpt4o"])
+    metrics["time_to_ticket_to_text"].append(result["time_to_ticket_to_text"])
+    metrics["time_to_extract_entities"].append(result["time_to_extract_entities"])
+    metrics["error"].append(result["error"])
+    for key in TICKET_STATS:
+        value = snow_ticket.stats.get(key, 0)
+        metrics[key].append(", ".join(map(str, value)) if isinstance(value, list) else value)
+    for key in TIMING_STATS:
+        metrics[key].append(round(sum(snow_ticket.stats.get(key, [])), 4))
+
+    # combine processed ticket + output
+    log = result["log"]
+    log += "LLM_INPUT:\n" + snow_ticket.processed_ticket + "TICKET ENTITY:\n" + snow_ticket.vcc_entity + "\n\nLLM_OUTPUT\n" + result["extracted_text"] + "\n\nLLM_OUTPUT + ENTITY\n" + result["extracted_text_post_processed"]
+    log += "\n\nINPUT_TOKENS:" + str(result["input_tokens"]) + "\nOUTPUT_TOKENS:" + str(result["output_tokens"])
+    log += "\n\nTIME TO PROCESS TICKET: " + str(result["time_to_ticket_to_text"]) + "\nTIME TO EXTRACT ENTITIES: " + str(result["time_to_extract_entities"]) + "\n"
+    log += "\n\n COSTS: " + "[" + str(result["costs_gpt4o"]) +"]"
+    notes = ""
+    if snow_ticket.stats.get("relevance_tokens_before"):
+        notes += f"\n\nRELEVANCE FILTER: attachments reduced from {snow_ticket.stats['relevance_tokens_before']} to {snow_ticket.stats['relevance_tokens_after']} tokens"
+        notes += " (fallback to full text)" if snow_ticket.stats.get("relevance_fallbacks") else ""
+    if snow_ticket.stats.get("pdf_page_methods"):
+        notes += "\n\nPDF PAGES:\n" + "\n".join(snow_ticket.stats["pdf_page_methods"])
+    log += notes
+    if results_store is not None:
+        # input, outputs and metrics are columns of their own: the log column only keeps the errors and notes
+        results_store.append({**{key: values[-1] for key, values in metrics.items()}, "sys_created_on": snow_ticket.ticket.get("sys_created_on"), "vcc_entity": snow_ticket.vcc_entity,
+                              "llm_input": snow_ticket.processed_ticket, "llm_output": result["extracted_text"], "extracted_entities": result["extracted_text_post_processed"],
+                              "log": (result["log"] + notes).strip(), "attachments": ", ".join(snow_ticket.sanitized_att_names)})
+        if not keep_attachments:
+            shutil.rmtree(snow_ticket.dir_att_path, ignore_errors=True)
+        return
+    if not keep_attachments:
+        for attachment_name in snow_ticket.sanitized_att_names:
+            if os.path.exists(snow_ticket.dir_att_path + "/" + attachment_name):
+                os.remove(snow_ticket.dir_att_path + "/" + attachment_name)
+    # create directory for the ticket if it does not exist
+    os.makedirs(snow_ticket.dir_att_path, exist_ok=True)
+    # save the log file
+    with open(snow_ticket.dir_att_path + "/" + "log.txt", "w", encoding="utf-8") as file:
+        file.write(log)
+    # save the results
+    with open(snow_ticket.dir_att_path + "/" + "extracted_entities.txt", "w", encoding="utf-8") as file:
+        file.write(result["extracted_text_post_processed"])
+
+def select_tickets(tickets, watermark, selected_regions, manifest, run_state):
+    """
+    Generator filtering a stream of tickets: created after the watermark, from the selected regions and not completed yet.
+    The newest sys_created_on seen is kept in run_state["last_sys_created_on"], all of them in run_state["created_on"] if present.
+    """
+    mapped_regions = [Region[r].value for r in selected_regions] if selected_regions is not None else None
+    for ticket in tickets:
+        if watermark is not None and ticket["sys_created_on"] <= watermark:
+            continue
+        if mapped_regions is not None and ticket["u_region"] not in mapped_regions:
+            continue
+        if run_state["last_sys_created_on"] is None or ticket["sys_created_on"] > run_state["last_sys_created_on"]:
+            run_state["last_sys_created_on"] = ticket["sys_created_on"]
+        if "created_on" in run_state:
+            run_state["created_on"].add(ticket["sys_created_on"])
+        if manifest.is_completed(ticket["number"]):
+            continue
+        yield ticket
+
+def gate_tickets(tickets, local_classifier, gate_subcategories, gate_threshold, gated):
+    """
+    Generator dropping the tickets that the local classifier predicts, with a confidence of at least gate_threshold, to be of a
+    subcategory not in gate_subcategories, so their attachments are never downloaded nor sent to the LLM. Dropped tickets are appended to gated.
+    """
+    for ticket in tickets:
+        subcategory, confidence = local_classifier.predict([ticket_text(ticket)])[0]
+        if subcategory not in gate_subcategories and confidence >= gate_threshold:
+            gated.append({"ticket": ticket["number"], "predicted_subcategory": subcategory, "confidence": confidence})
+            continue
+        yield ticket
+
+def process_tickets_sequentially(tickets, results_path, entity_extractor, ticket_options=None):
+    """Generator processing the tickets one at a time: download, OCR, LLM call. Yields (snow_ticket, result)."""
+    # Download attachments, process attachments, convert attachments to text and combine with ticket description and title. (preprocess ticket)
+    for snow_ticket, time_to_llm_input in prepare_tickets(tickets, results_path, ticket_options):
+        yield snow_ticket, run_entity_extraction(snow_ticket, entity_extractor, time_to_llm_input)
+
+def fetch_ticket(ticket: dict, results_path: str, ticket_options: dict = None) -> tuple[SnowTicket, float]:
+    """
+    Creates the SnowTicket and downloads its attachments (network bound). Returns the ticket and the time spent.
+    A failure (e.g. SNOW error) is kept in snow_ticket.error instead of raised, so it doesn't stop the other tickets.
+    """
+    snow_ticket = SnowTicket(ticket,results_path,**(ticket_options or {}))
+    print(f"Processing ticket number:{snow_ticket.ticket['number']}, from selected entity: {snow_ticket.vcc_entity}")
+    start_time = time.time()
+    try:
+        snow_ticket.fetch_attachments()
+    except Exception as e:
+        print(f"ERROR fetching the attachments of ticket {snow_ticket.ticket['number']}: {e}")
+        snow_ticket.error = f"attachments not fetched: {type(e).__name__}: {e}"
+    return snow_ticket, time.time() - start_time
+
+def convert_ticket(fetched: tuple[SnowTicket, float]) -> tuple[SnowTicket, float]:
+    """Converts the attachments of a fetched ticket to text and builds the LLM input (CPU bound). Returns the ticket and the time to LLM input."""
+    snow_ticket, time_to_fetch = fetched
+    if snow_ticket.error is not None:
+        return snow_ticket, time_to_fetch
+    start_time = time.time()
+    try:
+        snow_ticket.convert_attachments()
+    except Exception as e:
+        # e.g. a corrupt PDF: the ticket fails, the other tickets go on
+        print(f"ERROR converting the attachments of ticket {snow_ticket.ticket['number']}: {e}")
+        snow_ticket.error = f"attachments not converted: {type(e).__name__}: {e}"
+    return snow_ticket, time_to_fetch + time.time() - start_time
+
+def process_tickets_pipelined(tickets, results_path, entity_extractor, fetch_workers, convert_workers, llm_workers, ticket_options=None):
+    """
+    Generator processing the tickets in a pipeline: attachment fetching, text conversion and entity extraction
+    run as separate stages with their own worker pools, so different tickets are downloaded, OCR'd and sent to the LLM at the same time.
+    Yields (snow_ticket, result) in the same order as the sequential mode.
+    """
+    def extract(prepared):
+        snow_ticket, time_to_llm_input, prepared_at = prepared
+        # time the ticket waited for a free LLM worker
+        append_stat(snow_ticket.stats, "time_llm_queue_wait", round(time.time() - prepared_at, 4))
+        return snow_ticket, run_entity_extraction(snow_ticket, entity_extractor, time_to_llm_input)
+
+    prepared = ((snow_ticket, time_to_llm_input, time.time()) for snow_ticket, time_to_llm_input
+                in prepare_tickets(tickets, results_path, ticket_options, pipeline=True, fetch_workers=fetch_workers, convert_workers=convert_workers))
+    yield from Pipeline([("extract", extract, llm_workers)]).map(prepared)
+
+def prepare_tickets(tickets, results_path, ticket_options=None, pipeline=False, fetch_workers=4, convert_workers=2):
+    """Generator downloading and converting the attachments of the tickets (in a pipeline if pipeline=True). Yields (snow_ticket, time_to_llm_input)."""
+    fetch = lambda ticket: fetch_ticket(ticket, results_path, ticket_options)
+    if pipeline:
+        yield from Pipeline([("fetch", fetch, fetch_workers), ("convert", convert_ticket, convert_workers)]).map(tickets)
+    else:
+        for ticket in tickets:
+            yield convert_ticket(fetch(ticket))
+
+def process_tickets_batch(tickets, results_path, entity_extractor, ticket_options=None, pipeline=False, fetch_workers=4, convert_workers=2, poll_interval=60):
+    """
+    Offline mode for large backfills: all tickets are prepared first and written as a JSONL batch file, which is
+    submitted to the Azure OpenAI Batch API. When the batch is done, the outputs are mapped back to the tickets.
+    Yields (snow_ticket, result) like the other modes.
+    """
+    prepared_tickets = []
+    requests = []
+    for snow_ticket, time_to_llm_input in prepare_tickets(tickets, results_path, ticket_options, pipeline, fetch_workers, convert_workers):
+        if snow_ticket.error is not None:
+            yield snow_ticket, run_entity_extraction(snow_ticket, entity_extractor, time_to_llm_input)
+            continue
+        ticket_requests = entity_extractor.build_batch_requests(snow_ticket.ticket['number'], snow_ticket.processed_ticket, stats=snow_ticket.stats)
+        prepared_tickets.append((snow_ticket, time_to_llm_input, [request["custom_id"] for request in ticket_requests]))
+        requests += ticket_requests
+    if not requests:
+        return
+    batch_path = os.path.join(results_path, "batch_input.jsonl")
+    write_batch_file(batch_path, requests)
+    print(f"\nSubmitting {len(requests)} requests of {len(prepared_tickets)} tickets to the Batch API\n")
+    start_time = time.time()
+    batch_id = submit_batch(entity_extractor.client, batch_path)
+    batch = wait_for_batch(entity_extractor.client, batch_id, poll_interval=poll_interval)
+    outputs = read_batch_results(entity_extractor.client, batch)
+    # time of the batch shared between its tickets
+    time_to_extract_entities = (time.time() - start_time) / len(prepared_tickets)
+    for snow_ticket, time_to_llm_input, custom_ids in prepared_tickets:
+        ticket_outputs = [outputs.get(custom_id, ("", 0, 0, f"no output for {custom_id} (batch {batch.status})")) for custom_id in custom_ids]
+        errors = [output[3] for output in ticket_outputs if output[3] is not None]
+        log = ""
+        if errors:
+            log += "**ERROR IN BATCH REQUEST**: " + "; ".join(errors) + "\n\n"
+            print(f"ERROR extracting entities of {snow_ticket.ticket['number']}: {errors}")
+        texts = [entity_extractor.finalize_output(output[0], stats=snow_ticket.stats) for output in ticket_outputs]
+        extracted_text = texts[0] if len(texts) == 1 else merge_extracted_texts(texts)
+        input_tokens = sum(output[1] for output in ticket_outputs)
+        output_tokens = sum(output[2] for output in ticket_outputs)
+        yield snow_ticket, build_ticket_result(snow_ticket, extracted_text, input_tokens, output_tokens, log, bool(errors), time_to_llm_input, time_to_extract_entities, batch=True, model=entity_extractor.model_name, priced=entity_extractor.priced)
+
+def extract_entities(start_date, end_date, selected_regions, path_to_env_var, path_to_system_prompt, pipeline=False, fetch_workers=4, convert_workers=2, llm_workers=4, requests_per_minute=None, tokens_per_minute=None, ocr_workers=0, use_text_layer=True, ocr_mode="full", min_ocr_confidence=60.0, cache_dir=None, cache_max_mb=1024, resume_dir=None, incremental=False, watermark_path=None, download_workers=4, max_attachment_mb=250, max_input_tokens=65536, batch=False, batch_poll_interval=60, llm_cache="use", llm_cache_ttl_days=30, llm_cache_max_mb=1024, structured_output=False, max_output_tokens_limit=8192, gate_classifier_path=None, gate_threshold=0.9, gate_subcategories=("Invoice Payment Status",), relevance_filter=False, relevance_context_lines=3, relevance_max_reduction=0.95, relevance_min_tokens=2000, resolve_entities=False, entity_codes_path=DEFAULT_ENTITY_CODES_PATH, entity_min_score=0.75, metrics_format="jsonl", results_store="files", shard_size=1000, keep_attachments=True, tabular_max_rows=5000, tabular_max_cols=50, ocr_dpi=200, max_pdf_pages=None, max_archive_depth=2, deployments_path=None, page_dedup=False, page_dedup_similarity=0.9):
     current_dir = os.getcwd()
     # Get api keys and other secrets
     load_env_vars(path_to_env_var)
     with open(path_to_system_prompt, "r", encoding="utf-8") as file:
         system_prompt = file.read()
-    # create folder with results
-    timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-    results_folder_name = timestamp_str + "_run"
-    results_path = os.path.join(current_dir,"data","outputs","entity_extraction",results_folder_name)
-    os.makedirs(results_path, exist_ok=True)
-    # TODO: for the implementation maybe need to add time-stamp when extracting from SNOW API or filter tickets with filter_tickets(tickets, field_key, field_value)
-    tickets = get_tickets(start_date=start_date, end_date=end_date)
-    print(f"\nCollected a total of {len(tickets)} Snow tickets across all markets between {start_date} and {end_date}\n")
-    if selected_regions is not None:
-        mapped_regions = [Region[r].value for r in selected_regions]
-        tickets = filter_tickets(tickets, "u_region", mapped_regions)
-        print(f"Filtered to a total of {len(tickets)} Snow tickets from the following markets: {selected_regions}\n")
-    print(f"Start to extract entities from {len(tickets)} Snow tickets:\n\n")
+    if watermark_path is None:
+        watermark_path = os.path.join(current_dir,"data","outputs","entity_extraction","watermark.json")
+    watermark = None
+    if resume_dir is not None:
+        # continue an interrupted run in its own folder, with the same parameters
+        results_path = os.path.abspath(resume_dir)
+        timestamp_str = os.path.basename(os.path.normpath(results_path)).replace("_run", "")
+        manifest = RunManifest(results_path)
+        start_date, end_date = manifest.params["start_date"], manifest.params["end_date"]
+        selected_regions, incremental, watermark = manifest.params["regions"], manifest.params.get("incremental", False), manifest.params.get("watermark")
+        print(f"Resuming run {results_path}: {len(manifest.completed)} tickets already completed, {len(manifest.failed)} failed tickets processed again")
+    else:
+        if incremental:
+            # only fetch tickets created after the last ticket processed by the previous incremental run
+            watermark = load_watermark(watermark_path)
+            if watermark is not None:
+                start_date = watermark[:10]
+            elif start_date is None:
+                raise ValueError(f"No watermark found in {watermark_path}: the first incremental run needs a start_date")
+            if end_date is None:
+                end_date = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+            print(f"Incremental run. Last processed ticket created on: {watermark}")
+        # create folder with results
+        timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+        results_folder_name = timestamp_str + "_run"
+        results_path = os.path.join(current_dir,"data","outputs","entity_extraction",results_folder_name)
+        os.makedirs(results_path, exist_ok=True)
+        manifest = RunManifest(results_path, params={"regions": selected_regions, "start_date": start_date, "end_date": end_date, "incremental": incremental, "watermark": watermark})
+    # created_on of the tickets selected and of the failed ones: the watermark never moves past a failed ticket
+    run_state = {"last_sys_created_on": watermark, "created_on": set(), "failed_created_on": []}
+    # timers of the run not tied to a ticket (SNOW pages)
+    run_stats = {}
+    if pipeline:
+        # stream the tickets page by page, so the pipeline starts while the rest of the date range is still being downloaded
+        print(f"\nStreaming Snow tickets between {start_date} and {end_date}\n")
+        tickets = select_tickets(iter_tickets(start_date=start_date, end_date=end_date, stats=run_stats), watermark, selected_regions, manifest, run_state)
+    else:
+        # TODO: for the implementation maybe need to add time-stamp when extracting from SNOW API or filter tickets with filter_tickets(tickets, field_key, field_value)
+        tickets = get_tickets(start_date=start_date, end_date=end_date, stats=run_stats)
+        print(f"\nCollected a total of {len(tickets)} Snow tickets across all markets between {start_date} and {end_date}\n")
+        if watermark is not None:
+            tickets = [ticket for ticket in tickets if ticket["sys_created_on"] > watermark]
+            print(f"{len(tickets)} Snow tickets created after {watermark}\n")
+        if selected_regions is not None:
+            mapped_regions = [Region[r].value for r in selected_regions]
+            tickets = filter_tickets(tickets, "u_region", mapped_regions)
+            print(f"Filtered to a total of {len(tickets)} Snow tickets from the following markets: {selected_regions}\n")
+        # newest ticket of the run, saved as watermark for the next incremental run
+        run_state["last_sys_created_on"] = max([ticket["sys_created_on"] for ticket in tickets], default=watermark)
+        run_state["created_on"].update(ticket["sys_created_on"] for ticket in tickets)
+        if manifest.completed:
+            tickets = [ticket for ticket in tickets if not manifest.is_completed(ticket["number"])]
+            print(f"Skipping {len(manifest.completed)} tickets already completed\n")
+        print(f"Start to extract entities from {len(tickets)} Snow tickets:\n\n")
     # tickets = tickets[:10]
-    entity_extractor = EntityExtractor(system_prompt)
-    metrics = {"ticket":[],"input_tokens":[], "output_tokens":[], "time_to_ticket_to_text":[], "time_to_extract_entities":[], "costs_gpt4o":[], "error":[]}
-    for i,ticket in enumerate(tickets):
-        # create SnowTicket from ticket
-        snow_ticket = SnowTicket(ticket,results_path)
-        error = False
-        print(f"Processing ticket number:{snow_ticket.ticket['number']}, from selected entity: {snow_ticket.vcc_entity}")
-        start_time = time.time()
-        # Download attachments, process attachments, convert attachments to text and combine with ticket description and title. (preprocess ticket)
-        snow_ticket.to_llm_input()
-        # Calculate time to preprocess ticket
-        time_to_llm_input = time.time() - start_time
-        time_to_process_attachments_str = str(time_to_llm_input//60) + " minutes " + str(time_to_llm_input%60) + " seconds"
-        print(f"Attachments processed in: {time_to_process_attachments_str}")
-        # Initialize log
-        log = ""
-        # extract entities from processed tickets. If input is larger than max_content, it might exceed token rate limit
-        try:  
-            extracted_text, input_tokens, output_tokens = entity_extractor.extract_entities(snow_ticket.processed_ticket)
-        except Exception as e:
-            extracted_text,input_tokens, output_tokens = "", 0 , 0
-            log+="**ERROR: Token rate limit exceded**\n\n"
-            print(f"ERROR extracting entities: {e}")
-            error = True
-        # calculate time spent in extracting entities
-        time_to_extract_entities = time.time() - start_time - time_to_llm_input
-        # post process extacted text:
-        try:    
-            extracted_text_post_processed = post_process_extracted_text(extracted_text, snow_ticket.vcc_entity)
-        except Exception as e:
-            extracted_text_post_processed = "**ERROR IN LLM OUTPUT FORMAT**\n"
-            error = True
-            # this error usually is because output is longer than max_output_tokens in EntityExtractor.extract_entities, so the output is truncated and the dictionary is never closed with }
-        time_to_extract_entities_str = str(time_to_extract_entities//60) + " minutes " + str(time_to_extract_entities%60) + " seconds"
-        print(f"Entities extracted in: {time_to_extract_entities_str}")
-        # calculate cost
-        cost_gpt4o = calculate_openai_cost(input_tokens, output_tokens, model="gpt-4o")
-        # add metrics to dictionary
-        metrics["ticket"].append(snow_ticket.ticket['number'])
-        metrics["input_tokens"].append(input_tokens)
-        metrics["output_tokens"].append(output_tokens)
-        metrics["costs_gpt4o"].append(cost_gpt4o)
-        metrics["time_to_ticket_to_text"].append(time_to_llm_input)
-        metrics["time_to_extract_entities"].append(time_to_extract_entities)
-        metrics["error"].append(error)
-
-        # combine processed ticket + output
-        log += "LLM_INPUT:\n" + snow_ticket.processed_ticket + "TICKET ENTITY:\n" + snow_ticket.vcc_entity + "\n\nLLM_OUTPUT\n" + extracted_text + "\n\nLLM_OUTPUT + ENTITY\n" + extracted_text_post_processed
-        log += "\n\nINPUT_TOKENS:" + str(metrics["input_tokens"][i]) + "\nOUTPUT_TOKENS:" + str(metrics["output_tokens"][i])
-        log += "\n\nTIME TO PROCESS TICKET: " + str(metrics["time_to_ticket_to_text"][i]) + "\nTIME TO EXTRACT ENTITIES: " + str(metrics["time_to_extract_entities"][i]) + "\n"
-        log += "\n\n COSTS: " + "[" + str(metrics["costs_gpt4o"][i]) +"]"
-        # create directory for the ticket if it does not exist
-        os.makedirs(snow_ticket.dir_att_path, exist_ok=True)
-        # save the log file
-        with open(snow_ticket.dir_att_path + "/" + "log.txt", "w", encoding="utf-8") as file:
-            file.write(log)
-        # save the results
-        with open(snow_ticket.dir_att_path + "/" + "extracted_entities.txt", "w", encoding="utf-8") as file:
-            file.write(extracted_text_post_processed)
+    # local classifier as a gate: tickets confidently predicted as irrelevant are skipped before downloading their attachments
+    gated_tickets = []
+    if gate_classifier_path is not None:
+        tickets = gate_tickets(tickets, LocalSubcategoryClassifier.load(gate_classifier_path), gate_subcategories, gate_threshold, gated_tickets)
+    rate_limiter = None
+    if requests_per_minute is not None or tokens_per_minute is not None:
+        rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+    # cache of LLM responses, reused across runs (same deployment, prompt, ticket and parameters)
+    response_cache = None
+    if cache_dir is not None and llm_cache != "off":
+        response_cache = ResponseCache(cache_dir, max_size_bytes=llm_cache_max_mb * 1024 * 1024, ttl_seconds=llm_cache_ttl_days * 24 * 3600, refresh=llm_cache == "refresh")
+    # several Azure OpenAI deployments used as one (see utils/deployment_pool.py), each with its own quota. Otherwise the one of the environment variables
+    deployment_pool = DeploymentPool.from_file(deployments_path) if deployments_path is not None else None
+    entity_extractor = EntityExtractor(system_prompt, rate_limiter=rate_limiter, max_input_tokens=max_input_tokens, response_cache=response_cache,
+                                       structured_output=structured_output, max_output_tokens_limit=max_output_tokens_limit, deployment_pool=deployment_pool)
+    metrics = empty_metrics()
+    # metrics and stage timers of every ticket streamed to disk as soon as it is completed
+    metrics_sink = MetricsSink(results_path, timestamp_str, ["time_snow_fetch"] + TIMING_STATS, format=metrics_format)
+    # results of the tickets in compressed shards (results/ in the run folder) instead of a folder of text files per ticket
+    store = ResultsStore(results_path, format=results_store, shard_size=shard_size) if results_store != "files" else None
+    # metrics of the tickets completed before the run was interrupted
+    for row in manifest.metrics_rows():
+        for key in metrics:
+            metrics[key].append(row.get(key, 0))
+    # process pool shared by all tickets to OCR PDF pages in parallel
+    ocr_pool = create_ocr_pool(ocr_workers) if ocr_workers > 0 else None
+    # cache of attachment conversions, reused across runs
+    conversion_cache = ConversionCache(cache_dir, max_size_bytes=cache_max_mb * 1024 * 1024) if cache_dir is not None else None
+    # thread pool shared by all tickets to download attachments in parallel
+    download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="download") if download_workers > 0 else None
+    # options of the attachment download and conversion passed to every SnowTicket
+    ticket_options = build_ticket_options(entity_extractor.model_name, ocr_pool, conversion_cache, download_pool, use_text_layer=use_text_layer, ocr_mode=ocr_mode, min_ocr_confidence=min_ocr_confidence,
+                                          max_attachment_mb=max_attachment_mb, relevance_filter=relevance_filter, relevance_context_lines=relevance_context_lines,
+                                          relevance_max_reduction=relevance_max_reduction, relevance_min_tokens=relevance_min_tokens, resolve_entities=resolve_entities,
+                                          entity_codes_path=entity_codes_path, entity_min_score=entity_min_score, tabular_max_rows=tabular_max_rows, tabular_max_cols=tabular_max_cols,
+                                          ocr_dpi=ocr_dpi, max_pdf_pages=max_pdf_pages, max_archive_depth=max_archive_depth, page_dedup=page_dedup, page_dedup_similarity=page_dedup_similarity)
+    if batch:
+        processed_tickets = process_tickets_batch(tickets, results_path, entity_extractor, ticket_options=ticket_options, pipeline=pipeline, fetch_workers=fetch_workers, convert_workers=convert_workers, poll_interval=batch_poll_interval)
+    elif pipeline:
+        processed_tickets = process_tickets_pipelined(tickets, results_path, entity_extractor, fetch_workers, convert_workers, llm_workers, ticket_options=ticket_options)
+    else:
+        processed_tickets = process_tickets_sequentially(tickets, results_path, entity_extractor, ticket_options=ticket_options)
+    for i,(snow_ticket, result) in enumerate(processed_tickets):
+        save_ticket_results(snow_ticket, result, metrics, results_store=store, keep_attachments=keep_attachments)
+        if result["error"]:
+            # journaled as failed, so --resume and the next incremental run process the ticket again
+            manifest.mark_failed(snow_ticket.ticket['number'], {key: values[-1] for key, values in metrics.items()})
+            run_state["failed_created_on"].append(snow_ticket.ticket["sys_created_on"])
+        else:
+            manifest.mark_completed(snow_ticket.ticket['number'], {key: values[-1] for key, values in metrics.items()})
+        metrics_sink.write({**{key: values[-1] for key, values in metrics.items()}, **{key: snow_ticket.stats.get(key, []) for key in TIMING_STATS}})
         if i%5 == 0:
             print(f"\n{i+1} Tickets processed\n\n")
+    if ocr_pool is not None:
+        ocr_pool.shutdown()
+    if download_pool is not None:
+        download_pool.shutdown()
+    if conversion_cache is not None:
+        print(f"Conversion cache: {sum(metrics['cache_hits'])} hits, {sum(metrics['cache_misses'])} misses, {sum(metrics['cache_seconds_saved']):.1f} seconds saved")
+        conversion_cache.close()
+    if response_cache is not None:
+        print(f"LLM response cache: {sum(metrics['llm_cache_hits'])} hits, {sum(metrics['llm_cache_misses'])} misses, {sum(metrics['llm_cache_tokens_saved'])} tokens saved")
+        response_cache.close()
+    entity_extractor.deployment_pool.print_summary()
+    if relevance_filter:
+        tokens_before, tokens_after = sum(metrics["relevance_tokens_before"]), sum(metrics["relevance_tokens_after"])
+        print(f"Relevance filter: attachments reduced from {tokens_before} to {tokens_after} tokens ({(1 - tokens_after / tokens_before if tokens_before else 0):.0%}), {sum(metrics['relevance_fallbacks'])} tickets kept in full")
+    if page_dedup:
+        print(f"Page deduplication: {sum(metrics['dedup_pages_dropped'])} repeated pages dropped ({sum(metrics['dedup_tokens_saved'])} tokens saved), "
+              f"OCR skipped on {sum(metrics['pdf_pages_duplicate'])} PDF pages and {sum(metrics['images_duplicate'])} images")
+    if gate_classifier_path is not None:
+        print(f"Local classifier gate: {len(gated_tickets)} tickets skipped (LLM calls avoided), predicted not in {list(gate_subcategories)} with confidence >= {gate_threshold}")
+        pd.DataFrame(gated_tickets, columns=["ticket", "predicted_subcategory", "confidence"]).to_excel(os.path.join(results_path, "gated_tickets_" + timestamp_str + ".xlsx"), index=False)
+    if store is not None:
+        store.close()
+    metrics_sink.add_events(run_stats)
+    metrics_sink.save_summary()
     # save metrics in excel
     metrics_df = pd.DataFrame(metrics)
     metrics_df_path = os.path.join(results_path,"metrics_" + timestamp_str + ".xlsx")
@@ -106,27 +445,113 @@ def extract_entities(start_date, end_date, selected_regions, path_to_env_var, pa
     params = {
     "regions": selected_regions,
     "start_date": start_date,
-    "end_date": end_date
+    "end_date": end_date,
+    "incremental": incremental,
+    "watermark": watermark,
+    "gate_classifier": gate_classifier_path,
+    "gate_threshold": gate_threshold if gate_classifier_path is not None else None,
+    "tickets_gated": len(gated_tickets),
+    "entity_codes": entity_codes_path if resolve_entities else None,
+    "results_store": results_store,
+    "keep_attachments": keep_attachments,
+    "deployments": entity_extractor.deployment_pool.summary() if deployments_path is not None else None,
+    "page_dedup": {"min_similarity": page_dedup_similarity} if page_dedup else None,
+    "relevance_filter": {"context_lines": relevance_context_lines, "max_reduction": relevance_max_reduction, "min_tokens": relevance_min_tokens} if relevance_filter else None
     }
     params_path = os.path.join(results_path, f"parameters_{timestamp_str}.json")
     with open(params_path, "w", encoding="utf-8") as f:
         json.dump(params, f, indent=2, ensure_ascii=False)
+    # all tickets of the window are processed: move the watermark forward, up to the first failed ticket
+    if incremental:
+        new_watermark = watermark_before_failures(run_state["created_on"], run_state["failed_created_on"], watermark)
+        if run_state["failed_created_on"]:
+            print(f"{len(run_state['failed_created_on'])} tickets failed: watermark kept before the first of them ({new_watermark})")
+        if new_watermark is not None:
+            save_watermark(watermark_path, new_watermark)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process a ServiceNow ticket.")
 
     # Required positional arguments
-    parser.add_argument("start_date", help="time range start date for reading tickets")
-    parser.add_argument("end_date", help="time range end date for reading tickets")
+    parser.add_argument("start_date", nargs="?", default=None, help="time range start date for reading tickets (optional with --resume and --incremental)")
+    parser.add_argument("end_date", nargs="?", default=None, help="time range end date for reading tickets (optional with --resume and --incremental, default: today)")
 
     parser.add_argument("--regions", nargs='+', default=None, help="Space separated regions. Pick between APAC, EMEA and AMERICAS. Example: --regions APAC EMEA")
     parser.add_argument("--path_to_env_var", default="data/inputs/secrets/secrets.txt", help="path to file with env variables for Azure Open AI")
     parser.add_argument("--path_to_system_prompt", default="data/inputs/system_prompts/default_system_prompt_v6.txt", help="path to file for the system prompt of the entity extractor")
+    parser.add_argument("--pipeline", action="store_true", help="process tickets concurrently: attachment fetching, text conversion and entity extraction run as separate stages")
+    parser.add_argument("--fetch_workers", type=int, default=4, help="number of tickets fetching attachments at the same time (only with --pipeline)")
+    parser.add_argument("--convert_workers", type=int, default=2, help="number of tickets converting attachments to text at the same time (only with --pipeline)")
+    parser.add_argument("--llm_workers", type=int, default=4, help="number of concurrent requests to Azure Open AI (only with --pipeline)")
+    parser.add_argument("--download_workers", type=int, default=4, help="number of attachments downloaded at the same time, shared by all tickets (0 = one after another)")
+    parser.add_argument("--max_attachment_mb", type=int, default=250, help="attachments larger than this are not downloaded")
+    parser.add_argument("--ocr_workers", type=int, default=0, help="number of processes to OCR PDF pages in parallel, shared by all tickets (0 = OCR in the main process)")
+    parser.add_argument("--no_text_layer", action="store_true", help="OCR every PDF page, even if the PDF has embedded text")
+    parser.add_argument("--ocr_mode", choices=["full", "fast"], default="full", help="full: OSD + two OCR passes per image. fast: one OCR pass, re-run only if confidence is low or the language changes")
+    parser.add_argument("--ocr_min_confidence", type=float, default=60.0, help="mean word confidence (0-100) below which the fast OCR mode re-runs OCR")
+    parser.add_argument("--ocr_dpi", type=lambda value: value if value == "adaptive" else int(value), default=200, help="DPI of the PDF pages rasterized for OCR, or adaptive to choose it per page from the size of the page and of its text")
+    parser.add_argument("--max_pdf_pages", type=int, default=None, help="only the first pages of every PDF attachment are converted to text (default: all)")
+    parser.add_argument("--max_archive_depth", type=int, default=2, help="levels of zip/eml attachments expanded (a zip in a zip is 2 levels). 0 to not convert archives")
+    parser.add_argument("--tabular_max_rows", type=int, default=5000, help="rows read from every sheet of CSV/Excel attachments, the rest of the sheet is left out")
+    parser.add_argument("--tabular_max_cols", type=int, default=50, help="columns read from every sheet of CSV/Excel attachments")
+    parser.add_argument("--cache_dir", default=None, help="folder of the cache of attachment-to-text conversions, reused across runs (disabled if not given). Example: data/cache")
+    parser.add_argument("--cache_max_mb", type=int, default=1024, help="maximum size of the conversion cache in MB, least recently used entries are evicted")
+    parser.add_argument("--llm_cache", choices=["use", "refresh", "off"], default="use", help="cache of LLM responses in --cache_dir. use: reuse cached responses. refresh: call the LLM again and overwrite them. off: bypass the cache")
+    parser.add_argument("--llm_cache_ttl_days", type=float, default=30, help="cached LLM responses older than this are discarded")
+    parser.add_argument("--llm_cache_max_mb", type=int, default=1024, help="maximum size of the LLM response cache in MB, least recently used entries are evicted")
+    parser.add_argument("--resume", default=None, help="folder of an interrupted run to continue, skipping the tickets already completed. Example: --resume data/outputs/entity_extraction/20250706_143022_run")
+    parser.add_argument("--incremental", action="store_true", help="only process tickets created after the last ticket of the previous incremental run (watermark)")
+    parser.add_argument("--watermark_file", default=None, help="file storing the watermark of incremental runs (default: data/outputs/entity_extraction/watermark.json)")
+    parser.add_argument("--max_input_tokens", type=int, default=65536, help="token budget of a request to the LLM (system prompt + ticket). Longer tickets are split in chunks extracted separately and merged")
+    parser.add_argument("--structured_output", action="store_true", help="request JSON-schema-constrained output as a stream (API version 2024-08-01-preview or later)")
+    parser.add_argument("--max_output_tokens_limit", type=int, default=8192, help="truncated outputs are requested again with twice the max_output_tokens, up to this limit")
+    parser.add_argument("--gate_classifier", default=None, help="path to a local classifier trained with entity_extraction/local_classifier.py, used to skip irrelevant tickets before downloading their attachments")
+    parser.add_argument("--gate_threshold", type=float, default=0.9, help="minimum confidence (0-1) of the local classifier to skip a ticket")
+    parser.add_argument("--gate_subcategories", nargs='+', default=["Invoice Payment Status"], help="subcategories of the tickets to process, the rest are skipped by the gate")
+    parser.add_argument("--relevance_filter", action="store_true", help="send to the LLM only the regions of the attachments around invoice/PO/delivery note/vendor keywords and identifiers")
+    parser.add_argument("--relevance_context_lines", type=int, default=3, help="lines kept before and after every matching line")
+    parser.add_argument("--relevance_max_reduction", type=float, default=0.95, help="maximum share of the tokens dropped by the filter, the windows are widened to keep more text otherwise")
+    parser.add_argument("--relevance_min_tokens", type=int, default=2000, help="attachments shorter than this are not filtered")
+    parser.add_argument("--resolve_entities", action="store_true", help="resolve the entity of every invoice to its canonical name and company code (entity_codes.json) and remove duplicates with the same code")
+    parser.add_argument("--entity_codes", default=DEFAULT_ENTITY_CODES_PATH, help="json with the ENTITY and CODE of every Volvo Cars entity")
+    parser.add_argument("--entity_min_score", type=float, default=0.75, help="minimum similarity (0-1) between an extracted entity and an entity of entity_codes.json")
+    parser.add_argument("--results_store", choices=["files", "parquet", "jsonl"], default="files", help="files: log.txt and extracted_entities.txt in a folder per ticket. parquet/jsonl: compressed shards in the results folder of the run, see utils/results_store.py")
+    parser.add_argument("--shard_size", type=int, default=1000, help="tickets per shard of the results store")
+    parser.add_argument("--no_attachments", action="store_true", help="delete the downloaded attachments once a ticket is saved (with --results_store parquet/jsonl no folder is left per ticket)")
+    parser.add_argument("--metrics_format", choices=["jsonl", "csv"], default="jsonl", help="format of the file where the metrics and stage timings of every ticket are streamed as soon as it is completed")
+    parser.add_argument("--batch", action="store_true", help="offline mode for backfills: submit all tickets to the Azure OpenAI Batch API and wait for the results (AZURE_OPENAI_BATCH_DEPLOYMENT)")
+    parser.add_argument("--batch_poll_interval", type=float, default=60, help="seconds between checks of the status of the batch")
+    parser.add_argument("--rpm", type=int, default=None, help="requests-per-minute quota of the Azure Open AI deployment")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens-per-minute quota of the Azure Open AI deployment")
+    parser.add_argument("--deployments", default=None, help="JSON file with several Azure OpenAI deployments (endpoint, deployment, rpm, tpm) used as one, see utils/deployment_pool.py. --rpm and --tpm are ignored")
+    parser.add_argument("--page_dedup", action="store_true", help="skip the OCR of pages/images that look the same as one seen before in the ticket and send repeated pages to the LLM only once")
+    parser.add_argument("--page_dedup_similarity", type=float, default=0.9, help="minimum share (0-1) of word sequences in common for a page to be a repeat of a previous one")
 
 
     args = parser.parse_args()
-    extract_entities(start_date = args.start_date, end_date = args.end_date, selected_regions = args.regions, path_to_env_var = args.path_to_env_var, path_to_system_prompt = args.path_to_system_prompt)
+    if args.resume is None and not args.incremental and (args.start_date is None or args.end_date is None):
+        parser.error("start_date and end_date are required, unless --resume or --incremental are used")
+    extract_entities(start_date = args.start_date, end_date = args.end_date, selected_regions = args.regions, path_to_env_var = args.path_to_env_var, path_to_system_prompt = args.path_to_system_prompt,
+                     pipeline = args.pipeline, fetch_workers = args.fetch_workers, convert_workers = args.convert_workers, llm_workers = args.llm_workers,
+                     requests_per_minute = args.rpm, tokens_per_minute = args.tpm, ocr_workers = args.ocr_workers, use_text_layer = not args.no_text_layer,
+                     ocr_mode = args.ocr_mode, min_ocr_confidence = args.ocr_min_confidence,
+                     cache_dir = args.cache_dir, cache_max_mb = args.cache_max_mb,
+                     resume_dir = args.resume, incremental = args.incremental, watermark_path = args.watermark_file,
+                     download_workers = args.download_workers, max_attachment_mb = args.max_attachment_mb, max_input_tokens = args.max_input_tokens,
+                     batch = args.batch, batch_poll_interval = args.batch_poll_interval,
+                     llm_cache = args.llm_cache, llm_cache_ttl_days = args.llm_cache_ttl_days, llm_cache_max_mb = args.llm_cache_max_mb,
+                     structured_output = args.structured_output, max_output_tokens_limit = args.max_output_tokens_limit,
+                     gate_classifier_path = args.gate_classifier, gate_threshold = args.gate_threshold, gate_subcategories = args.gate_subcategories,
+                     relevance_filter = args.relevance_filter, relevance_context_lines = args.relevance_context_lines, relevance_max_reduction = args.relevance_max_reduction, relevance_min_tokens = args.relevance_min_tokens,
+                     resolve_entities = args.resolve_entities, entity_codes_path = args.entity_codes, entity_min_score = args.entity_min_score,
+                     metrics_format = args.metrics_format, results_store = args.results_store, shard_size = args.shard_size, keep_attachments = not args.no_attachments,
+                     tabular_max_rows = args.tabular_max_rows, tabular_max_cols = args.tabular_max_cols,
+                     ocr_dpi = args.ocr_dpi, max_pdf_pages = args.max_pdf_pages, max_archive_depth = args.max_archive_depth,
+                     deployments_path = args.deployments, page_dedup = args.page_dedup, page_dedup_similarity = args.page_dedup_similarity)
 
 # example how to run: ./.chatbot_env/Scripts/python.exe entity_extraction/extract_entities.py "2025-05-01" "2025-06-01"
-# example how to run if env activated: python entity_extraction/extract_entities.py "2025-05-30" "2025-06-01" --regions AMERICAS EMEA
\ No newline at end of file
+# example how to run if env activated: python entity_extraction/extract_entities.py "2025-05-30" "2025-06-01" --regions AMERICAS EMEA
+# example how to run with concurrency: python entity_extraction/extract_entities.py "2025-05-30" "2025-06-01" --pipeline --llm_workers 8 --rpm 300 --tpm 150000
+# example daily incremental run (e.g. from cron): python entity_extraction/extract_entities.py --incremental --pipeline
+# example how to resume an interrupted run: python entity_extraction/extract_entities.py --resume data/outputs/entity_extraction/20250706_143022_run
\ No newline at end of file
@@ -0,0 +1,127 @@
+import sys
+from pathlib import Path
+# Set sys.path to include the project root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import argparse
+import glob
+import pickle
+import pandas as pd
+
+# columns of the metrics of classify_tickets.py that can be used as label
+LABEL_COLUMNS = {"assigned": "assigned_subcategory", "selected": "selected_subcategory"}
+
+def ticket_text(ticket: dict) -> str:
+    """Text of a SNOW ticket used by the classifiers, same as SnowTicket.description."""
+    return ticket['short_description'] + "\n" + ticket['description'] + "\n\n"
+
+
+class LocalSubcategoryClassifier:
+    """
+    CPU-only classifier (TF-IDF of words and character n-grams + logistic regression) trained on the descriptions of tickets
+    classified in previous runs. Used in front of the LLM: only tickets predicted with a confidence below the threshold are sent to it.
+    scikit-learn is only imported when a classifier is trained.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.labels = list(model.classes_)
+
+    @classmethod
+    def train(cls, descriptions: list, labels: list) -> "LocalSubcategoryClassifier":
+        from sklearn.pipeline import make_pipeline, make_union
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.linear_model import LogisticRegression
+        model = make_pipeline(
+            make_union(
+                TfidfVectorizer(lowercase=True, ngram_range=(1, 2), min_df=2, sublinear_tf=True),
+                # character n-grams cope with typos and the different languages of the suppliers
+                TfidfVectorizer(lowercase=True, analyzer="char_wb", ngram_range=(3, 5), min_df=2, sublinear_tf=True, max_features=200000),
+            ),
+            LogisticRegression(max_iter=1000, C=4.0, class_weight="balanced"),
+        )
+        model.fit(descriptions, labels)
+        return cls(model)
+
+    def predict(self, descriptions: list) -> list:
+        """Returns (subcategory, confidence) for every description, the confidence being the probability of the predicted subcategory."""
+        if not descriptions:
+            return []
+        probabilities = self.model.predict_proba(descriptions)
+        return [(str(self.labels[row.argmax()]), float(row.max())) for row in probabilities]
+
+    def save(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as file:
+            pickle.dump(self.model, file)
+
+    @classmethod
+    def load(cls, path: str) -> "LocalSubcategoryClassifier":
+        with open(path, "rb") as file:
+            return cls(pickle.load(file))
+
+
+def load_training_data(metrics_pattern: str, label: str = "assigned") -> pd.DataFrame:
+    """
+    Descriptions and subcategories of the tickets in the metrics_*.xlsx of previous classification runs.
+    label: "assigned" (subcategory of the LLM), "selected" (subcategory selected in SNOW) or "agreed" (tickets where both are the same).
+    The last run wins for tickets classified more than once.
+    """
+    paths = sorted(glob.glob(metrics_pattern))
+    if not paths:
+        raise FileNotFoundError(f"No metrics files found for {metrics_pattern}")
+    data = pd.concat([pd.read_excel(path) for path in paths], ignore_index=True)
+    data = data.dropna(subset=["description", "assigned_subcategory", "selected_subcategory"])
+    if "classified_by" in data.columns:
+        # don't learn from the predictions of the local classifier itself
+        data = data[data["classified_by"] != "local"]
+    if label == "agreed":
+        data = data[data["assigned_subcategory"] == data["selected_subcategory"]]
+        data = data.assign(label=data["assigned_subcategory"])
+    else:
+        data = data.assign(label=data[LABEL_COLUMNS[label]])
+    data = data.drop_duplicates(subset="ticket", keep="last")
+    return data[["ticket", "description", "label"]].reset_index(drop=True)
+
+def threshold_report(classifier: LocalSubcategoryClassifier, descriptions: list, labels: list, thresholds: list) -> pd.DataFrame:
+    """Share of tickets answered locally (coverage) and accuracy of those answers for every confidence threshold."""
+    predictions = classifier.predict(descriptions)
+    rows = []
+    for threshold in thresholds:
+        answered = [(prediction, label) for (prediction, confidence), label in zip(predictions, labels) if confidence >= threshold]
+        correct = sum(prediction == label for prediction, label in answered)
+        rows.append({"threshold": threshold, "coverage": len(answered) / max(len(labels), 1), "accuracy": correct / len(answered) if answered else None})
+    return pd.DataFrame(rows)
+
+def split_training_data(data: pd.DataFrame, test_size: float) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Train/test split stratified by label. Subcategories with a single ticket can't be stratified: they only go to the training set.
+    Falls back to a random split if the test set is too small to hold every subcategory.
+    """
+    from sklearn.model_selection import train_test_split
+    counts = data["label"].value_counts()
+    rare = data["label"].isin(counts[counts < 2].index)
+    try:
+        train, test = train_test_split(data[~rare], test_size=test_size, random_state=0, stratify=data.loc[~rare, "label"])
+    except ValueError:
+        train, test = train_test_split(data[~rare], test_size=test_size, random_state=0)
+    return pd.concat([train, data[rare]]), test
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the local subcategory classifier on the metrics of previous classification runs.")
+    parser.add_argument("--metrics", default="data/outputs/ticket_classification/*/metrics_*.xlsx", help="glob of the metrics files used for training")
+    parser.add_argument("--label", choices=["assigned", "selected", "agreed"], default="assigned", help="assigned: subcategory of the LLM. selected: subcategory selected in SNOW. agreed: only tickets where both are the same")
+    parser.add_argument("--output", default="data/models/local_classifier.pkl", help="path where the trained classifier is saved")
+    parser.add_argument("--test_size", type=float, default=0.2, help="share of the tickets kept apart to report coverage and accuracy per threshold")
+    args = parser.parse_args()
+
+    data = load_training_data(args.metrics, args.label)
+    print(f"{len(data)} tickets for training:\n{data['label'].value_counts().to_string()}\n")
+    train, test = split_training_data(data, args.test_size)
+    report = threshold_report(LocalSubcategoryClassifier.train(train["description"].tolist(), train["label"].tolist()),
+                              test["description"].tolist(), test["label"].tolist(), [0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99])
+    print(f"Held-out tickets answered locally (coverage) and accuracy per threshold:\n{report.to_string(index=False)}\n")
+    # final model trained on all the tickets
+    LocalSubcategoryClassifier.train(data["description"].tolist(), data["label"].tolist()).save(args.output)
+    print(f"Classifier saved in {args.output}")
+
+# example how to train: python entity_extraction/local_classifier.py --label agreed
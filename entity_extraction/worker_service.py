@@ -0,0 +1,404 @@
+import sys
+from pathlib import Path
+# Set sys.path to include the project root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from utils.snowAPI import iter_tickets, get_ticket
+from utils.processing import create_ocr_pool, preload_ocr_backends
+from utils.converters import CONVERTERS
+from utils.load_env_vars import load_env_vars
+from utils.rate_limiter import RateLimiter
+from utils.deployment_pool import DeploymentPool
+from utils.cache import ConversionCache, ResponseCache
+from utils.metrics_sink import MetricsSink, percentile
+from utils.results_store import ResultsStore
+from utils.run_state import RunManifest, load_watermark, save_watermark, watermark_before_failures
+from utils.stats import append_stat
+from entity_extraction.core import SnowTicket, EntityExtractor
+from entity_extraction.extract_entities import TIMING_STATS, empty_metrics, build_ticket_options, prepare_ticket, run_entity_extraction, save_ticket_results, select_tickets
+import argparse
+import itertools
+import json
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# tickets with a lower priority number are processed first. Tickets found by the poller come after the ones enqueued by hand
+ENQUEUE_PRIORITY = 0
+POLL_PRIORITY = 10
+# completed tickets used for the latency percentiles of /stats, and failures listed
+LATENCY_WINDOW = 1000
+FAILURES_WINDOW = 20
+# a failed ticket (exception or LLM error) is queued again up to MAX_ATTEMPTS times, RETRY_SECONDS x attempt later
+MAX_ATTEMPTS = 3
+RETRY_SECONDS = 30
+
+
+class WorkerService:
+    """
+    Resident entity extraction: a single process keeping the SNOW connection pool, the Azure OpenAI client, the OCR process pool,
+    the caches and the converter backends warm between tickets, so a new ticket is processed in seconds instead of waiting for the next run.
+    Tickets come from a priority queue fed by a poller (tickets created in SNOW after the watermark, every poll_interval seconds)
+    and by the HTTP endpoint (POST /enqueue). workers threads take the ticket with the lowest priority number and save its results
+    in results_path like a run of extract_entities. The folder is reused when the service is restarted: completed tickets are not polled again.
+    """
+    def __init__(self, results_path: str, entity_extractor: EntityExtractor, ticket_options: dict, workers: int = 4, poll_interval: float = 60, selected_regions: list = None,
+                 start_date: str = None, results_store: str = "files", shard_size: int = 1000, keep_attachments: bool = True, metrics_format: str = "jsonl"):
+        self.results_path = results_path
+        self.entity_extractor = entity_extractor
+        self.ticket_options = ticket_options
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.selected_regions = selected_regions
+        self.start_date = start_date or datetime.now().strftime("%Y-%m-%d")
+        self.keep_attachments = keep_attachments
+        os.makedirs(results_path, exist_ok=True)
+        if os.path.exists(os.path.join(results_path, RunManifest.FILE_NAME)):
+            self.manifest = RunManifest(results_path)
+        else:
+            self.manifest = RunManifest(results_path, params={"mode": "service", "regions": selected_regions, "start_date": self.start_date})
+        # newest ticket found by the poller. The file is only moved forward when all the polled tickets are done, and never past a
+        # polled ticket that failed MAX_ATTEMPTS times, so the poller finds it again after a restart
+        self.watermark_path = os.path.join(results_path, "watermark.json")
+        self.watermark = load_watermark(self.watermark_path)
+        self.saved_watermark = self.watermark
+        self.metrics_sink = MetricsSink(results_path, "service", ["time_snow_fetch", "time_queue_wait"] + TIMING_STATS, format=metrics_format)
+        self.store = ResultsStore(results_path, format=results_store, shard_size=shard_size) if results_store != "files" else None
+        # (priority, sequence, enqueued at, sys_id, ticket or None if it has to be fetched)
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        # sys_ids queued or in progress, and the ones of them found by the poller
+        self.known = set()
+        self.pending_polled = set()
+        # sys_created_on of the polled tickets after the saved watermark, and of the ones that failed every attempt
+        self.polled_created_on = set()
+        self.failed_polled = {}
+        # failed attempts of the tickets queued again
+        self.attempts = {}
+        self.counters = {"enqueued": 0, "completed": 0, "llm_errors": 0, "failed": 0, "polls": 0, "poll_errors": 0}
+        self.in_progress = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.failures = deque(maxlen=FAILURES_WINDOW)
+        self.last_poll = None
+        self.last_poll_error = None
+        self.started_at = time.time()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.server = None
+
+    def enqueue(self, sys_id: str, priority: float = ENQUEUE_PRIORITY, ticket: dict = None) -> bool:
+        """Adds a ticket to the queue (ticket is given by the poller, otherwise it is fetched by sys_id). False if it is already queued or in progress."""
+        with self.lock:
+            if sys_id in self.known:
+                return False
+            self.known.add(sys_id)
+            if ticket is not None:
+                self.pending_polled.add(sys_id)
+                self.polled_created_on.add(ticket["sys_created_on"])
+            self.counters["enqueued"] += 1
+        self.queue.put((priority, next(self.sequence), time.time(), sys_id, ticket))
+        return True
+
+    def poll(self) -> int:
+        """Enqueues the tickets created after the watermark that are not completed, queued or in progress. Returns how many were enqueued."""
+        start_date = self.watermark[:10] if self.watermark else self.start_date
+        end_date = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+        poll_stats = {}
+        run_state = {"last_sys_created_on": self.watermark}
+        enqueued = 0
+        for ticket in select_tickets(iter_tickets(start_date, end_date, stats=poll_stats), self.watermark, self.selected_regions, self.manifest, run_state):
+            enqueued += self.enqueue(ticket["sys_id"], POLL_PRIORITY, ticket)
+        with self.lock:
+            self.watermark = run_state["last_sys_created_on"]
+            self.metrics_sink.add_events(poll_stats)
+        return enqueued
+
+    def poll_forever(self):
+        while not self.stopping.is_set():
+            try:
+                enqueued = self.poll()
+                self.last_poll, self.last_poll_error = datetime.now().isoformat(timespec="seconds"), None
+                if enqueued:
+                    print(f"{enqueued} new tickets in SNOW, {self.queue.qsize()} tickets in the queue")
+            except Exception as e:
+                # SNOW not reachable: try again at the next interval
+                self.last_poll_error = str(e)
+                print(f"ERROR polling SNOW: {e}")
+                with self.lock:
+                    self.counters["poll_errors"] += 1
+            with self.lock:
+                self.counters["polls"] += 1
+            self.stopping.wait(self.poll_interval)
+
+    def work_forever(self):
+        while not self.stopping.is_set():
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            self.process(item)
+
+    def process(self, item: tuple):
+        """Downloads, converts and extracts the entities of a queued ticket, and saves its results and metrics."""
+        priority, _, enqueued_at, sys_id, ticket = item
+        with self.lock:
+            self.in_progress += 1
+        try:
+            if ticket is None:
+                ticket = get_ticket(sys_id)
+            snow_ticket = SnowTicket(ticket, self.results_path, **self.ticket_options)
+            append_stat(snow_ticket.stats, "time_queue_wait", round(time.time() - enqueued_at, 4))
+            print(f"Processing ticket number:{snow_ticket.ticket['number']} (priority {priority}), from selected entity: {snow_ticket.vcc_entity}")
+            time_to_llm_input = prepare_ticket(snow_ticket)
+            result = run_entity_extraction(snow_ticket, self.entity_extractor, time_to_llm_input)
+            metrics = empty_metrics()
+            with self.lock:
+                save_ticket_results(snow_ticket, result, metrics, results_store=self.store, keep_attachments=self.keep_attachments)
+                row = {key: values[-1] for key, values in metrics.items()}
+                if result["error"]:
+                    self.manifest.mark_failed(snow_ticket.ticket['number'], row)
+                else:
+                    self.manifest.mark_completed(snow_ticket.ticket['number'], row)
+                latency = time.time() - enqueued_at
+                self.metrics_sink.write({**row, "priority": priority, "latency": round(latency, 3), **{key: snow_ticket.stats.get(key, []) for key in ["time_queue_wait"] + TIMING_STATS}})
+                self.latencies.append(latency)
+                self.counters["completed"] += 1
+                self.counters["llm_errors"] += bool(result["error"])
+            print(f"Ticket {snow_ticket.ticket['number']} completed {latency:.1f} seconds after it was queued")
+            error = (result["log"].strip() or "error in the LLM output") if result["error"] else None
+        except Exception as e:
+            error = str(e)
+        retried = False
+        try:
+            if error is not None:
+                print(f"ERROR processing ticket {sys_id}: {error}")
+                retried = self.retry(item, error)
+        finally:
+            with self.lock:
+                self.in_progress -= 1
+                if not retried:
+                    self.finish(sys_id, ticket, failed=error is not None)
+            self.queue.task_done()
+
+    def retry(self, item: tuple, error: str) -> bool:
+        """Queues a failed ticket again RETRY_SECONDS x attempt later, unless it already failed MAX_ATTEMPTS times. Returns True if it was queued."""
+        priority, _, enqueued_at, sys_id, ticket = item
+        with self.lock:
+            self.counters["failed"] += 1
+            self.failures.append({"sys_id": sys_id, "error": error, "at": datetime.now().isoformat(timespec="seconds")})
+            attempts = self.attempts[sys_id] = self.attempts.get(sys_id, 0) + 1
+        if attempts >= MAX_ATTEMPTS or self.stopping.is_set():
+            print(f"Ticket {sys_id} failed {attempts} times, not retried (it can be enqueued again through the HTTP endpoint)")
+            return False
+        timer = threading.Timer(RETRY_SECONDS * attempts, lambda: self.queue.put((priority, next(self.sequence), time.time(), sys_id, ticket)))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def finish(self, sys_id: str, ticket: dict | None, failed: bool):
+        """Forgets a ticket that is done (completed or failed every attempt) and saves the watermark once all the polled tickets are done. Called with the lock."""
+        self.known.discard(sys_id)
+        self.attempts.pop(sys_id, None)
+        if not failed:
+            # e.g. a polled ticket that failed, enqueued again by hand
+            self.failed_polled.pop(sys_id, None)
+        if sys_id not in self.pending_polled:
+            return
+        self.pending_polled.discard(sys_id)
+        if failed:
+            self.failed_polled[sys_id] = ticket["sys_created_on"]
+        if self.pending_polled or self.watermark is None:
+            return
+        # a restart starts from the newest ticket polled, or before the oldest polled ticket that failed
+        watermark = watermark_before_failures(self.polled_created_on, self.failed_polled.values(), self.saved_watermark)
+        if watermark is not None and watermark != self.saved_watermark:
+            save_watermark(self.watermark_path, watermark)
+            self.saved_watermark = watermark
+            self.polled_created_on = {created_on for created_on in self.polled_created_on if created_on > watermark}
+
+    def health(self) -> dict:
+        """Liveness of the workers and the poller, queue depth and tickets in progress."""
+        workers_alive = sum(thread.is_alive() for thread in self.threads if thread.name.startswith("worker"))
+        healthy = workers_alive == self.workers and self.last_poll_error is None and not self.stopping.is_set()
+        return {"status": "ok" if healthy else "degraded", "uptime_seconds": round(time.time() - self.started_at, 1), "queue_depth": self.queue.qsize(),
+                "in_progress": self.in_progress, "workers_alive": workers_alive, "last_poll": self.last_poll, "last_poll_error": self.last_poll_error}
+
+    def stats(self) -> dict:
+        """Health, counters, latency from enqueue to saved results (last LATENCY_WINDOW tickets), stage timings and last failures."""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {**self.health(), **self.counters, "watermark": self.watermark, "failures": list(self.failures), "stage_timings": self.metrics_sink.summary(),
+                     "deployments": self.entity_extractor.deployment_pool.summary()}
+        stats["latency_seconds"] = {"p50": round(percentile(latencies, 50), 3), "p95": round(percentile(latencies, 95), 3), "max": round(latencies[-1], 3) if latencies else 0.0}
+        return stats
+
+    def start(self, host: str = "127.0.0.1", port: int = 8765):
+        """Starts the HTTP endpoint, the workers and (if poll_interval > 0) the poller in background threads."""
+        self.server = ThreadingHTTPServer((host, port), _ServiceHandler)
+        self.server.daemon_threads = True
+        self.server.service = self
+        self.threads = [threading.Thread(target=self.work_forever, name=f"worker-{n}") for n in range(self.workers)]
+        if self.poll_interval > 0:
+            self.threads.append(threading.Thread(target=self.poll_forever, name="poller", daemon=True))
+        self.threads.append(threading.Thread(target=self.server.serve_forever, name="http", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stops taking tickets, waits for the tickets in progress and writes the stage timings. Queued tickets are dropped (the poller finds them again)."""
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            if thread.name.startswith("worker"):
+                thread.join()
+        if self.store is not None:
+            self.store.close()
+        self.metrics_sink.save_summary()
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.split("?")[0]
+        if path == "/health":
+            health = service.health()
+            return self._send_json(200 if health["status"] == "ok" else 503, health)
+        if path == "/stats":
+            return self._send_json(200, service.stats())
+        return self._send_json(404, {"error": f"{path} not found. Use GET /health, GET /stats or POST /enqueue"})
+
+    def do_POST(self):
+        service = self.server.service
+        path = self.path.split("?")[0]
+        if path != "/enqueue":
+            return self._send_json(404, {"error": f"{path} not found. Use GET /health, GET /stats or POST /enqueue"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError as e:
+            return self._send_json(400, {"error": f"invalid JSON: {e}"})
+        sys_ids = request.get("sys_ids") or ([request["sys_id"]] if "sys_id" in request else [])
+        priority = request.get("priority", ENQUEUE_PRIORITY)
+        if not sys_ids or not all(isinstance(sys_id, str) for sys_id in sys_ids) or not isinstance(priority, (int, float)):
+            return self._send_json(400, {"error": 'expected {"sys_ids": ["<sys_id>", ...], "priority": 0} (lower priority = processed first)'})
+        queued = [sys_id for sys_id in sys_ids if service.enqueue(sys_id, priority)]
+        return self._send_json(202, {"queued": queued, "already_queued": [sys_id for sys_id in sys_ids if sys_id not in queued], "queue_depth": service.queue.qsize()})
+
+
+def run_worker_service(path_to_env_var, path_to_system_prompt, host="127.0.0.1", port=8765, workers=4, poll_interval=60, selected_regions=None, start_date=None, results_dir=None,
+                       requests_per_minute=None, tokens_per_minute=None, ocr_workers=0, use_text_layer=True, ocr_mode="full", min_ocr_confidence=60.0, ocr_dpi=200, max_pdf_pages=None,
+                       cache_dir=None, cache_max_mb=1024, llm_cache="use", download_workers=4, max_attachment_mb=250, max_input_tokens=65536, structured_output=False,
+                       relevance_filter=False, resolve_entities=False, results_store="files", shard_size=1000, keep_attachments=True, metrics_format="jsonl", deployments_path=None,
+                       page_dedup=False):
+    start_time = time.time()
+    load_env_vars(path_to_env_var)
+    with open(path_to_system_prompt, "r", encoding="utf-8") as file:
+        system_prompt = file.read()
+    if results_dir is None:
+        results_dir = os.path.join(os.getcwd(), "data", "outputs", "entity_extraction", "service")
+    rate_limiter = None
+    if requests_per_minute is not None or tokens_per_minute is not None:
+        rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+    response_cache = ResponseCache(cache_dir, refresh=llm_cache == "refresh") if cache_dir is not None and llm_cache != "off" else None
+    # the Azure OpenAI client, the OCR processes and the converter backends are created once and kept warm for all the tickets
+    deployment_pool = DeploymentPool.from_file(deployments_path) if deployments_path is not None else None
+    entity_extractor = EntityExtractor(system_prompt, rate_limiter=rate_limiter, max_input_tokens=max_input_tokens, response_cache=response_cache, structured_output=structured_output,
+                                       deployment_pool=deployment_pool)
+    ocr_pool = create_ocr_pool(ocr_workers) if ocr_workers > 0 else None
+    if ocr_pool is not None:
+        list(ocr_pool.map(preload_ocr_backends, range(ocr_workers)))
+    CONVERTERS.load_all()
+    conversion_cache = ConversionCache(cache_dir, max_size_bytes=cache_max_mb * 1024 * 1024) if cache_dir is not None else None
+    download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="download") if download_workers > 0 else None
+    ticket_options = build_ticket_options(entity_extractor.model_name, ocr_pool, conversion_cache, download_pool, use_text_layer=use_text_layer, ocr_mode=ocr_mode,
+                                          min_ocr_confidence=min_ocr_confidence, max_attachment_mb=max_attachment_mb, relevance_filter=relevance_filter,
+                                          resolve_entities=resolve_entities, ocr_dpi=ocr_dpi, max_pdf_pages=max_pdf_pages, page_dedup=page_dedup)
+    service = WorkerService(results_dir, entity_extractor, ticket_options, workers=workers, poll_interval=poll_interval, selected_regions=selected_regions, start_date=start_date,
+                            results_store=results_store, shard_size=shard_size, keep_attachments=keep_attachments, metrics_format=metrics_format)
+    service.start(host, port)
+    print(f"Worker service ready in {time.time() - start_time:.1f} seconds on http://{host}:{port} (results in {results_dir})")
+    # stop on Ctrl+C or SIGTERM, after the tickets in progress
+    signal.signal(signal.SIGTERM, lambda signum, frame: service.stopping.set())
+    try:
+        while not service.stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    print("Stopping: waiting for the tickets in progress")
+    service.stop()
+    for pool in [ocr_pool, download_pool]:
+        if pool is not None:
+            pool.shutdown()
+    for cache in [conversion_cache, response_cache]:
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident entity extraction service: polls SNOW for new tickets and accepts tickets by sys_id over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the HTTP endpoint (local only by default)")
+    parser.add_argument("--port", type=int, default=8765, help="port of the HTTP endpoint")
+    parser.add_argument("--workers", type=int, default=4, help="number of tickets processed at the same time")
+    parser.add_argument("--poll_interval", type=float, default=60, help="seconds between checks for new tickets in SNOW (0 = only tickets enqueued over HTTP)")
+    parser.add_argument("--start_date", default=None, help="date (YYYY-MM-DD) of the first poll when the results folder has no watermark yet (default: today)")
+    parser.add_argument("--regions", nargs='+', default=None, help="Space separated regions of the polled tickets. Pick between APAC, EMEA and AMERICAS")
+    parser.add_argument("--results_dir", default=None, help="folder of the results, reused across restarts (default: data/outputs/entity_extraction/service)")
+    parser.add_argument("--path_to_env_var", default="data/inputs/secrets/secrets.txt", help="path to file with env variables for Azure Open AI")
+    parser.add_argument("--path_to_system_prompt", default="data/inputs/system_prompts/default_system_prompt_v6.txt", help="path to file for the system prompt of the entity extractor")
+    parser.add_argument("--rpm", type=int, default=None, help="requests-per-minute quota of the Azure Open AI deployment")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens-per-minute quota of the Azure Open AI deployment")
+    parser.add_argument("--deployments", default=None, help="JSON file with several Azure OpenAI deployments (endpoint, deployment, rpm, tpm) used as one, see utils/deployment_pool.py. --rpm and --tpm are ignored")
+    parser.add_argument("--ocr_workers", type=int, default=0, help="number of processes to OCR PDF pages in parallel, started with the service")
+    parser.add_argument("--no_text_layer", action="store_true", help="OCR every PDF page, even if the PDF has embedded text")
+    parser.add_argument("--ocr_mode", choices=["full", "fast"], default="full", help="full: OSD + two OCR passes per image. fast: one OCR pass, re-run only if confidence is low or the language changes")
+    parser.add_argument("--ocr_min_confidence", type=float, default=60.0, help="mean word confidence (0-100) below which the fast OCR mode re-runs OCR")
+    parser.add_argument("--ocr_dpi", type=lambda value: value if value == "adaptive" else int(value), default=200, help="DPI of the PDF pages rasterized for OCR, or adaptive")
+    parser.add_argument("--max_pdf_pages", type=int, default=None, help="only the first pages of every PDF attachment are converted to text (default: all)")
+    parser.add_argument("--cache_dir", default=None, help="folder of the conversion and LLM response caches (disabled if not given). Example: data/cache")
+    parser.add_argument("--cache_max_mb", type=int, default=1024, help="maximum size of the conversion cache in MB")
+    parser.add_argument("--llm_cache", choices=["use", "refresh", "off"], default="use", help="cache of LLM responses in --cache_dir")
+    parser.add_argument("--download_workers", type=int, default=4, help="number of attachments downloaded at the same time, shared by all tickets")
+    parser.add_argument("--max_attachment_mb", type=int, default=250, help="attachments larger than this are not downloaded")
+    parser.add_argument("--max_input_tokens", type=int, default=65536, help="token budget of a request to the LLM. Longer tickets are split in chunks")
+    parser.add_argument("--structured_output", action="store_true", help="request JSON-schema-constrained output as a stream")
+    parser.add_argument("--relevance_filter", action="store_true", help="send to the LLM only the regions of the attachments around invoice/PO/delivery note/vendor keywords")
+    parser.add_argument("--page_dedup", action="store_true", help="skip the OCR of repeated pages/images of a ticket and send repeated pages to the LLM only once")
+    parser.add_argument("--resolve_entities", action="store_true", help="resolve the entity of every invoice to its company code (entity_codes.json)")
+    parser.add_argument("--results_store", choices=["files", "parquet", "jsonl"], default="files", help="files: a folder per ticket. parquet/jsonl: compressed shards, see utils/results_store.py")
+    parser.add_argument("--shard_size", type=int, default=1000, help="tickets per shard of the results store")
+    parser.add_argument("--no_attachments", action="store_true", help="delete the downloaded attachments once a ticket is saved")
+    parser.add_argument("--metrics_format", choices=["jsonl", "csv"], default="jsonl", help="format of the file where the metrics of every ticket are streamed")
+
+    args = parser.parse_args()
+    run_worker_service(path_to_env_var = args.path_to_env_var, path_to_system_prompt = args.path_to_system_prompt, host = args.host, port = args.port,
+                       workers = args.workers, poll_interval = args.poll_interval, selected_regions = args.regions, start_date = args.start_date, results_dir = args.results_dir,
+                       requests_per_minute = args.rpm, tokens_per_minute = args.tpm, ocr_workers = args.ocr_workers, use_text_layer = not args.no_text_layer,
+                       ocr_mode = args.ocr_mode, min_ocr_confidence = args.ocr_min_confidence, ocr_dpi = args.ocr_dpi, max_pdf_pages = args.max_pdf_pages,
+                       cache_dir = args.cache_dir, cache_max_mb = args.cache_max_mb, llm_cache = args.llm_cache,
+                       download_workers = args.download_workers, max_attachment_mb = args.max_attachment_mb, max_input_tokens = args.max_input_tokens,
+                       structured_output = args.structured_output, relevance_filter = args.relevance_filter, resolve_entities = args.resolve_entities,
+                       results_store = args.results_store, shard_size = args.shard_size, keep_attachments = not args.no_attachments, metrics_format = args.metrics_format,
+                       deployments_path = args.deployments, page_dedup = args.page_dedup)
+
+# example how to run: python entity_extraction/worker_service.py --workers 4 --ocr_workers 4 --cache_dir data/cache --rpm 300 --tpm 150000
+# example how to enqueue a ticket: curl -X POST localhost:8765/enqueue -d '{"sys_ids": ["<sys_id>"], "priority": 0}'
@@ -0,0 +1,75 @@
+import json
+import time
+
+# statuses of a batch that is not finished yet
+PENDING_STATUSES = ["validating", "in_progress", "finalizing", "cancelling"]
+
+def build_batch_request(custom_id: str, model: str, messages: list, max_output_tokens: int, temperature: float = 1.0, top_p: float = 0.9, response_format: dict = None) -> dict:
+    """One line of the batch input file: a chat completion request identified by custom_id (e.g. the ticket number)."""
+    request = {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/chat/completions",
+        "body": {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_output_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+        },
+    }
+    if response_format is not None:
+        request["body"]["response_format"] = response_format
+    return request
+
+def write_batch_file(path: str, requests: list):
+    with open(path, "w", encoding="utf-8") as file:
+        for request in requests:
+            file.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+def submit_batch(client, path: str) -> str:
+    """Uploads the batch input file and creates the batch job. Returns the batch id."""
+    with open(path, "rb") as file:
+        input_file = client.files.create(file=file, purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/chat/completions", completion_window="24h")
+    print(f"Submitted batch {batch.id} with input file {input_file.id}")
+    return batch.id
+
+def wait_for_batch(client, batch_id: str, poll_interval: float = 60):
+    """Polls the batch job until it is completed, failed, expired or cancelled. Returns the final batch object."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status not in PENDING_STATUSES:
+            print(f"Batch {batch_id} {batch.status}")
+            return batch
+        counts = batch.request_counts
+        progress = f"{counts.completed + counts.failed}/{counts.total} requests" if counts is not None else ""
+        print(f"Batch {batch_id} {batch.status} {progress}")
+        time.sleep(poll_interval)
+
+def read_batch_results(client, batch) -> dict:
+    """
+    Downloads the output (and error) files of a finished batch.
+    Returns {custom_id: (content, input_tokens, output_tokens, error)}, error being None for successful requests.
+    """
+    results = {}
+    for file_id in [batch.output_file_id, batch.error_file_id]:
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            body = response.get("body") or {}
+            if entry.get("error") or response.get("status_code") != 200:
+                error = entry.get("error") or body.get("error") or f"status code {response.get('status_code')}"
+                results[entry["custom_id"]] = ("", 0, 0, str(error))
+                continue
+            usage = body.get("usage") or {}
+            choice = (body.get("choices") or [{}])[0]
+            content = ((choice.get("message") or {}).get("content") or "").strip()
+            # no text (e.g. content filtered): the request was billed but the ticket has no output
+            error = None if content else f"empty output (finish reason {choice.get('finish_reason')})"
+            results[entry["custom_id"]] = (content, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), error)
+    return results
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from utils.stats import add_stat
+
+
+class DiskCache:
+    """
+    Key-value store of texts in a SQLite file, shared between runs.
+    When the stored values exceed max_size_bytes, the least recently used entries are evicted.
+    Entries older than ttl_seconds (if given) are treated as missing and deleted.
+    """
+    def __init__(self, path: str, max_size_bytes: int = None, ttl_seconds: float = None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, "
+                "compute_seconds REAL, created REAL, last_access REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON cache (last_access)")
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        """Returns (value, seconds it took to compute it) or None if the key is not cached."""
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value, compute_seconds, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl_seconds is not None and row[2] < time.time() - self.ttl_seconds:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0], row[1]
+
+    def set(self, key: str, value: str, compute_seconds: float = 0.0):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, compute_seconds, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), compute_seconds, now, now),
+            )
+            self._evict()
+
+    def delete(self, key: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _evict(self):
+        # remove expired entries, then least recently used entries until the cache fits in max_size_bytes
+        if self.ttl_seconds is not None:
+            self.conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl_seconds,))
+        if self.max_size_bytes is None:
+            return
+        total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        to_delete = []
+        for key, size in self.conn.execute("SELECT key, size FROM cache ORDER BY last_access ASC"):
+            if total_size <= self.max_size_bytes:
+                break
+            to_delete.append((key,))
+            total_size -= size
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", to_delete)
+
+    def close(self):
+        self.conn.close()
+
+
+def hash_file(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of the content of a file, read in chunks."""
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# conversions that increased one of these stats are not cached: a page failed (it may work next time), or a page took the text of
+# a page of another file (page deduplication), which must not be stored under the key of this file
+UNCACHED_STATS = ["pdf_pages_error", "dedup_text_borrowed"]
+
+
+class ConversionCache(DiskCache):
+    """
+    Cache of attachment-to-text conversions, keyed by the content of the file, the converter (name and version)
+    and the settings used (e.g. OCR mode), so the same attachment is never converted twice with the same settings.
+    """
+    def __init__(self, cache_dir: str, max_size_bytes: int = None):
+        super().__init__(os.path.join(cache_dir, "conversions.sqlite"), max_size_bytes)
+
+    @staticmethod
+    def make_key(file_path: str, converter_name: str, converter_version: str, settings: dict) -> str:
+        key = {"file": hash_file(file_path), "converter": converter_name, "version": converter_version, "settings": settings}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def convert(self, file_path: str, converter_name: str, converter_version: str, settings: dict, convert_fn, stats: dict = None, on_hit=None) -> str:
+        """
+        Returns the cached text of the file, or calls convert_fn() and caches its output. Hits, misses and seconds saved go to stats.
+        on_hit(text) is called with the text of a cache hit (e.g. to register its pages for deduplication).
+        """
+        key = self.make_key(file_path, converter_name, converter_version, settings)
+        cached = self.get(key)
+        if cached is not None:
+            text, compute_seconds = cached
+            add_stat(stats, "cache_hits")
+            add_stat(stats, "cache_seconds_saved", compute_seconds)
+            if on_hit is not None:
+                on_hit(text)
+            return text
+        add_stat(stats, "cache_misses")
+        stats_before = [(stats or {}).get(name, 0) for name in UNCACHED_STATS]
+        start_time = time.time()
+        text = convert_fn()
+        if [(stats or {}).get(name, 0) for name in UNCACHED_STATS] == stats_before:
+            self.set(key, text, time.time() - start_time)
+        return text
+
+
+class ResponseCache(DiskCache):
+    """
+    Cache of LLM completions, keyed by the model that answered, the messages (system prompt + user content) and the sampling
+    parameters, so re-running the same tickets (e.g. after changing the post-processing) doesn't pay for the same requests again.
+    The deployments of a pool serving the same model share their cached responses.
+    With refresh=True cached responses are ignored and overwritten by the new ones.
+    """
+    def __init__(self, cache_dir: str, max_size_bytes: int = None, ttl_seconds: float = None, refresh: bool = False):
+        super().__init__(os.path.join(cache_dir, "responses.sqlite"), max_size_bytes, ttl_seconds)
+        self.refresh = refresh
+
+    @staticmethod
+    def make_key(model: str, messages: list, params: dict) -> str:
+        key = {"model": model, "messages": messages, "params": params}
+        return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def complete(self, models: list, messages: list, params: dict, complete_fn, stats: dict = None) -> tuple[str, int, int]:
+        """
+        Returns the cached (text, input_tokens, output_tokens) of the request answered by any of models (the models the request
+        can be sent to), or calls complete_fn() and caches its output under the model that answered: complete_fn returns
+        (text, input_tokens, output_tokens, model). Cached responses are free, so they are returned with 0 tokens; the tokens they saved go to stats.
+        """
+        for model in ([] if self.refresh else models):
+            cached = self.get(self.make_key(model, messages, params))
+            if cached is not None:
+                text, input_tokens, output_tokens = json.loads(cached[0])
+                add_stat(stats, "llm_cache_hits")
+                add_stat(stats, "llm_cache_tokens_saved", input_tokens + output_tokens)
+                return text, 0, 0
+        add_stat(stats, "llm_cache_misses")
+        start_time = time.time()
+        text, input_tokens, output_tokens, model = complete_fn()
+        self.set(self.make_key(model, messages, params), json.dumps([text, input_tokens, output_tokens], ensure_ascii=False), time.time() - start_time)
+        return text, input_tokens, output_tokens
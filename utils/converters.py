@@ -0,0 +1,351 @@
+import sys
+from pathlib import Path
+# Set sys.path to include the project root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import argparse
+import html
+import importlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from utils.stats import add_stat, timer
+
+# version of the attachment-to-text converters. Increase it when the output of a converter changes, so cached conversions are not reused
+CONVERTER_VERSION = "3"
+
+# first bytes of the formats that can be recognized from their content
+MAGIC_BYTES = [(b"\x89PNG\r\n\x1a\n", "image/png"), (b"\xff\xd8\xff", "image/jpeg"), (b"II*\x00", "image/tiff"), (b"MM\x00*", "image/tiff")]
+ZIP_MAGIC = (b"PK\x03\x04", b"PK\x05\x06")
+# container of Excel 97-2003, Word 97-2003 and Outlook .msg files, told apart by the extension
+OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+OLE_MIME_TYPES = {"xls": "application/vnd.ms-excel", "doc": "application/msword", "msg": "application/vnd.ms-outlook"}
+# header fields that can start an email saved as .eml
+EMAIL_HEADER_PATTERN = re.compile(rb"(Received|Return-Path|From|To|Subject|Date|Message-ID|MIME-Version|Delivered-To|X-[\w-]+): ", re.IGNORECASE)
+
+# archives (zip, eml) inside archives are expanded up to this depth, with at most MAX_ARCHIVE_MEMBERS files and MAX_ARCHIVE_BYTES uncompressed
+MAX_ARCHIVE_DEPTH = 2
+MAX_ARCHIVE_MEMBERS = 200
+MAX_ARCHIVE_BYTES = 1 << 30
+
+# extensions of files that are never converted to text (video, audio, executables, disk images, ...): they are not downloaded nor extracted
+# from archives. Files with any other extension, or without one, are downloaded and their type is detected from their content
+NON_CONVERTIBLE_EXTENSIONS = {"mp4", "mov", "avi", "mkv", "wmv", "flv", "webm", "m4v", "mpg", "mpeg", "3gp",
+                              "mp3", "wav", "wma", "aac", "flac", "ogg", "m4a",
+                              "exe", "dll", "msi", "bat", "cmd", "com", "scr", "jar", "apk", "sys",
+                              "iso", "img", "dmg", "vhd", "vhdx", "vmdk", "ova"}
+
+
+def is_non_convertible(file_name: str) -> bool:
+    """True if the extension of the file is in NON_CONVERTIBLE_EXTENSIONS, so it can be skipped without downloading or reading it."""
+    return os.path.splitext(file_name)[1].lower().lstrip(".") in NON_CONVERTIBLE_EXTENSIONS
+
+
+def _zip_mime_type(file_path: str) -> str:
+    # Office Open XML documents are zip files, told apart by the parts they contain
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            names = set(archive.namelist())
+    except (zipfile.BadZipFile, OSError):
+        return "application/octet-stream"
+    if "word/document.xml" in names:
+        return "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    if "xl/workbook.bin" in names:
+        return "application/vnd.ms-excel.sheet.binary.macroenabled.12"
+    if "xl/workbook.xml" in names:
+        return "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    if "[Content_Types].xml" in names:
+        # PowerPoint and other Office Open XML documents
+        return "application/vnd.openxmlformats-officedocument"
+    return "application/zip"
+
+def detect_mime_type(file_path: str) -> str:
+    """
+    MIME type of a file from its first bytes, so attachments with a wrong or missing extension are converted with the right converter.
+    The extension is only used for formats without magic bytes (CSV) and to tell apart the OLE formats (xls, doc, msg).
+    """
+    extension = os.path.splitext(file_path)[1].lower().lstrip(".")
+    with open(file_path, "rb") as file:
+        head = file.read(8192)
+    # PDF allows some bytes before the header
+    if b"%PDF-" in head[:1024]:
+        return "application/pdf"
+    for magic, mime_type in MAGIC_BYTES:
+        if head.startswith(magic):
+            return mime_type
+    if head.startswith(ZIP_MAGIC):
+        return _zip_mime_type(file_path)
+    if head.startswith(OLE_MAGIC):
+        return OLE_MIME_TYPES.get(extension, "application/x-ole-storage")
+    if b"\x00" in head:
+        return "application/octet-stream"
+    if extension == "eml" or (EMAIL_HEADER_PATTERN.match(head) and re.search(rb"\r?\n\r?\n", head)):
+        return "message/rfc822"
+    if re.match(rb"\s*<(!doctype html|html)", head, re.IGNORECASE):
+        return "text/html"
+    if extension == "csv":
+        return "text/csv"
+    return "text/plain"
+
+def html_to_text(text: str) -> str:
+    """Text of an HTML document (e.g. the body of an email), one line per paragraph/row."""
+    text = re.sub(r"(?is)<(script|style|head)\b.*?</\1>", "", text)
+    text = re.sub(r"(?i)<br\s*/?>|</(p|div|tr|li|h\d|table)>", "\n", text)
+    text = re.sub(r"(?i)</t[dh]>", "\t", text)
+    text = html.unescape(re.sub(r"<[^>]+>", "", text))
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+class Converter:
+    """
+    Converter of one or more MIME types to text. function(file_path, options, stats) is called with the options of the ticket
+    (archives also get the registry, their depth and the cache). backends are the modules it needs, imported on first use (see load),
+    so a run that never converts e.g. images never loads Tesseract.
+    settings: options changing the output, part of the key of cached conversions. extensions: usual extensions of the type
+    (for reference only: the converter is chosen from the content of the file). index_function(file_path, text, options, stats) registers
+    the pages of a cached conversion in the page index of the ticket (page deduplication).
+    """
+    def __init__(self, name: str, function, mime_types: list, extensions: list, backends: list = (), settings: list = (), cacheable: bool = True, archive: bool = False,
+                 index_function=None):
+        self.name = name
+        self.function = function
+        self.index_function = index_function
+        self.mime_types = list(mime_types)
+        self.extensions = list(extensions)
+        self.backends = list(backends)
+        self.settings = list(settings)
+        self.cacheable = cacheable
+        self.archive = archive
+        self.loaded = False
+
+    def load(self, stats: dict = None):
+        """Imports the backends the first time the converter is used. The import time goes to stats["time_converter_load"]."""
+        if self.loaded:
+            return
+        if self.backends:
+            with timer(stats, "time_converter_load"):
+                for backend in self.backends:
+                    importlib.import_module(backend)
+        self.loaded = True
+
+
+class ConverterRegistry:
+    """
+    Converters of attachments to text keyed by the MIME type detected from the content of the file (see detect_mime_type).
+    The time of every conversion goes to stats["time_convert_<converter name>"] (the time of an archive includes its members).
+    """
+    def __init__(self):
+        self.converters = {}
+        self.by_mime_type = {}
+
+    def register(self, converter: Converter):
+        self.converters[converter.name] = converter
+        for mime_type in converter.mime_types:
+            self.by_mime_type[mime_type] = converter
+
+    def extensions(self) -> set:
+        return {extension for converter in self.converters.values() for extension in converter.extensions}
+
+    def timers(self) -> list:
+        return [f"time_convert_{name}" for name in self.converters]
+
+    def load_all(self, stats: dict = None):
+        """Imports the backends of every converter, e.g. when a resident service starts."""
+        for converter in self.converters.values():
+            converter.load(stats)
+
+    def converter_for(self, file_path: str) -> Converter | None:
+        """Converter of the MIME type detected from the content of the file, None if the type is not supported."""
+        return self.by_mime_type.get(detect_mime_type(file_path)) if os.path.exists(file_path) else None
+
+    def convert(self, file_path: str, options: dict = None, stats: dict = None, cache=None, depth: int = 0, file_name: str = None) -> str:
+        """
+        Text of the file, converted with the converter of its MIME type, or a note if the type is not supported.
+        options: settings of the converters (ocr_mode, dpi, max_rows, ...). cache: optional ConversionCache.
+        depth: number of archives the file is in. file_name: name used in the notes (default: name of the file).
+        """
+        options = options or {}
+        file_name = file_name or os.path.basename(file_path)
+        converter = self.converter_for(file_path)
+        if converter is None:
+            return f"File {file_name} type not supported"
+        max_depth = options.get("max_archive_depth", MAX_ARCHIVE_DEPTH)
+        if converter.archive and depth >= max_depth:
+            return f"File {file_name} not converted: archives are expanded up to {max_depth} levels"
+        converter.load(stats)
+        if converter.archive:
+            convert_fn = lambda: converter.function(self, file_path, options, stats, depth, cache)
+        else:
+            convert_fn = lambda: converter.function(file_path, options, stats)
+        with timer(stats, f"time_convert_{converter.name}"):
+            if cache is None or not converter.cacheable:
+                return convert_fn()
+            settings = {key: options.get(key) for key in converter.settings}
+            on_hit = None
+            if converter.index_function is not None and options.get("page_index") is not None:
+                # a cached file is not fingerprinted by its converter: its pages are registered for the deduplication of the next attachments
+                on_hit = lambda text: converter.index_function(file_path, text, options, stats)
+            return cache.convert(file_path, converter.name, CONVERTER_VERSION, settings, convert_fn, stats=stats, on_hit=on_hit)
+
+    def convert_members(self, members, options: dict, stats: dict, depth: int, cache=None) -> str:
+        """
+        Converts the files of an archive one at a time: each member is copied to a temporary file, converted through the registry
+        (so archives in archives are expanded too) and deleted before the next one. members: (name, size, open function) tuples.
+        """
+        texts = []
+        total_bytes = 0
+        max_member_bytes = options.get("max_member_bytes")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for n, (name, size, open_member) in enumerate(members, start=1):
+                title = f"ARCHIVE MEMBER {n} - {name}:\n\n"
+                if n > MAX_ARCHIVE_MEMBERS:
+                    add_stat(stats, "archive_members_skipped")
+                    texts.append(f"[members after {MAX_ARCHIVE_MEMBERS} not converted]\n\n")
+                    break
+                if (max_member_bytes is not None and size > max_member_bytes) or total_bytes + size > MAX_ARCHIVE_BYTES:
+                    add_stat(stats, "archive_members_skipped")
+                    texts.append(title + f"File {name} not converted: {size / 1e6:.1f} MB uncompressed\n\n")
+                    continue
+                if is_non_convertible(name):
+                    add_stat(stats, "archive_members_skipped")
+                    texts.append(title + f"File {name} type not supported\n\n")
+                    continue
+                total_bytes += size
+                # keep the extension of the member, which tells apart the formats without magic bytes
+                member_path = os.path.join(tmp_dir, f"{n:05d}_{re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(name))}")
+                try:
+                    with open_member() as source, open(member_path, "wb") as target:
+                        shutil.copyfileobj(source, target, 1 << 20)
+                    text = self.convert(member_path, options, stats, cache, depth + 1, file_name=name)
+                    add_stat(stats, "archive_members")
+                except Exception as e:
+                    # a damaged or encrypted member doesn't stop the conversion of the rest of the archive
+                    add_stat(stats, "archive_members_skipped")
+                    text = f"File {name} could not be converted: {e}"
+                finally:
+                    if os.path.exists(member_path):
+                        os.remove(member_path)
+                texts.append(title + text + "\n\n")
+        return "".join(texts).strip()
+
+
+def convert_pdf(file_path: str, options: dict, stats: dict) -> str:
+    from utils.processing import pdf2text
+    return pdf2text(file_path, ocr_pool=options.get("ocr_pool"), use_text_layer=options.get("use_text_layer", True), ocr_mode=options.get("ocr_mode", "full"),
+                    min_confidence=options.get("min_confidence", 60.0), stats=stats, dpi=options.get("dpi") or 200, max_pages=options.get("max_pages"),
+                    page_index=options.get("page_index"))
+
+def index_pdf(file_path: str, text: str, options: dict, stats: dict):
+    from utils.processing import index_pdf_pages
+    index_pdf_pages(file_path, text, options["page_index"], use_text_layer=options.get("use_text_layer", True), stats=stats)
+
+def fingerprint_image(file_path: str, stats: dict):
+    from PIL import Image
+    from utils.page_dedup import ImageFingerprint
+    with timer(stats, "time_page_fingerprint"), Image.open(file_path) as image:
+        return ImageFingerprint(image)
+
+def convert_image(file_path: str, options: dict, stats: dict) -> str:
+    from utils.processing import image2text
+    page_index = options.get("page_index")
+    ocr = lambda: image2text(file_path, ocr_mode=options.get("ocr_mode", "full"), min_confidence=options.get("min_confidence", 60.0), stats=stats)
+    if page_index is None:
+        return ocr()
+    # an image that looks the same as a page or image seen before in the ticket (e.g. a screenshot of a PDF page) takes its text
+    fingerprint = fingerprint_image(file_path, stats)
+    original = page_index.find_image(fingerprint)
+    if original is not None and original.text is not None:
+        add_stat(stats, "images_duplicate")
+        # text of another file: this conversion is not cached (see utils/cache.py)
+        add_stat(stats, "dedup_text_borrowed")
+        return original.text
+    page = page_index.add_image(fingerprint, os.path.basename(file_path), source=file_path)
+    page.text = ocr()
+    return page.text
+
+def index_image(file_path: str, text: str, options: dict, stats: dict):
+    page_index = options["page_index"]
+    fingerprint = fingerprint_image(file_path, stats)
+    if page_index.find_image(fingerprint) is None:
+        page_index.add_image(fingerprint, os.path.basename(file_path), source=file_path).text = text
+
+def convert_word(file_path: str, options: dict, stats: dict) -> str:
+    from utils.processing import word_to_text
+    return word_to_text(file_path)
+
+def convert_table(file_path: str, options: dict, stats: dict) -> str:
+    from utils.processing import tabular_to_text
+    file_format = {"text/csv": "csv", "application/vnd.ms-excel": "xls", "application/vnd.ms-excel.sheet.binary.macroenabled.12": "xlsb"}.get(detect_mime_type(file_path), "xlsx")
+    with timer(stats, "time_tabular_parse"):
+        return tabular_to_text(file_path, options.get("max_rows") or 5000, options.get("max_cols") or 50, file_format=file_format)
+
+def convert_text(file_path: str, options: dict, stats: dict) -> str:
+    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+        return file.read()
+
+def convert_zip(registry: ConverterRegistry, file_path: str, options: dict, stats: dict, depth: int, cache=None) -> str:
+    """Converts the files of a zip archive, read one at a time (directories and macOS metadata are ignored)."""
+    with zipfile.ZipFile(file_path) as archive:
+        infos = [info for info in archive.infolist() if not info.is_dir() and not info.filename.startswith("__MACOSX/") and os.path.basename(info.filename) != ".DS_Store"]
+        return registry.convert_members([(info.filename, info.file_size, lambda info=info: archive.open(info)) for info in infos], options, stats, depth, cache)
+
+def convert_email(registry: ConverterRegistry, file_path: str, options: dict, stats: dict, depth: int, cache=None) -> str:
+    """Headers and body of an email (.eml), followed by its attachments converted through the registry."""
+    from email import policy
+    from email.parser import BytesParser
+    with open(file_path, "rb") as file:
+        message = BytesParser(policy=policy.default).parse(file)
+    text = "\n".join(f"{header}: {message[header]}" for header in ["From", "To", "Cc", "Date", "Subject"] if message[header]) + "\n\n"
+    body = message.get_body(preferencelist=("plain", "html"))
+    if body is not None:
+        content = body.get_content()
+        text += html_to_text(content) if body.get_content_type() == "text/html" else content.strip()
+    members = []
+    for n, part in enumerate(message.iter_attachments(), start=1):
+        if part.get_content_maintype() == "message":
+            # forwarded emails are attached as message/rfc822 parts
+            payload, default_name = part.get_content().as_bytes(), f"attachment_{n}.eml"
+        else:
+            payload, default_name = part.get_payload(decode=True) or b"", f"attachment_{n}"
+        members.append((part.get_filename() or default_name, len(payload), lambda payload=payload: io.BytesIO(payload)))
+    members_text = registry.convert_members(members, options, stats, depth, cache)
+    return text + ("\n\n" + members_text if members_text else "")
+
+
+# converters of the attachments of the tickets (see SnowTicket.process_attachments)
+CONVERTERS = ConverterRegistry()
+CONVERTERS.register(Converter("pdf2text", convert_pdf, ["application/pdf"], ["pdf"], backends=["pdf2image", "pytesseract", "langdetect"],
+                              settings=["ocr_mode", "min_confidence", "use_text_layer", "dpi", "max_pages"], index_function=index_pdf))
+CONVERTERS.register(Converter("image2text", convert_image, ["image/png", "image/jpeg", "image/tiff"], ["jpg", "jpeg", "png", "tif", "tiff"],
+                              backends=["pytesseract", "langdetect"], settings=["ocr_mode", "min_confidence"], index_function=index_image))
+CONVERTERS.register(Converter("word_to_text", convert_word, ["application/vnd.openxmlformats-officedocument.wordprocessingml.document"], ["docx"], backends=["docx"]))
+CONVERTERS.register(Converter("tabular_to_text", convert_table, ["text/csv", "application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                                                  "application/vnd.ms-excel.sheet.binary.macroenabled.12"],
+                              ["csv", "xls", "xlsx", "xlsm", "xlsb"], backends=["pandas", "openpyxl"], settings=["max_rows", "max_cols"]))
+CONVERTERS.register(Converter("text", convert_text, ["text/plain"], ["txt"], cacheable=False))
+# archives are not cached as a whole: their members are, like any other attachment
+CONVERTERS.register(Converter("zip", convert_zip, ["application/zip"], ["zip"], cacheable=False, archive=True))
+CONVERTERS.register(Converter("email", convert_email, ["message/rfc822"], ["eml"], backends=["email.parser"], cacheable=False, archive=True))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert files to text with the converters of the attachments, printing the detected type and the timings.")
+    parser.add_argument("files", nargs="+", help="files to convert")
+    parser.add_argument("--ocr_mode", default="full", choices=["full", "fast"], help="OCR mode of images and scanned PDFs")
+    parser.add_argument("--show_text", action="store_true", help="print the converted text")
+    args = parser.parse_args()
+
+    for file_path in args.files:
+        stats = {}
+        start_time = time.perf_counter()
+        text = CONVERTERS.convert(file_path, {"ocr_mode": args.ocr_mode}, stats)
+        print(f"{file_path}: {detect_mime_type(file_path)}, {len(text)} characters in {time.perf_counter() - start_time:.3f} s "
+              f"(backends loaded in {sum(stats.get('time_converter_load', [])):.3f} s)")
+        if args.show_text:
+            print(text + "\n")
+
+# example how to run: python utils/converters.py data/outputs/entity_extraction/INC0123456/invoices.zip
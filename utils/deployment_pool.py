@@ -0,0 +1,270 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from openai import AzureOpenAI, APIConnectionError
+from utils.rate_limiter import RateLimiter, get_retry_after, is_rate_limit_error
+from utils.stats import add_stat, append_stat
+
+# requests in flight on a deployment are assumed to slow each other down by this share of its latency
+IN_FLIGHT_PENALTY = 0.25
+# HTTP status codes that mean the deployment (not the request) is in trouble: the request is sent to another deployment
+DEPLOYMENT_ERROR_STATUS = {404, 408, 409}
+# wrong key or no access to the deployment: retrying can't help, the deployment is disabled for the rest of the run
+AUTH_ERROR_STATUS = {401, 403}
+
+
+def is_deployment_error(exception: Exception) -> bool:
+    """Server errors, timeouts, connection errors and a misconfigured deployment (e.g. 404). A 400 is a problem of the request itself."""
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None:
+        return isinstance(exception, APIConnectionError)
+    return status_code >= 500 or status_code in DEPLOYMENT_ERROR_STATUS
+
+
+def is_auth_error(exception: Exception) -> bool:
+    """401/403: the key of the deployment is wrong or has no access to it."""
+    return getattr(exception, "status_code", None) in AUTH_ERROR_STATUS
+
+
+class Deployment:
+    """
+    One Azure OpenAI deployment: its client, its RPM/TPM quota (RateLimiter, also paused after a 429 or repeated failures)
+    and what was observed on its recent requests (latency, share of 429s, consecutive failures).
+    model is the model (and version) it serves, the key of its cached responses: AZURE_OPENAI_MODEL by default.
+    """
+    def __init__(self, name: str, endpoint: str, deployment: str, api_key: str, api_version: str, rate_limiter: RateLimiter = None, window_seconds: float = 60, model: str = None):
+        self.name = name
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.model = model or os.environ.get("AZURE_OPENAI_MODEL", "gpt-4o")
+        # retries are done by the pool (on another deployment if possible), not by the client
+        self.client = AzureOpenAI(api_version=api_version, azure_endpoint=endpoint, api_key=api_key, max_retries=0)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # observations older than this are forgotten, so a deployment that was slow or rate limited gets traffic again
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.latency = None
+        self.last_latency_time = 0.0
+        self.outcomes = deque()
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.counters = {"requests": 0, "rate_limited": 0, "failures": 0, "tokens": 0}
+        # reason why the deployment gets no more requests in this run (401/403), None while it is enabled
+        self.disabled = None
+
+    def recent_latency(self) -> float | None:
+        """Moving average of the latency of the last requests, None if there was no request in the last window_seconds."""
+        with self.lock:
+            return self.latency if time.monotonic() - self.last_latency_time < self.window_seconds else None
+
+    def rate_limited_share(self) -> float:
+        """Share of the requests of the last window_seconds answered with a 429, smoothed so a single 429 does not take the deployment out."""
+        with self.lock:
+            self._forget()
+            return sum(rate_limited for _, rate_limited in self.outcomes) / (len(self.outcomes) + 2)
+
+    def _forget(self):
+        limit = time.monotonic() - self.window_seconds
+        while self.outcomes and self.outcomes[0][0] < limit:
+            self.outcomes.popleft()
+
+    def record_success(self, seconds: float, tokens: int):
+        with self.lock:
+            # exponential moving average, restarted when the last value is too old
+            fresh = self.latency is not None and time.monotonic() - self.last_latency_time < self.window_seconds
+            self.latency = 0.8 * self.latency + 0.2 * seconds if fresh else seconds
+            self.last_latency_time = time.monotonic()
+            self.outcomes.append((time.monotonic(), False))
+            self.consecutive_failures = 0
+            self.counters["requests"] += 1
+            self.counters["tokens"] += tokens
+
+    def record_rate_limit(self):
+        with self.lock:
+            self.outcomes.append((time.monotonic(), True))
+            self.counters["requests"] += 1
+            self.counters["rate_limited"] += 1
+
+    def record_failure(self) -> int:
+        """Counts a failed request. Returns the number of consecutive failures."""
+        with self.lock:
+            self.consecutive_failures += 1
+            self.counters["requests"] += 1
+            self.counters["failures"] += 1
+            return self.consecutive_failures
+
+    def disable(self, reason: str) -> bool:
+        """Counts the failed request and disables the deployment. Returns False if it was already disabled (by another request)."""
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["failures"] += 1
+            if self.disabled is not None:
+                return False
+            self.disabled = reason
+            return True
+
+    def summary(self) -> dict:
+        latency = self.recent_latency()
+        return {**self.counters, "latency": round(latency, 3) if latency is not None else None, "rate_limited_share": round(self.rate_limited_share(), 3),
+                "headroom": round(self.rate_limiter.headroom(), 3), "consecutive_failures": self.consecutive_failures, "disabled": self.disabled}
+
+
+class DeploymentPool:
+    """
+    Several Azure OpenAI deployments (endpoints/regions) used as one, so the throughput is the sum of their quotas.
+    Every request goes to the deployment expected to answer first: seconds until its quota allows the request, plus its recent
+    latency (higher with requests in flight), divided by the share of its recent requests not rate limited. Ties go to the one with more quota left.
+    A 429 pauses the deployment for its Retry-After and the request is sent again, to another deployment if one is free. Server and connection
+    errors send the request to another deployment right away; once every deployment failed for the request, it waits an exponential backoff
+    (base_delay doubling up to max_delay, with jitter) before each new attempt. After failure_threshold consecutive failures a deployment is
+    paused for cooldown_seconds (doubling while it keeps failing, up to max_cooldown_seconds). A deployment answering 401 or 403 (wrong key,
+    no access) is disabled for the rest of the run and the request goes to another one right away; the error is raised once none is left.
+    """
+    def __init__(self, deployments: list, failure_threshold: int = 3, cooldown_seconds: float = 30, max_cooldown_seconds: float = 300):
+        if not deployments:
+            raise ValueError("A deployment pool needs at least one deployment")
+        self.deployments = deployments
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, rate_limiter: RateLimiter = None) -> "DeploymentPool":
+        """Single deployment of AZURE_OPENAI_ENDPOINT/AZURE_OPENAI_DEPLOYMENT, with the quota of rate_limiter."""
+        return cls([Deployment(os.environ["AZURE_OPENAI_DEPLOYMENT"], os.environ["AZURE_OPENAI_ENDPOINT"], os.environ["AZURE_OPENAI_DEPLOYMENT"],
+                               os.environ["AZURE_OPENAI_API_KEY"], os.environ["AZURE_OPENAI_API_VERSION"], rate_limiter=rate_limiter)])
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "DeploymentPool":
+        """
+        Deployments listed in a JSON file: [{"name", "endpoint", "deployment", "api_key_env", "api_version", "rpm", "tpm", "model"}, ...].
+        api_key_env is the environment variable (e.g. in the secrets file) with the key of the endpoint, AZURE_OPENAI_API_KEY by default.
+        api_version defaults to AZURE_OPENAI_API_VERSION, name to the deployment. rpm and tpm are the quotas of the deployment (optional).
+        model is the model it serves (e.g. "gpt-4o-2024-08-06"), AZURE_OPENAI_MODEL by default.
+        """
+        with open(path, "r", encoding="utf-8") as file:
+            entries = json.load(file)
+        deployments = []
+        for entry in entries:
+            rate_limiter = RateLimiter(requests_per_minute=entry.get("rpm"), tokens_per_minute=entry.get("tpm"))
+            deployments.append(Deployment(entry.get("name", entry["deployment"]), entry["endpoint"], entry["deployment"], os.environ[entry.get("api_key_env", "AZURE_OPENAI_API_KEY")],
+                                          entry.get("api_version", os.environ.get("AZURE_OPENAI_API_VERSION")), rate_limiter=rate_limiter, model=entry.get("model")))
+        if len({deployment.name for deployment in deployments}) < len(deployments):
+            raise ValueError(f"Deployment names in {path} must be unique")
+        return cls(deployments, **kwargs)
+
+    def models(self) -> list:
+        """Models served by the deployments, in the order of the deployments."""
+        return list(dict.fromkeys(deployment.model for deployment in self.deployments))
+
+    def expected_seconds(self, deployment: Deployment, n_tokens: int, default_latency: float) -> float:
+        """Estimated seconds until deployment answers a request of n_tokens (see the class docstring)."""
+        latency = deployment.recent_latency()
+        latency = default_latency if latency is None else latency
+        latency *= 1 + IN_FLIGHT_PENALTY * deployment.in_flight
+        return (deployment.rate_limiter.time_to_wait(n_tokens) + latency) / max(0.1, 1 - deployment.rate_limited_share())
+
+    def enabled(self) -> list:
+        """Deployments not disabled by a 401/403."""
+        return [deployment for deployment in self.deployments if deployment.disabled is None]
+
+    def select(self, n_tokens: int = 0, exclude: set = None) -> Deployment:
+        """Deployment expected to answer first among the enabled ones, ignoring the ones in exclude (unless all of them are)."""
+        enabled = self.enabled()
+        if not enabled:
+            raise RuntimeError("Every deployment is disabled (401/403), check their API keys: " + "; ".join(f"{deployment.name}: {deployment.disabled}" for deployment in self.deployments))
+        candidates = [deployment for deployment in enabled if deployment.name not in (exclude or set())] or enabled
+        # deployments without recent requests are assumed as fast as the others, so they get traffic again
+        latencies = [latency for latency in (deployment.recent_latency() for deployment in self.deployments) if latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else 0.0
+        with self.lock:
+            deployment = min(candidates, key=lambda deployment: (round(self.expected_seconds(deployment, n_tokens, default_latency), 3), -deployment.rate_limiter.headroom(), random.random()))
+            deployment.in_flight += 1
+        return deployment
+
+    def complete(self, request, n_tokens: int, used_tokens=None, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, stats: dict = None):
+        """
+        Calls request(deployment) on the selected deployment, within its quota, and sends it again (to another deployment
+        if possible) after a 429 or a deployment error, up to max_retries times. used_tokens(result) returns the tokens really
+        used, to correct the quota reserved. The deployment that answered is appended to stats["llm_deployment"].
+        """
+        attempt = 0
+        failed = set()
+        backoff = 0.0
+        while True:
+            # not holding a slot of a deployment while waiting
+            time.sleep(backoff)
+            backoff = 0.0
+            deployment = self.select(n_tokens, exclude=failed)
+            try:
+                append_stat(stats, "time_rate_limit_wait", round(deployment.rate_limiter.acquire(n_tokens), 4))
+                start_time = time.monotonic()
+                try:
+                    result = request(deployment)
+                except Exception as e:
+                    # a request that failed did not use its tokens
+                    deployment.rate_limiter.adjust(n_tokens, 0)
+                    if is_auth_error(e):
+                        self._disable(deployment, e)
+                        if not self.enabled():
+                            raise
+                        add_stat(stats, "llm_failovers")
+                        continue
+                    if attempt >= max_retries or not (is_rate_limit_error(e) or is_deployment_error(e)):
+                        raise
+                    attempt += 1
+                    self._record_error(deployment, e, attempt, max_retries, base_delay, max_delay)
+                    if not is_rate_limit_error(e):
+                        failed.add(deployment.name)
+                        if len(failed) < len(self.enabled()):
+                            add_stat(stats, "llm_failovers")
+                        else:
+                            # no other deployment left: back off before hitting the same endpoints again
+                            backoff = min(max_delay, base_delay * 2 ** (attempt - 1)) * (1 + random.random())
+                    continue
+                tokens = used_tokens(result) if used_tokens is not None else n_tokens
+                deployment.rate_limiter.adjust(n_tokens, tokens)
+                deployment.record_success(time.monotonic() - start_time, tokens)
+                append_stat(stats, "llm_deployment", deployment.name)
+                return result
+            finally:
+                with self.lock:
+                    deployment.in_flight -= 1
+
+    def _disable(self, deployment: Deployment, exception: Exception):
+        if not deployment.disable(f"{type(exception).__name__}: {exception}"):
+            return
+        print(f"{'!' * 80}\nERROR: deployment {deployment.name} ({deployment.endpoint}) answered {exception.status_code}, check its API key and access. "
+              f"It gets no more requests in this run ({len(self.enabled())} deployment(s) left)\n{exception}\n{'!' * 80}")
+
+    def _record_error(self, deployment: Deployment, exception: Exception, attempt: int, max_retries: int, base_delay: float, max_delay: float):
+        if is_rate_limit_error(exception):
+            delay = get_retry_after(exception)
+            if delay is None:
+                delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * (1 + random.random())
+            deployment.record_rate_limit()
+            deployment.rate_limiter.pause(delay)
+            print(f"Rate limit reached on deployment {deployment.name}, paused for {delay:.1f} seconds (attempt {attempt}/{max_retries})")
+            return
+        failures = deployment.record_failure()
+        print(f"ERROR on deployment {deployment.name} ({type(exception).__name__}: {exception}), sending the request again (attempt {attempt}/{max_retries})")
+        if failures >= self.failure_threshold:
+            cooldown = min(self.max_cooldown_seconds, self.cooldown_seconds * 2 ** (failures - self.failure_threshold))
+            deployment.rate_limiter.pause(cooldown)
+            print(f"Deployment {deployment.name} failed {failures} times in a row, paused for {cooldown:.0f} seconds")
+
+    def summary(self) -> dict:
+        """Requests, 429s, failures, tokens, recent latency and quota left of every deployment."""
+        return {deployment.name: deployment.summary() for deployment in self.deployments}
+
+    def print_summary(self):
+        if len(self.deployments) < 2:
+            return
+        print(f"{'deployment':<24}{'requests':>10}{'429s':>8}{'failures':>10}{'tokens':>12}{'latency':>10}")
+        for name, row in self.summary().items():
+            latency = f"{row['latency']:.2f}" if row["latency"] is not None else "-"
+            print(f"{name:<24}{row['requests']:>10}{row['rate_limited']:>8}{row['failures']:>10}{row['tokens']:>12}{latency:>10}" + ("  DISABLED" if row["disabled"] else ""))
@@ -0,0 +1,190 @@
+import sys
+from pathlib import Path
+# Set sys.path to include the project root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import argparse
+import json
+import re
+import unicodedata
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+
+DEFAULT_ENTITY_CODES_PATH = str(Path(__file__).resolve().parent.parent / "data" / "inputs" / "entities" / "entity_codes.json")
+
+# legal forms and filler words ignored when comparing entity names
+STOP_WORDS = {"gmbh", "bv", "ab", "ltd", "limited", "sa", "sas", "spa", "srl", "nv", "inc", "as", "oy", "sro", "kft", "co", "company", "the", "of"}
+# spellings of the legal forms with dots, spaces or slashes (G.m.b.H., B.V., S.p.A., A/S, ...), written as one word before the punctuation is removed
+LEGAL_FORM_SPELLINGS = {"gmbh": r"g\.?\s?m\.?\s?b\.?\s?h", "bv": r"b\.\s?v", "nv": r"n\.\s?v", "ab": r"a\.\s?b", "sas": r"s\.\s?a\.\s?s",
+                        "spa": r"s\.\s?p\.\s?a", "srl": r"s\.\s?r\.\s?l", "sro": r"s\.\s?r\.\s?o", "sa": r"s\.\s?a", "as": r"a\s?/\s?s"}
+LEGAL_FORM_PATTERN = re.compile(r"\b(?:" + "|".join(f"(?P<{form}>{spelling})" for form, spelling in LEGAL_FORM_SPELLINGS.items()) + r")\b\.?")
+# legal forms cut by the length limit of the names in entity_codes.json (e.g. "AGS Immobilien Leasing GM"), only read at the end of those names
+TRUNCATED_LEGAL_FORMS = {"gm": "gmbh", "gmb": "gmbh"}
+# spellings of the same word in the names written by suppliers and the LLM
+SYNONYMS = {"cars": "car", "netherlands": "netherland", "nederland": "netherland", "holland": "netherland", "deutschland": "germany",
+            "sverige": "sweden", "united kingdom": "uk", "great britain": "uk", "belgie": "belgium", "belgique": "belgium", "espana": "spain",
+            "italia": "italy", "osterreich": "austria", "suomi": "finland", "danmark": "denmark", "norge": "norway", "polska": "poland", "turkiye": "turkey"}
+SYNONYM_PATTERN = re.compile(r"\b(" + "|".join(sorted(map(re.escape, SYNONYMS), key=len, reverse=True)) + r")\b")
+
+EntityMatch = namedtuple("EntityMatch", ["entity", "code", "score"])
+
+# entities with the same normalized name but different codes are told apart by their spelling, if the best one is this much more similar than the next
+AMBIGUITY_MARGIN = 0.1
+
+def normalize_entity(name: str, truncated: bool = False) -> str:
+    """
+    Lowercase name without accents, punctuation, legal forms and with the usual spellings unified, e.g. "Volvo Cars Germany, G.m.b.H." -> "volvo car germany".
+    truncated: the name may end with a legal form cut short (names of entity_codes.json).
+    """
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    name = LEGAL_FORM_PATTERN.sub(lambda match: f" {match.lastgroup} ", name)
+    words = re.sub(r"[^a-z0-9]+", " ", name).split()
+    if truncated and words:
+        words[-1] = TRUNCATED_LEGAL_FORMS.get(words[-1], words[-1])
+    name = SYNONYM_PATTERN.sub(lambda match: SYNONYMS[match.group(1)], " ".join(words))
+    return " ".join(word for word in name.split() if word not in STOP_WORDS)
+
+def _spelling(name: str) -> str:
+    # name as written (only case, accents, punctuation and legal-form spellings unified), to tell apart entities with the same normalized name
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", LEGAL_FORM_PATTERN.sub(lambda match: f" {match.lastgroup} ", name)).split())
+
+def _trigrams(name: str) -> set:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _similarity(trigrams: set, other: set) -> float:
+    # Dice coefficient
+    return 2 * len(trigrams & other) / (len(trigrams) + len(other))
+
+
+class EntityResolver:
+    """
+    Index of the Volvo Cars entities of entity_codes.json, resolving the entity names written by suppliers or the LLM
+    to the canonical name and company code. Exact matches of the normalized name are a dictionary lookup; other names are
+    matched by trigram similarity (Dice coefficient) against the candidates sharing trigrams, and accepted over min_score.
+    A normalized name shared by entities with different codes (e.g. "Volvo Cars Netherland" NL07 and "Volvo Car Nederland BV" NL10)
+    is ambiguous: the entity whose spelling is clearly the closest is returned with the lower score of the two, otherwise None.
+    Lookups are cached, so resolving the same names again over a run is a dictionary access.
+    """
+    def __init__(self, entities: list, min_score: float = 0.75):
+        self.min_score = min_score
+        # (entity, code, trigrams of its spelling) of every entity
+        self.entries = []
+        # (normalized name, trigrams, entries with that name) of every distinct normalized name
+        self.names = []
+        self.exact = {}
+        self.trigram_index = defaultdict(set)
+        for entity in entities:
+            normalized = normalize_entity(entity["ENTITY"], truncated=True)
+            if normalized not in self.exact:
+                self.exact[normalized] = len(self.names)
+                self.names.append((normalized, _trigrams(normalized), []))
+                for trigram in self.names[-1][1]:
+                    self.trigram_index[trigram].add(self.exact[normalized])
+            self.names[self.exact[normalized]][2].append(len(self.entries))
+            self.entries.append((entity["ENTITY"], entity["CODE"], _trigrams(_spelling(entity["ENTITY"]))))
+        ambiguous = [normalized for normalized, _, entry_ids in self.names if len({self.entries[entry_id][1] for entry_id in entry_ids}) > 1]
+        if ambiguous:
+            print(f"WARNING: entity names with several codes, resolved by their spelling: {', '.join(ambiguous)}")
+        self.resolve = lru_cache(maxsize=65536)(self._resolve)
+
+    @classmethod
+    def from_json(cls, path: str = DEFAULT_ENTITY_CODES_PATH, min_score: float = 0.75) -> "EntityResolver":
+        with open(path, "r", encoding="utf-8") as file:
+            return cls(json.load(file), min_score=min_score)
+
+    def _resolve(self, name: str) -> EntityMatch | None:
+        """Canonical entity, code and similarity score (1.0 for exact matches) of a name, or None if nothing is similar enough."""
+        if not name or name == "NaN":
+            return None
+        normalized = normalize_entity(name)
+        if normalized in self.exact:
+            return self._pick(name, self.exact[normalized], 1.0)
+        trigrams = _trigrams(normalized)
+        shared = defaultdict(int)
+        for trigram in trigrams:
+            for name_id in self.trigram_index.get(trigram, ()):
+                shared[name_id] += 1
+        best_id, best_score = None, 0.0
+        for name_id, n_shared in shared.items():
+            score = 2 * n_shared / (len(trigrams) + len(self.names[name_id][1]))
+            if score > best_score:
+                best_id, best_score = name_id, score
+        if best_id is None or best_score < self.min_score:
+            return None
+        return self._pick(name, best_id, best_score)
+
+    def _pick(self, name: str, name_id: int, score: float) -> EntityMatch | None:
+        # entity of the normalized name matched; if it has entities with different codes, the one with the closest spelling
+        entry_ids = self.names[name_id][2]
+        if len({self.entries[entry_id][1] for entry_id in entry_ids}) == 1:
+            entity, code, _ = self.entries[entry_ids[0]]
+            return EntityMatch(entity, code, round(score, 3))
+        trigrams = _trigrams(_spelling(name))
+        similarities = sorted(((_similarity(trigrams, self.entries[entry_id][2]), entry_id) for entry_id in entry_ids), reverse=True)
+        (best_similarity, best_id), (next_similarity, _) = similarities[0], similarities[1]
+        score = min(score, best_similarity)
+        if best_similarity - next_similarity < AMBIGUITY_MARGIN or score < self.min_score:
+            return None
+        entity, code, _ = self.entries[best_id]
+        return EntityMatch(entity, code, round(score, 3))
+
+    def resolve_many(self, names) -> dict:
+        """Resolves a collection of names at once (e.g. all the entities of a run). Returns {name: EntityMatch or None}."""
+        return {name: self.resolve(name) for name in set(names)}
+
+@lru_cache(maxsize=4)
+def load_entity_resolver(path: str = DEFAULT_ENTITY_CODES_PATH, min_score: float = 0.75) -> EntityResolver:
+    """Resolver loaded once per process and shared by all tickets."""
+    return EntityResolver.from_json(path, min_score=min_score)
+
+
+def resolve_run(results_path: str, resolver: EntityResolver) -> list:
+    """
+    Resolves the entities of the invoices extracted in a run (extracted_entities.txt of every ticket folder, or the results store),
+    deduplicating the invoices of a ticket on (reference, fiscal year, entity code). Returns one row per invoice.
+    """
+    from utils.results_store import is_results_store, load_run
+    if is_results_store(results_path):
+        texts = load_run(results_path, columns=["extracted_entities"]).sort_values("ticket")
+        texts = dict(zip(texts["ticket"], texts["extracted_entities"]))
+    else:
+        texts = {path.parent.name: path.read_text(encoding="utf-8") for path in sorted(Path(results_path).glob("*/extracted_entities.txt"))}
+    extracted = {}
+    for ticket, text in texts.items():
+        try:
+            extracted[ticket] = json.loads(text)
+        except (json.JSONDecodeError, TypeError):
+            continue
+    matches = resolver.resolve_many(invoice[2] for entities in extracted.values() for invoice in entities.get("invoices", []) if len(invoice) > 2)
+    rows = []
+    for ticket, entities in extracted.items():
+        seen = set()
+        for invoice in entities.get("invoices", []):
+            if len(invoice) < 3:
+                continue
+            match = matches.get(invoice[2])
+            code = match.code if match is not None else "NaN"
+            key = (invoice[0], invoice[1], code if match is not None else normalize_entity(invoice[2]))
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append({"ticket": ticket, "invoice_reference_number": invoice[0], "invoice_fiscal_year": invoice[1], "extracted_entity": invoice[2],
+                         "entity": match.entity if match is not None else "NaN", "entity_code": code, "score": match.score if match is not None else 0.0})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resolve the entities of the invoices extracted in a run to their company codes.")
+    parser.add_argument("results_path", help="folder of the run. Example: data/outputs/entity_extraction/20250706_143022_run")
+    parser.add_argument("--entity_codes", default=DEFAULT_ENTITY_CODES_PATH, help="json with the ENTITY and CODE of every Volvo Cars entity")
+    parser.add_argument("--min_score", type=float, default=0.75, help="minimum similarity (0-1) to accept a match")
+    args = parser.parse_args()
+
+    import pandas as pd
+    rows = resolve_run(args.results_path, EntityResolver.from_json(args.entity_codes, min_score=args.min_score))
+    output_path = str(Path(args.results_path) / "resolved_invoices.xlsx")
+    pd.DataFrame(rows).to_excel(output_path, index=False)
+    print(f"{len(rows)} invoices resolved, {sum(row['entity_code'] == 'NaN' for row in rows)} without entity code. Saved in {output_path}")
+
+# example how to run: python utils/entity_resolver.py data/outputs/entity_extraction/20250706_143022_run
@@ -0,0 +1,92 @@
+import csv
+import json
+import math
+import os
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Nearest-rank percentile (q in 0-100) of a sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+
+class MetricsSink:
+    """
+    Streams the metrics of every ticket to metrics_stream_<timestamp>.jsonl (or .csv) as soon as the ticket is completed,
+    so the timings of a long run can be followed (e.g. tail -f) and are not lost if the run is killed.
+    Values of the stage timers (lists with one duration per event, e.g. per download) are also collected to report
+    count, total, p50, p95, p99 and max per stage at the end of the run. An existing file (resumed run) is appended to
+    and its timings are included in the summary.
+    """
+    def __init__(self, results_path: str, timestamp_str: str, stages: list, format: str = "jsonl"):
+        if format not in ("jsonl", "csv"):
+            raise ValueError(f"Unknown metrics format {format}. Pick between jsonl and csv")
+        self.format = format
+        self.stages = list(stages)
+        self.path = os.path.join(results_path, f"metrics_stream_{timestamp_str}.{format}")
+        self.summary_path = os.path.join(results_path, f"stage_timings_{timestamp_str}.json")
+        self.events = {stage: [] for stage in self.stages}
+        self.columns = None
+        if os.path.exists(self.path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8", newline="") as file:
+            if self.format == "jsonl":
+                rows = []
+                for line in file:
+                    try:
+                        rows.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # last line of a run killed while writing
+                        continue
+            else:
+                reader = csv.DictReader(file)
+                self.columns = reader.fieldnames
+                rows = [{key: json.loads(value) if key in self.events and value else value for key, value in row.items()} for row in reader]
+        for row in rows:
+            self.add_events(row)
+
+    def add_events(self, stats: dict):
+        """Adds the timer values of stats (e.g. of the run, not of a ticket) to the summary."""
+        for stage in self.stages:
+            value = stats.get(stage)
+            if isinstance(value, list):
+                self.events[stage].extend(value)
+
+    def write(self, row: dict):
+        """Appends the row of a ticket and flushes it to disk."""
+        self.add_events(row)
+        with open(self.path, "a", encoding="utf-8", newline="") as file:
+            if self.format == "jsonl":
+                file.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+            else:
+                if self.columns is None:
+                    self.columns = list(row)
+                    csv.DictWriter(file, fieldnames=self.columns).writeheader()
+                # lists of the timers are written as json arrays
+                values = {key: json.dumps(value) if isinstance(value, list) else value for key, value in row.items()}
+                csv.DictWriter(file, fieldnames=self.columns, extrasaction="ignore").writerow(values)
+            file.flush()
+
+    def summary(self) -> dict:
+        """Count, total, p50, p95, p99 and max in seconds of every stage with events."""
+        summary = {}
+        for stage, values in self.events.items():
+            if not values:
+                continue
+            values = sorted(values)
+            summary[stage] = {"count": len(values), "total": round(sum(values), 3), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                              "p99": percentile(values, 99), "max": values[-1]}
+        return summary
+
+    def save_summary(self) -> dict:
+        """Writes the summary to stage_timings_<timestamp>.json and prints it as a table."""
+        summary = self.summary()
+        with open(self.summary_path, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+        if summary:
+            print(f"\n{'stage':<30}{'count':>8}{'total':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+            for stage, row in summary.items():
+                print(f"{stage:<30}{row['count']:>8}{row['total']:>10.1f}{row['p50']:>9.3f}{row['p95']:>9.3f}{row['p99']:>9.3f}{row['max']:>9.3f}")
+        return summary
@@ -1,24 +1,48 @@
-def calculate_openai_cost(input_tokens: int, output_tokens: int, model: str="gpt-4-turbo") -> float:
+# price in USD per 1M tokens of every model. Dated versions (e.g. gpt-4o-2024-08-06) use the price of the longest matching name
+PRICING = {
+    'gpt-4': {'input_per_1m': 30, 'output_per_1m': 60},
+    'gpt-4-turbo': {'input_per_1m': 10, 'output_per_1m': 30},
+    'gpt-4o': {'input_per_1m': 2.5, 'output_per_1m': 10},
+    'gpt-4o-2024-05-13': {'input_per_1m': 5, 'output_per_1m': 15},
+    'gpt-4o-mini': {'input_per_1m': 0.15, 'output_per_1m': 0.6},
+    'gpt-4.1': {'input_per_1m': 2, 'output_per_1m': 8},
+    'gpt-4.1-mini': {'input_per_1m': 0.4, 'output_per_1m': 1.6},
+    'gpt-4.1-nano': {'input_per_1m': 0.1, 'output_per_1m': 0.4},
+    'o3-mini': {'input_per_1m': 1.1, 'output_per_1m': 4.4},
+}
+
+def model_pricing(model: str) -> dict:
+    """Price of the model, matching dated versions to the longest model name they start with (case insensitive)."""
+    model = model.lower()
+    matches = [name for name in PRICING if model == name or model.startswith(name + "-")]
+    if not matches:
+        raise ValueError(f"Model '{model}' not recognized. Available models: {', '.join(PRICING.keys())}")
+    return PRICING[max(matches, key=len)]
+
+def is_priced(model: str) -> bool:
+    """True if the price of the model is known. Otherwise a warning is printed: the costs of the run are left empty."""
+    try:
+        model_pricing(model)
+        return True
+    except ValueError as e:
+        print(f"WARNING: {e}. Costs are not calculated, set AZURE_OPENAI_MODEL to the model of the deployment")
+        return False
+
+def calculate_openai_cost(input_tokens: int, output_tokens: int, model: str="gpt-4-turbo", batch: bool = False) -> float:
     """
     Calculate the cost of querying OpenAI's GPT-4 API based on the number of input and output tokens.
 
     :param input_tokens: Number of input tokens used in the request.
     :param output_tokens: Number of output tokens generated in the response.
-    :param model: The specific GPT-4 model used ('gpt-4', 'gpt-4-turbo', 'gpt-4o', 'gpt-4o-mini').
+    :param model: The model used (one of PRICING, or a dated version of one, e.g. 'gpt-4o-2024-08-06').
+    :param batch: True for requests sent through the Batch API, which are billed at 50% of the price.
     :return: Total cost in USD.
     """
-    pricing = {
-        'gpt-4': {'input_per_1m': 30, 'input_per_1m': 60},
-        'gpt-4-turbo': {'input_per_1m': 10, 'input_per_1m': 30},
-        'gpt-4o': {'input_per_1m': 5, 'input_per_1m': 15},
-        'gpt-4o-mini': {'input_per_1m': 0.15, 'input_per_1m': 0.6},
-    }
-
-    if model not in pricing:
-        raise ValueError(f"Model '{model}' not recognized. Available models: {', '.join(pricing.keys())}")
-
-    input_cost = (input_tokens / 10e6) * pricing[model]['input_per_1m']
-    output_cost = (output_tokens / 10e6) * pricing[model]['input_per_1m']
+    pricing = model_pricing(model)
+    input_cost = (input_tokens / 1e6) * pricing['input_per_1m']
+    output_cost = (output_tokens / 1e6) * pricing['output_per_1m']
     total_cost = input_cost + output_cost
+    if batch:
+        total_cost *= 0.5
 
     return round(total_cost, 6)  # Round to 6 decimal places for precision
\ No newline at end of file
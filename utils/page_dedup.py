@@ -0,0 +1,147 @@
+import re
+import threading
+import zlib
+import numpy as np
+from utils.stats import add_stat
+from utils.tokens import count_tokens
+
+# separator of the pages in the text of a converted attachment (PDF pages). Removed before the text goes to the LLM
+PAGE_BREAK = "\f"
+# dHash: 8x8 differences between neighbour pixels (64 bits). Pages within MAX_HASH_DISTANCE bits are compared on their thumbnails
+HASH_SIZE = 8
+MAX_HASH_DISTANCE = 6
+# thumbnails (about 70 DPI for an A4 page, enough to see a single digit) compared pixel by pixel: a block of BLOCK_SIZE x BLOCK_SIZE pixels
+# with more than MAX_BLOCK_PIXELS pixels differing by more than PIXEL_TOLERANCE gray levels means the pages are different (e.g. another invoice number on the same template)
+THUMBNAIL_SIZE = (576, 816)
+BLOCK_SIZE = 16
+PIXEL_TOLERANCE = 48
+MAX_BLOCK_PIXELS = 3
+# DPI of the pages rasterized only to be fingerprinted
+FINGERPRINT_DPI = 72
+WORD_PATTERN = re.compile(r"\w+")
+# words with a digit (invoice/PO numbers, amounts, dates): a page with one not found in the other page is never dropped
+NUMBER_PATTERN = re.compile(r"\w*\d[\w\-/.,]*\w|\d")
+
+
+class ImageFingerprint:
+    """Perceptual hash (dHash), aspect ratio and grayscale thumbnail of a page or image."""
+    def __init__(self, image):
+        from PIL import Image
+        gray = image.convert("L")
+        pixels = list(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+        self.dhash = 0
+        for row in range(HASH_SIZE):
+            for col in range(HASH_SIZE):
+                left, right = pixels[row * (HASH_SIZE + 1) + col], pixels[row * (HASH_SIZE + 1) + col + 1]
+                self.dhash = self.dhash << 1 | (left > right)
+        self.aspect = gray.width / gray.height
+        # same size whatever the aspect ratio: only pages with the same aspect ratio are compared
+        self.thumbnail = np.asarray(gray.resize(THUMBNAIL_SIZE, Image.BOX), dtype=np.int16)
+
+    def same_as(self, other: "ImageFingerprint") -> bool:
+        """Near-duplicate: close hashes, same aspect ratio and no block of the thumbnails that differs."""
+        if bin(self.dhash ^ other.dhash).count("1") > MAX_HASH_DISTANCE or abs(self.aspect - other.aspect) > 0.02 * self.aspect:
+            return False
+        width, height = THUMBNAIL_SIZE
+        differing = np.abs(self.thumbnail - other.thumbnail) > PIXEL_TOLERANCE
+        per_block = differing.reshape(height // BLOCK_SIZE, BLOCK_SIZE, width // BLOCK_SIZE, BLOCK_SIZE).sum(axis=(1, 3))
+        return bool(per_block.max() <= MAX_BLOCK_PIXELS)
+
+
+class ImagePage:
+    """Page or image seen in a ticket, from the file source. text is set once it is converted (None if it failed)."""
+    def __init__(self, fingerprint: ImageFingerprint, label: str, source: str = None):
+        self.fingerprint = fingerprint
+        self.label = label
+        self.source = source
+        self.text = None
+
+
+class PageIndex:
+    """
+    Pages already seen in the attachments of a ticket, to skip the OCR of a page that looks the same as a previous one
+    (find_image / add_image) and to drop pages whose text repeats a previous page from the LLM input (filter_pages).
+    """
+    def __init__(self, deduplicator: "PageDeduplicator"):
+        self.deduplicator = deduplicator
+        self.images = []
+        self.texts = []
+        self.lock = threading.Lock()
+
+    def find_image(self, fingerprint: ImageFingerprint) -> ImagePage | None:
+        """Page seen before that looks the same as fingerprint, or None. Its text may not be converted yet (earlier page of the same PDF)."""
+        with self.lock:
+            images = list(self.images)
+        for page in images:
+            if page.fingerprint.same_as(fingerprint):
+                return page
+        return None
+
+    def add_image(self, fingerprint: ImageFingerprint, label: str, source: str = None) -> ImagePage:
+        page = ImagePage(fingerprint, label, source)
+        with self.lock:
+            self.images.append(page)
+        return page
+
+    def text_features(self, text: str) -> tuple[set, set] | None:
+        """Hashed shingles (words_per_shingle consecutive words) and numbers of a page, None if it is too short to be compared."""
+        words = WORD_PATTERN.findall(text.lower())
+        k = self.deduplicator.words_per_shingle
+        if len(words) < max(self.deduplicator.min_words, k):
+            return None
+        shingles = {zlib.crc32(" ".join(words[i:i + k]).encode("utf-8")) for i in range(len(words) - k + 1)}
+        return shingles, set(NUMBER_PATTERN.findall(text.lower()))
+
+    def match_text(self, text: str, label: str) -> str | None:
+        """
+        Label of a previous page with the same text, otherwise None and the page is added to the index as label. Same text: Jaccard
+        similarity of the shingles of at least min_similarity, and no number that is not in the previous page.
+        """
+        features = self.text_features(text)
+        if features is None:
+            return None
+        shingles, numbers = features
+        min_similarity = self.deduplicator.min_similarity
+        with self.lock:
+            for other_label, other_shingles, other_numbers in self.texts:
+                # the similarity can't reach min_similarity if the sizes are too different
+                if min(len(shingles), len(other_shingles)) < min_similarity * max(len(shingles), len(other_shingles)):
+                    continue
+                if numbers <= other_numbers and len(shingles & other_shingles) >= min_similarity * len(shingles | other_shingles):
+                    return other_label
+            self.texts.append((label, shingles, numbers))
+        return None
+
+    def filter_pages(self, text: str, label: str, stats: dict = None) -> str:
+        """
+        Text of an attachment (pages separated by PAGE_BREAK) without the pages that repeat a page seen before in the ticket,
+        replaced by a one line note. Dropped pages and tokens saved go to stats. The page breaks are removed.
+        """
+        pages = text.split(PAGE_BREAK)
+        kept = []
+        for n, page in enumerate(pages, start=1):
+            page_label = f"{label} page {n}" if len(pages) > 1 else label
+            original = self.match_text(page, page_label)
+            if original is None:
+                kept.append(page)
+                continue
+            note = f"[page {n}: same as {original}, not repeated]\n" if len(pages) > 1 else f"[same as {original}, not repeated]\n"
+            add_stat(stats, "dedup_pages_dropped")
+            add_stat(stats, "dedup_tokens_saved", max(0, count_tokens(page, self.deduplicator.model) - count_tokens(note, self.deduplicator.model)))
+            kept.append(note)
+        return "".join(kept)
+
+
+class PageDeduplicator:
+    """
+    Settings of the page deduplication of the attachments of a ticket (see SnowTicket.process_attachments). Shared by all the
+    tickets of a run: every ticket gets its own PageIndex. Pages with fewer than min_words words (e.g. blank) are always kept.
+    """
+    def __init__(self, min_similarity: float = 0.9, words_per_shingle: int = 5, min_words: int = 20, model: str = "gpt-4o"):
+        self.min_similarity = min_similarity
+        self.words_per_shingle = words_per_shingle
+        self.min_words = min_words
+        self.model = model
+
+    def new_index(self) -> PageIndex:
+        return PageIndex(self)
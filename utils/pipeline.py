@@ -0,0 +1,48 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages, each stage with its own bounded thread pool,
+    so that e.g. downloads, OCR and LLM calls of different tickets overlap in time.
+    Results are returned in the same order as the input items.
+    """
+    def __init__(self, stages: list, max_in_flight: int = None):
+        # stages: list of (name, function, number of workers). The output of a stage is the input of the next one
+        self.stages = stages
+        # limit the number of items being processed at the same time, so that memory stays bounded
+        self.max_in_flight = max_in_flight or 2 * sum(workers for _, _, workers in stages)
+        self.executors = []
+
+    def _submit(self, stage_idx: int, value, result: Future):
+        _, fn, _ = self.stages[stage_idx]
+        future = self.executors[stage_idx].submit(fn, value)
+
+        def _on_done(done_future: Future):
+            exception = done_future.exception()
+            if exception is not None:
+                result.set_exception(exception)
+            elif stage_idx + 1 == len(self.stages):
+                result.set_result(done_future.result())
+            else:
+                self._submit(stage_idx + 1, done_future.result(), result)
+
+        future.add_done_callback(_on_done)
+
+    def map(self, items):
+        """Generator yielding the output of the last stage for each item, in input order."""
+        self.executors = [ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name) for name, _, workers in self.stages]
+        in_flight = deque()
+        try:
+            for item in items:
+                if len(in_flight) >= self.max_in_flight:
+                    yield in_flight.popleft().result()
+                result = Future()
+                self._submit(0, item, result)
+                in_flight.append(result)
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for executor in self.executors:
+                executor.shutdown(wait=True, cancel_futures=True)
@@ -1,17 +1,27 @@
-import pytesseract
+# Tesseract, poppler, pandas, python-docx and langdetect are imported inside the functions using them,
+# so importing this module (e.g. for post_process_extracted_text) doesn't load the conversion backends
+import os
 import re
 import json
-import pandas as pd	
-from pdf2image import convert_from_path
-from docx import Document
-from langdetect import detect
+import subprocess
+import sys
+import csv
+import itertools
+from datetime import datetime
+from concurrent.futures import Executor, ProcessPoolExecutor
 from PIL import Image
+from utils.stats import add_stat, append_stat, merge_stats, timer
+from utils.entity_resolver import normalize_entity
+from utils.converters import CONVERTER_VERSION
+from utils.page_dedup import PAGE_BREAK, FINGERPRINT_DPI, ImageFingerprint, PageIndex
 
 # TODO: When using pyteseract OCR, can include part of code to detect angle of the image, sometimes horizontal picture, so need to rotate 90º or 270º. Can be easily implemented with python
-def detect_image_script(image) -> tuple:
+def detect_image_script(image, stats: dict = None) -> tuple:
     """Detects the script used in the image via Tesseract's OSD."""
+    import pytesseract
     try:
-        osd = pytesseract.image_to_osd(image)
+        with timer(stats, "time_osd"):
+            osd = pytesseract.image_to_osd(image)
         script = re.search("Script: ([a-zA-Z]+)\n", osd).group(1)
         conf = float(re.search("Script confidence: (\d+\.?(\d+)?)", osd).group(1))
         return script, conf
@@ -20,6 +30,7 @@ def detect_image_script(image) -> tuple:
 
 def detect_top_scripts(image, top_n=2):
     """Detects the top scripts in the image using Tesseract OSD."""
+    import pytesseract
     try:
         osd = pytesseract.image_to_osd(image)
         
@@ -38,6 +49,7 @@ def detect_top_scripts(image, top_n=2):
 
 def detect_text_language(text) -> str:
     """Detects the language of the extracted text using langdetect."""
+    from langdetect import detect
     try:
         return detect(text)  # Returns language code (e.g., 'en', 'fr', 'ru', etc.)
     except:
@@ -45,10 +57,86 @@ def detect_text_language(text) -> str:
 
 # TODO: Detect multiple languages and return list of languages
 
-def image2text(image: Image) -> str:
-    """Extracts text from an image using Tesseract OCR."""
+# Tesseract language for each script detected by OSD (fast OCR mode)
+SCRIPT_TO_LANG = {
+    "Latin": "eng", "Cyrillic": "rus", "Arabic": "ara", "Devanagari": "hin",
+    "Greek": "ell", "Hebrew": "heb", "Hangul": "kor", "Han": "chi_sim",
+    "Katakana": "jpn", "Tamil": "tam", "Bengali": "ben", "Thai": "tha"
+}
+
+# langdetect returns ISO 639-1 codes ("en", "de", ...), Tesseract expects its own codes ("eng", "deu", ...)
+ISO_TO_TESSERACT_LANG = {
+    "en": "eng", "de": "deu", "fr": "fra", "es": "spa", "it": "ita", "pt": "por", "nl": "nld", "sv": "swe",
+    "da": "dan", "no": "nor", "fi": "fin", "pl": "pol", "cs": "ces", "sk": "slk", "hu": "hun", "ro": "ron",
+    "tr": "tur", "ru": "rus", "uk": "ukr", "el": "ell", "ar": "ara", "he": "heb", "hi": "hin", "ko": "kor",
+    "ja": "jpn", "zh-cn": "chi_sim", "zh-tw": "chi_tra", "ta": "tam", "bn": "ben", "th": "tha"
+}
+# languages written in Latin script: OSD reports them all as "Latin", read by the "eng" pass well enough unless its confidence is low
+LATIN_SCRIPT_LANGS = {"eng", "deu", "fra", "spa", "ita", "por", "nld", "swe", "dan", "nor", "fin", "pol", "ces", "slk", "hun", "ron", "tur"}
+
+def ocr_with_confidence(image, lang: str) -> tuple[str, float]:
+    """Runs a single Tesseract pass returning the text and the mean word confidence (0-100)."""
+    import pytesseract
+    data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+    lines = {}
+    confidences = []
+    for word, conf, block, par, line in zip(data["text"], data["conf"], data["block_num"], data["par_num"], data["line_num"]):
+        conf = float(conf)
+        # conf is -1 for layout elements (blocks, lines...) that are not words
+        if conf < 0 or not word.strip():
+            continue
+        confidences.append(conf)
+        lines.setdefault((block, par, line), []).append(word)
+    # rebuild the text line by line, with an empty line between paragraphs
+    text = ""
+    previous_par = None
+    for (block, par, line), words in lines.items():
+        if previous_par is not None and previous_par != (block, par):
+            text += "\n"
+        text += " ".join(words) + "\n"
+        previous_par = (block, par)
+    mean_conf = sum(confidences) / len(confidences) if confidences else 0.0
+    return text, mean_conf
+
+def image2text_fast(image, min_confidence: float = 60.0, stats: dict = None) -> str:
+    """
+    Single-pass OCR: one Tesseract pass with the language of the script detected by OSD.
+    The image is OCR'd a second time only if the mean word confidence is below min_confidence
+    or the language detected in the text is not covered by the first pass. The "eng" pass of a Latin-script page
+    covers all the Latin-script languages (German, French, ...): their own language is only used if the confidence is low.
+    """
+    script, conf = detect_image_script(image, stats=stats)
+    ocr_lang = SCRIPT_TO_LANG.get(script, "eng")
+    if ocr_lang != "eng":
+        ocr_lang += "+eng"
+    with timer(stats, "time_ocr_pass"):
+        extracted_text, mean_conf = ocr_with_confidence(image, ocr_lang)
+    add_stat(stats, "ocr_passes")
+
+    detected_lang = ISO_TO_TESSERACT_LANG.get(detect_text_language(extracted_text))
+    in_first_pass = detected_lang is None or detected_lang in ocr_lang.split("+")
+    language_changed = not in_first_pass and not (ocr_lang == "eng" and detected_lang in LATIN_SCRIPT_LANGS)
+    if not language_changed and mean_conf >= min_confidence:
+        return extracted_text
+
+    rerun_lang = detected_lang + "+eng" if not in_first_pass else ocr_lang
+    if in_first_pass:
+        # same language but low confidence: also try Chinese, as in the full mode
+        rerun_lang += "+chi_sim" if "chi_sim" not in rerun_lang else ""
+    with timer(stats, "time_ocr_pass"):
+        rerun_text, rerun_conf = ocr_with_confidence(image, rerun_lang)
+    add_stat(stats, "ocr_passes")
+    add_stat(stats, "ocr_reruns")
+    # keep the pass with the highest confidence
+    return rerun_text if rerun_conf >= mean_conf else extracted_text
+
+def image2text(image: Image, ocr_mode: str = "full", min_confidence: float = 60.0, stats: dict = None) -> str:
+    """Extracts text from an image using Tesseract OCR. ocr_mode "fast" does a single pass (see image2text_fast)."""
+    if ocr_mode == "fast":
+        return image2text_fast(image, min_confidence=min_confidence, stats=stats)
+    import pytesseract
     # Step 1: Detect script
-    script, conf = detect_image_script(image)
+    script, conf = detect_image_script(image, stats=stats)
         
     # Step 2: Map script to OCR language
     script_to_lang = {
@@ -63,7 +151,8 @@ def image2text(image: Image) -> str:
         ocr_lang += "+eng"
 
     # Step 3: Perform OCR with detected script's language
-    extracted_text = pytesseract.image_to_string(image, lang=ocr_lang)
+    with timer(stats, "time_ocr_pass"):
+        extracted_text = pytesseract.image_to_string(image, lang=ocr_lang)
     
     # Step 4: Detect final language of text
     detected_lang = detect_text_language(extracted_text)
@@ -72,23 +161,242 @@ def image2text(image: Image) -> str:
     if detected_lang != "eng":
         detected_lang += "+eng"
     # Step 5: Perform OCR with final detected language
-    final_extracted_text = pytesseract.image_to_string(image, lang=detected_lang)
+    with timer(stats, "time_ocr_pass"):
+        final_extracted_text = pytesseract.image_to_string(image, lang=detected_lang)
+    add_stat(stats, "ocr_passes", 2)
     # print(f"Script: {script} (Confidence: {conf}) -> OCR Lang: {ocr_lang} -> Detected Lang: {detected_lang}")
     return final_extracted_text
 
 
-def pdf2text(file_path: str) -> str:
-    """Extracts text from a PDF with automated script & language detection."""
-    text = ""
-    images = convert_from_path(file_path)
+def create_ocr_pool(max_workers: int = None) -> ProcessPoolExecutor:
+    """Creates a process pool to OCR PDF pages in parallel. The same pool can be shared by the attachments of several tickets."""
+    return ProcessPoolExecutor(max_workers=max_workers)
 
-    for img in images:
-        text += image2text(img) + "\n"
+def preload_ocr_backends(_=None) -> int:
+    """Imports the OCR backends (e.g. in the processes of an OCR pool, so the first pages don't pay for it). Returns the process id."""
+    import pytesseract, pdf2image, langdetect
+    return os.getpid()
+
+def page_sizes(pdf_info: dict) -> dict:
+    """Size in points (width, height) of every page listed by pdfinfo -f/-l ("Page    1 size: 595 x 842 pts (A4)")."""
+    sizes = {}
+    for key, value in pdf_info.items():
+        match = re.match(r"Page\s+(\d+) size", key)
+        size = re.match(r"([\d.]+) x ([\d.]+)", value) if match else None
+        if size:
+            sizes[int(match.group(1))] = (float(size.group(1)), float(size.group(2)))
+    return sizes
+
+def text_line_height(image: Image) -> float | None:
+    """Median height in pixels of the text lines of a grayscale image (rows with ink between blank rows), None if no lines are found."""
+    import numpy as np
+    ink = np.asarray(image.convert("L")) < 128
+    # vertical rules of tables would join all the lines in a single run
+    ink = ink[:, ink.mean(axis=0) < 0.5]
+    if ink.size == 0:
+        return None
+    inked_rows = ink.mean(axis=1) > 0.002
+    # starts and ends of the runs of inked rows
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], inked_rows.astype(np.int8), [0]))))
+    heights = edges[1::2] - edges[::2]
+    # runs of 1-2 rows are rules or noise, not text
+    heights = heights[heights >= 3]
+    return float(np.median(heights)) if heights.size else None
+
+def choose_dpi(file_path: str, page_number: int, page_size: tuple = None, base_dpi: int = 200, min_dpi: int = 150, max_dpi: int = 300,
+               target_line_px: int = 32, max_pixels: int = 20_000_000) -> int:
+    """
+    DPI to rasterize a page for OCR: the text lines are measured on a 72 DPI thumbnail (1 pixel = 1 point) and the DPI is chosen so that
+    they are about target_line_px pixels high, which is where Tesseract is most accurate (small print gets more DPI, large print less).
+    Large pages (drawings, A3) are capped at max_pixels, so a single page can't take more than ~max_pixels bytes in grayscale.
+    """
+    from pdf2image import convert_from_path
+    dpi = base_dpi
+    thumbnail = convert_from_path(file_path, dpi=72, first_page=page_number, last_page=page_number, grayscale=True)[0]
+    try:
+        line_height = text_line_height(thumbnail)
+        if page_size is None:
+            page_size = thumbnail.size
+    finally:
+        thumbnail.close()
+    if line_height is not None:
+        dpi = int(round(target_line_px * 72 / line_height / 25) * 25)
+    dpi = max(min_dpi, min(max_dpi, dpi))
+    width_in, height_in = page_size[0] / 72, page_size[1] / 72
+    max_dpi_for_size = int((max_pixels / (width_in * height_in)) ** 0.5)
+    return max(72, min(dpi, max_dpi_for_size))
+
+def process_peak_rss_mb() -> float | None:
+    """Peak resident memory of the current process in MB (None if it can't be read on this platform)."""
+    try:
+        import resource
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / 2**20, 1)
+    except (ImportError, AttributeError):
+        return None
+
+def ocr_pdf_page(file_path: str, page_number: int, ocr_mode: str = "full", min_confidence: float = 60.0, dpi: int | str = 200, page_size: tuple = None) -> tuple[str, dict]:
+    """
+    Rasterizes a single page of a PDF (1-based) in grayscale and extracts its text. dpi="adaptive" chooses the DPI from the
+    size of the page and of its text (see choose_dpi). The page image is released before returning, so only one page per
+    process is in memory. Runs in a worker process when a pool is used, so the stats of the page are returned instead of updated in place.
+    """
+    from pdf2image import convert_from_path
+    page_stats = {}
+    with timer(page_stats, "time_rasterize"):
+        if dpi == "adaptive":
+            dpi = choose_dpi(file_path, page_number, page_size)
+        image = convert_from_path(file_path, dpi=dpi, first_page=page_number, last_page=page_number, grayscale=True)[0]
+    try:
+        append_stat(page_stats, "pdf_page_dpi", dpi)
+        append_stat(page_stats, "pdf_page_image_mb", round(image.width * image.height * len(image.getbands()) / 2**20, 1))
+        text = image2text(image, ocr_mode=ocr_mode, min_confidence=min_confidence, stats=page_stats)
+    finally:
+        image.close()
+    peak_rss_mb = process_peak_rss_mb()
+    if peak_rss_mb is not None:
+        append_stat(page_stats, "pdf_page_peak_rss_mb", peak_rss_mb)
+    return text, page_stats
+
+def extract_text_layer(file_path: str) -> list:
+    """Returns the embedded text of each page of a PDF using poppler's pdftotext (installed with pdf2image). Empty list if it fails."""
+    try:
+        result = subprocess.run(["pdftotext", "-layout", "-enc", "UTF-8", file_path, "-"], capture_output=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    if result.returncode != 0:
+        return []
+    # pages are separated by form feeds
+    return result.stdout.decode("utf-8", errors="replace").split("\f")
+
+def has_usable_text(text: str, min_chars: int = 50, min_alnum_ratio: float = 0.5) -> bool:
+    """
+    Decides if the embedded text of a page can be used instead of OCR.
+    Scanned pages have no text (or a few characters), and PDFs with broken font encodings produce mostly symbols.
+    """
+    chars = "".join(text.split())
+    if len(chars) < min_chars:
+        return False
+    alnum_ratio = sum(c.isalnum() for c in chars) / len(chars)
+    return alnum_ratio >= min_alnum_ratio and chars.count("\ufffd") / len(chars) < 0.05
+
+def fingerprint_pdf_pages(file_path: str, page_numbers: list, batch_size: int = 20) -> dict:
+    """Perceptual fingerprints of some pages of a PDF, rasterized at FINGERPRINT_DPI batch_size pages at a time."""
+    from pdf2image import convert_from_path
+    fingerprints = {}
+    for start in range(0, len(page_numbers), batch_size):
+        batch = page_numbers[start:start + batch_size]
+        images = convert_from_path(file_path, dpi=FINGERPRINT_DPI, first_page=batch[0], last_page=batch[-1], grayscale=True)
+        for page_number, image in zip(range(batch[0], batch[-1] + 1), images):
+            if page_number in batch:
+                fingerprints[page_number] = ImageFingerprint(image)
+            image.close()
+    return fingerprints
+
+def pdf2text(file_path: str, ocr_pool: Executor = None, use_text_layer: bool = True, ocr_mode: str = "full", min_confidence: float = 60.0, stats: dict = None, dpi: int | str = 200, max_pages: int = None,
+             page_index: PageIndex = None) -> str:
+    """
+    Extracts text from a PDF with automated script & language detection.
+    Pages of digitally generated PDFs that have usable embedded text are extracted directly; the rest of pages are
+    rasterized (at dpi, or "adaptive", see ocr_pdf_page) and OCR'd one by one, in parallel if an ocr_pool is given. Page order is preserved,
+    and a page that fails is replaced by an error note instead of losing the whole document. Pages are separated by PAGE_BREAK.
+    With a page_index, a page to OCR that looks the same as a page seen before in the ticket (perceptual hash) takes its text instead.
+    Only the first max_pages pages are converted. The method used for each page is recorded in stats.
+    """
+    from pdf2image import pdfinfo_from_path
+    pdf_info = pdfinfo_from_path(file_path, first_page=1, last_page=max_pages or 100000)
+    n_pages = pdf_info["Pages"]
+    sizes = page_sizes(pdf_info)
+    text_layer = extract_text_layer(file_path) if use_text_layer else []
+    file_name = os.path.basename(file_path)
+
+    pages = {}
+    for page_number in range(1, min(n_pages, max_pages or n_pages) + 1):
+        if page_number <= len(text_layer) and has_usable_text(text_layer[page_number - 1]):
+            pages[page_number] = text_layer[page_number - 1]
+        else:
+            pages[page_number] = None
+    # pages to OCR: the ones looking like a page seen before (in this PDF or in a previous attachment) are not OCR'd
+    image_pages, duplicates = {}, {}
+    ocr_pages = [page_number for page_number, page in pages.items() if page is None]
+    if page_index is not None and ocr_pages:
+        try:
+            with timer(stats, "time_page_fingerprint"):
+                fingerprints = fingerprint_pdf_pages(file_path, ocr_pages)
+        except Exception as e:
+            print(f"WARNING: pages of {file_path} could not be fingerprinted, all of them are OCR'd: {e}")
+            fingerprints = {}
+        for page_number, fingerprint in fingerprints.items():
+            original = page_index.find_image(fingerprint)
+            if original is not None:
+                duplicates[page_number] = original
+            else:
+                image_pages[page_number] = page_index.add_image(fingerprint, f"{file_name} p{page_number}", source=file_path)
+    if ocr_pool is not None:
+        for page_number in ocr_pages:
+            if page_number not in duplicates:
+                pages[page_number] = ocr_pool.submit(ocr_pdf_page, file_path, page_number, ocr_mode, min_confidence, dpi, sizes.get(page_number))
+
+    text = ""
+    for page_number, page in pages.items():
+        if isinstance(page, str):
+            page_text, method = page, "text_layer"
+        elif page_number in duplicates and duplicates[page_number].text is not None:
+            page_text, method = duplicates[page_number].text, "duplicate"
+            if duplicates[page_number].source != file_path:
+                # text of another file: this conversion is not cached (see utils/cache.py)
+                add_stat(stats, "dedup_text_borrowed")
+        else:
+            method = "ocr"
+            try:
+                page_text, page_stats = page.result() if page is not None else ocr_pdf_page(file_path, page_number, ocr_mode, min_confidence, dpi, sizes.get(page_number))
+                merge_stats(stats, page_stats)
+            except Exception as e:
+                print(f"WARNING: OCR failed on page {page_number} of {file_path}: {e}")
+                page_text = f"**ERROR: page {page_number} could not be converted to text**"
+                method = "error"
+            if method == "ocr" and page_number in image_pages:
+                image_pages[page_number].text = page_text
+        add_stat(stats, f"pdf_pages_{method}")
+        append_stat(stats, "pdf_page_methods", f"{file_name} p{page_number}: {method}")
+        text += (PAGE_BREAK if text else "") + page_text + "\n"
+    if max_pages is not None and n_pages > max_pages:
+        add_stat(stats, "pdf_pages_skipped", n_pages - max_pages)
+        text += f"[pages {max_pages + 1}-{n_pages} not converted: limit of {max_pages} pages per attachment]\n"
 
     return text
 
+def index_pdf_pages(file_path: str, text: str, page_index: PageIndex, use_text_layer: bool = True, stats: dict = None):
+    """
+    Registers in page_index the pages of a PDF converted before (text of pdf2text, e.g. from the conversion cache) that pdf2text would OCR,
+    so the next attachments of the ticket are deduplicated against them as if the PDF had just been converted.
+    """
+    # the note on the pages over max_pages is not part of the last page
+    pages = re.sub(r"\[pages \d+-\d+ not converted: [^\]]*\]\n$", "", text).split(PAGE_BREAK)
+    text_layer = extract_text_layer(file_path) if use_text_layer else []
+    ocr_pages = [page_number for page_number in range(1, len(pages) + 1) if not (page_number <= len(text_layer) and has_usable_text(text_layer[page_number - 1]))]
+    if not ocr_pages:
+        return
+    try:
+        with timer(stats, "time_page_fingerprint"):
+            fingerprints = fingerprint_pdf_pages(file_path, ocr_pages)
+    except Exception as e:
+        print(f"WARNING: pages of {file_path} could not be fingerprinted: {e}")
+        return
+    for page_number, fingerprint in fingerprints.items():
+        if page_index.find_image(fingerprint) is None:
+            page = page_index.add_image(fingerprint, f"{os.path.basename(file_path)} p{page_number}", source=file_path)
+            page.text = pages[page_number - 1].removesuffix("\n")
+
 def word_to_text(file_path: str) -> str:
     """Extracts text from a Word document."""
+    from docx import Document
     doc = Document(file_path)
     text = "\n".join([para.text for para in doc.paragraphs])
     return text
@@ -98,51 +406,147 @@ def detect_table(df):
     Detects the table header dynamically and removes summary rows.
     Returns the cleaned DataFrame.
     """
-    # Step 1: Detect header row (first row with at least 50% non-empty values)
-    for i, row in df.iterrows():
-        non_null_count = row.count()  # Count non-null values
-        total_count = len(row)
-        if non_null_count / total_count > 0.5:  # At least 50% non-empty
-            header_row = i
-            break
+    import pandas as pd
+    # Step 0: Drop empty rows and columns (formatted but empty cells of Excel sheets)
+    df = df.dropna(axis=0, how="all").dropna(axis=1, how="all")
+    if df.empty:
+        return df
 
-    # Step 2: Extract table from header onward
-    detected_table = df.iloc[header_row:].reset_index(drop=True)
+    # Step 1: Detect header row (first row with more than 50% non-empty values, first row if none)
+    filled = df.notna().sum(axis=1).to_numpy() / df.shape[1] > 0.5
+    header_row = int(filled.argmax()) if filled.any() else 0
 
-    # Step 3: Set first row as header
-    detected_table.columns = detected_table.iloc[0]
-    detected_table = detected_table[1:].reset_index(drop=True)
+    # Step 2: Set the header row as header, keeping the rows below
+    header = [str(value).strip() if pd.notna(value) else f"column_{n + 1}" for n, value in enumerate(df.iloc[header_row])]
+    detected_table = df.iloc[header_row + 1:].reset_index(drop=True)
+    detected_table.columns = header
 
-    # Step 4: Remove summary rows (rows with >50% NaN values)
+    # Step 3: Remove summary rows (rows with >50% NaN values)
     detected_table = detected_table.dropna(thresh=len(detected_table.columns) * 0.5)
 
     return detected_table
 
-def tabular_to_text(file_path) -> str:
+def _sniff_csv(file_path: str) -> tuple[str, str]:
+    """Encoding and delimiter of a CSV file, guessed from its first 64 KB."""
+    with open(file_path, "rb") as file:
+        sample = file.read(65536)
+    encoding = "utf-8-sig"
+    try:
+        sample = sample.decode(encoding)
+    except UnicodeDecodeError as e:
+        # a sample cut in the middle of a character is still UTF-8
+        if e.start < len(sample) - 3:
+            encoding = "latin-1"
+        sample = sample[:e.start].decode(encoding) if encoding != "latin-1" else sample.decode(encoding)
+    try:
+        delimiter = csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        delimiter = ","
+    return encoding, delimiter
+
+def read_table_sheets(file_path: str, max_rows: int = 5000, max_cols: int = 50, file_format: str = None) -> list:
     """
-    Reads an Excel or CSV file, detects the table, removes summary rows, 
-    and converts it into a JSON string.
+    Reads the sheets of a CSV/XLSX/XLS/XLSB file without headers, at most max_rows rows and max_cols columns each.
+    CSV and XLSX files are streamed row by row (openpyxl read-only mode), so large files never have to fit in memory.
+    file_format (csv, xlsx, xls or xlsb) defaults to the extension of the file.
+    Returns (sheet name, DataFrame, True if rows were left out) for every sheet.
     """
-    # Read CSV or Excel file
-    if file_path.lower().endswith(".csv"):
-        df = pd.read_csv(file_path, header=None)
+    import pandas as pd
+    extension = file_format or file_path.lower().rsplit(".", 1)[-1]
+    sheets = []
+    if extension == "csv":
+        encoding, delimiter = _sniff_csv(file_path)
+        with open(file_path, "r", encoding=encoding, errors="replace", newline="") as file:
+            rows = [row[:max_cols] for row in itertools.islice(csv.reader(file, delimiter=delimiter), max_rows + 1)]
+        sheets.append(("csv", rows))
+    elif extension in ["xlsx", "xlsm"]:
+        from openpyxl import load_workbook
+        # opened as a file object, openpyxl refuses paths without an Excel extension
+        with open(file_path, "rb") as file:
+            workbook = load_workbook(file, read_only=True, data_only=True)
+            try:
+                for worksheet in workbook.worksheets:
+                    sheets.append((worksheet.title, list(itertools.islice(worksheet.iter_rows(max_col=max_cols, values_only=True), max_rows + 1))))
+            finally:
+                workbook.close()
     else:
-        df = pd.read_excel(file_path, engine="pyxlsb" if file_path.endswith(".xlsb") else None,header=None)
+        frames = pd.read_excel(file_path, engine="pyxlsb" if extension == "xlsb" else None, header=None, sheet_name=None, nrows=max_rows + 1)
+        sheets = [(name, frame.iloc[:, :max_cols].values.tolist()) for name, frame in frames.items()]
+    tables = []
+    for name, rows in sheets:
+        df = pd.DataFrame(rows[:max_rows], dtype=object)
+        # empty strings of CSV files are missing values, like empty cells of Excel files
+        df = df.replace("", None) if not df.empty else df
+        tables.append((name, df, len(rows) > max_rows))
+    return tables
 
-    # Detect and clean the table
-    df = detect_table(df)
+def _format_cell(value):
+    # dates without time as YYYY-MM-DD and integral floats (e.g. invoice numbers read as 12345.0) without decimals
+    if isinstance(value, datetime) and value.time() == datetime.min.time():
+        return value.date().isoformat()
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return int(value)
+    return value
 
-    # Convert DataFrame to dictionary
-    data_dict = df.to_dict(orient="records")  # List of dictionaries (row-wise)
+def tabular_to_text(file_path, max_rows: int = 5000, max_cols: int = 50, file_format: str = None) -> str:
+    """
+    Reads an Excel or CSV file (every sheet), detects the table, removes summary rows,
+    and converts it into compact CSV text (one line per row), capped at max_rows rows and max_cols columns per sheet.
+    """
+    texts = []
+    tables = read_table_sheets(file_path, max_rows=max_rows, max_cols=max_cols, file_format=file_format)
+    for name, df, truncated in tables:
+        # Detect and clean the table
+        df = detect_table(df)
+        if df.empty:
+            continue
+        text = df.map(_format_cell).to_csv(index=False, lineterminator="\n")
+        if truncated:
+            text += f"[only the first {max_rows} rows were read]\n"
+        texts.append(f"SHEET {name}:\n{text}" if len(tables) > 1 else text)
+    return "\n".join(texts)
 
-    # Convert dictionary to JSON string --> can fail for instance if date in header TODO: fix
-    json_str = json.dumps(data_dict, indent=4, ensure_ascii=False, default=str)
-    return json_str
+def merge_extracted_texts(texts: list) -> str:
+    """
+    Merges the outputs of the LLM for the chunks of a ticket that was too long to be processed in one request.
+    The first known vendor code/name is kept and the lists of invoices, POs and delivery notes are concatenated without duplicates.
+    The merged output has the same format as a single output, so it can be post-processed with post_process_extracted_text.
+    """
+    merged = {"vendor_code": "NaN", "vendor_name": "NaN", "invoices": [], "po_numbers": [], "delivery_notes": []}
+    parsed_any = False
+    for text in texts:
+        try:
+            extracted = json.loads(text.replace("(", "[").replace(")", "]"))
+        except json.JSONDecodeError:
+            # truncated/invalid output of a chunk: keep what the other chunks found
+            continue
+        parsed_any = True
+        for key in ["vendor_code", "vendor_name"]:
+            if merged[key] in ["NaN", ""] and extracted.get(key) not in [None, "NaN", ""]:
+                merged[key] = extracted[key]
+        for key in ["invoices", "po_numbers", "delivery_notes"]:
+            for value in extracted.get(key, []):
+                if value not in merged[key]:
+                    merged[key].append(value)
+    if not parsed_any:
+        # no chunk could be parsed: return the raw outputs so the error is visible in the log
+        return "\n".join(texts)
+    return json.dumps(merged, indent=4, ensure_ascii=False)
 
-def post_process_extracted_text(text, vcc_entity):
+def post_process_extracted_text(text, vcc_entity, entity_resolver=None):
     # Convert JSON-like string to a Python dictionary
     text = json.loads(text.replace("(", "[").replace(")", "]"))
 
+    # with an EntityResolver, entities are replaced by their canonical name + company code and rows are compared on the code,
+    # so spelling variants of the same entity ("Volvo Cars Germany, GMBH" / "Volvo Cars Germany") don't make duplicate rows
+    def resolve_row(invoice_reference, fiscal_year, entity):
+        if entity_resolver is None:
+            return (invoice_reference, fiscal_year, entity), (invoice_reference, fiscal_year, entity)
+        match = entity_resolver.resolve(entity)
+        if match is None:
+            return (invoice_reference, fiscal_year, entity, "NaN"), (invoice_reference, fiscal_year, normalize_entity(entity))
+        return (invoice_reference, fiscal_year, match.entity, match.code), (invoice_reference, fiscal_year, match.code)
+
     # Use a set to track unique rows
     unique_invoices = set()
 
@@ -160,18 +564,18 @@ def post_process_extracted_text(text, vcc_entity):
             invoice[2] = vcc_entity
 
         # Add the original invoice if it's unique
-        invoice_tuple = tuple(invoice)
-        if invoice_tuple not in unique_invoices:
-            unique_invoices.add(invoice_tuple)
-            cleaned_invoices.append(invoice_tuple)
+        invoice_row, invoice_key = resolve_row(invoice[0], invoice[1], invoice[2])
+        if invoice_key not in unique_invoices:
+            unique_invoices.add(invoice_key)
+            cleaned_invoices.append(invoice_row)
 
         # If invoice[2] is not vcc_entity, add a new modified row
         # this way we ensure to have invoices with the entity provided by supplier and with the entity detected in attachments
         if invoice[2] != vcc_entity:
-            modified_invoice = (invoice[0], invoice[1], vcc_entity)
-            if modified_invoice not in unique_invoices:
-                unique_invoices.add(modified_invoice)
-                cleaned_invoices.append(modified_invoice)
+            modified_row, modified_key = resolve_row(invoice[0], invoice[1], vcc_entity)
+            if modified_key not in unique_invoices:
+                unique_invoices.add(modified_key)
+                cleaned_invoices.append(modified_row)
 
     # Update the dictionary with cleaned invoices
     text['invoices'] = cleaned_invoices
@@ -0,0 +1,122 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+def estimate_tokens(messages: list, max_output_tokens: int = 0) -> int:
+    """Rough token estimate (~4 characters per token) used to reserve quota before a request."""
+    n_chars = sum(len(message["content"]) for message in messages)
+    return n_chars // 4 + max_output_tokens
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter for the requests-per-minute (RPM) and tokens-per-minute (TPM) quotas of an Azure OpenAI deployment.
+    Both buckets refill continuously; a request waits until both buckets can cover it.
+    """
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.blocked_until = 0.0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.requests_per_minute is not None:
+            self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _time_to_wait(self, n_tokens: int) -> float:
+        # seconds until both buckets (and any Retry-After pause) allow the request
+        wait = max(0.0, self.blocked_until - time.monotonic())
+        if self.requests_per_minute is not None and self.available_requests < 1:
+            wait = max(wait, (1 - self.available_requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute is not None and self.available_tokens < n_tokens:
+            wait = max(wait, (n_tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, n_tokens: int = 0) -> float:
+        """Blocks until the request fits in the quota, reserves it and returns the seconds waited."""
+        if self.tokens_per_minute is not None:
+            # a single request can never reserve more than the full bucket
+            n_tokens = min(n_tokens, self.tokens_per_minute)
+        start_time = time.monotonic()
+        while True:
+            with self.lock:
+                self._refill()
+                wait = self._time_to_wait(n_tokens)
+                if wait <= 0:
+                    if self.requests_per_minute is not None:
+                        self.available_requests -= 1
+                    if self.tokens_per_minute is not None:
+                        self.available_tokens -= n_tokens
+                    return time.monotonic() - start_time
+            time.sleep(wait)
+
+    def time_to_wait(self, n_tokens: int = 0) -> float:
+        """Seconds a request of n_tokens would wait now (0 if it fits in the quota), without reserving anything."""
+        if self.tokens_per_minute is not None:
+            n_tokens = min(n_tokens, self.tokens_per_minute)
+        with self.lock:
+            self._refill()
+            return self._time_to_wait(n_tokens)
+
+    def headroom(self) -> float:
+        """Share (0-1) of the quota available now: the emptiest of the two buckets, 1 without quotas."""
+        with self.lock:
+            self._refill()
+            shares = [1.0]
+            if self.requests_per_minute is not None:
+                shares.append(max(0.0, self.available_requests / self.requests_per_minute))
+            if self.tokens_per_minute is not None:
+                shares.append(max(0.0, self.available_tokens / self.tokens_per_minute))
+            return min(shares)
+
+    def adjust(self, reserved_tokens: int, used_tokens: int):
+        """Corrects the token bucket once the real usage of a request is known."""
+        if self.tokens_per_minute is None:
+            return
+        with self.lock:
+            self._refill()
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + reserved_tokens - used_tokens)
+
+    def pause(self, seconds: float):
+        """Stops handing out quota for `seconds`, e.g. after the service answered with a 429 and Retry-After."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def is_rate_limit_error(exception: Exception) -> bool:
+    return getattr(exception, "status_code", None) == 429
+
+
+def get_retry_after(exception: Exception) -> float | None:
+    """Reads the Retry-After (or retry-after-ms) header of a failed request, in seconds."""
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Retry-After can also be an HTTP date
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
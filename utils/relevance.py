@@ -0,0 +1,99 @@
+import re
+from utils.stats import add_stat
+from utils.tokens import count_tokens, FILE_HEADER_PATTERN, FILE_TITLE_PATTERN
+
+# keywords next to the entities we extract, in the languages of the suppliers (en, de, fr, es, it, pt, nl, sv, da/no, pl, fi, cs, hu, tr, zh, ja)
+ANCHOR_KEYWORDS = [
+    # invoices
+    r"invoice", r"inv\.? ?(?:no|nr|#)", r"bill(?:ing)? (?:no|number)", r"rechnung", r"facture", r"factura", r"fattura", r"fatura",
+    r"faktura", r"factuur", r"lasku", r"sz[aá]mla", r"发票", r"請求書", r"credit ?note", r"gutschrift", r"avoir", r"nota de cr[eé]dito",
+    # references and document numbers
+    r"referenz", r"r[eé]f[eé]rence", r"referencia", r"riferimento", r"referens", r"beleg", r"document (?:no|number)",
+    # purchase orders
+    r"purchase order", r"\bP\.?O\.?\b", r"order (?:no|nr|number)", r"bestell", r"commande", r"pedido", r"ordine", r"ordem de compra",
+    r"ink[öo]psorder", r"best[äa]llning", r"zam[óo]wieni", r"objedn[aá]vk", r"tilaus", r"sipari[sş]", r"注文", r"订单",
+    # delivery notes
+    r"delivery note", r"\bD\.?N\.?\b", r"lieferschein", r"bon de livraison", r"albar[aá]n", r"bolla", r"guia de remessa",
+    r"pakbon", r"f[öo]ljesedel", r"f[øo]lgeseddel", r"dokument dostawy", r"dodac[ií] list", r"l[äa]hetysluettelo", r"irsaliye", r"送货单", r"納品書",
+    # vendors
+    r"vendor", r"supplier", r"lieferant", r"kreditor", r"fournisseur", r"proveedor", r"fornitore", r"fornecedor", r"leverancier",
+    r"leverant[öo]r", r"leverand[øo]r", r"dostawca", r"toimittaja", r"dodavatel", r"sz[aá]ll[ií]t[oó]", r"tedarik[cç]i", r"供应商", r"仕入先",
+    # fiscal year and Volvo entities
+    r"fiscal year", r"gesch[äa]ftsjahr", r"exercice", r"ejercicio", r"volvo",
+]
+ANCHOR_PATTERN = re.compile("|".join(ANCHOR_KEYWORDS), re.IGNORECASE)
+# document numbers: letters and at least 4 digits (e.g. INV-2025/0042, DN123456), or a run of 6+ digits without separators (e.g. 4500123456).
+# Dates and amounts (digits split by "/", "-", "." or ",") are not identifiers, otherwise every line of a ledger or statement would match
+IDENTIFIER_PATTERN = re.compile(r"\b(?:(?=[A-Z0-9\-/]*[A-Z])(?=(?:[A-Z\-/]*\d){4})[A-Z0-9][A-Z0-9\-/]{4,}|\d{6,})\b", re.IGNORECASE)
+DROPPED_MARKER = "[...]"
+
+
+class RelevanceFilter:
+    """
+    Shrinks the attachments of a ticket before the LLM call, keeping only windows of context_lines lines around lines with
+    anchor keywords (invoice, PO, delivery note, vendor... in several languages) or document identifiers, plus the first
+    header_lines lines of every file (letterhead with the vendor name). Dropped lines are replaced by "[...]".
+    Tickets under min_tokens are not filtered. If more than max_reduction of the tokens would be dropped, the windows are widened
+    until enough text is kept, and the full text is kept if no line matches at all (e.g. OCR text without recognizable anchors).
+    """
+    def __init__(self, context_lines: int = 3, header_lines: int = 8, max_reduction: float = 0.95, min_tokens: int = 2000, model: str = "gpt-4o"):
+        self.context_lines = context_lines
+        self.header_lines = header_lines
+        self.max_reduction = max_reduction
+        self.min_tokens = min_tokens
+        self.model = model
+
+    def filter_section(self, section: str, context_lines: int) -> tuple[str, int]:
+        """Filters the text of one attachment. Returns the filtered text and the number of matching lines."""
+        title_match = FILE_TITLE_PATTERN.match(section)
+        title = title_match.group(0) if title_match else ""
+        lines = section[len(title):].split("\n")
+        keep = [False] * len(lines)
+        hits = 0
+        for n, line in enumerate(lines):
+            if n < self.header_lines:
+                keep[n] = True
+            if ANCHOR_PATTERN.search(line) or IDENTIFIER_PATTERN.search(line):
+                hits += 1
+                for m in range(max(0, n - context_lines), min(len(lines), n + context_lines + 1)):
+                    keep[m] = True
+        kept_lines = []
+        for n, line in enumerate(lines):
+            if keep[n]:
+                kept_lines.append(line)
+            elif not kept_lines or kept_lines[-1] != DROPPED_MARKER:
+                kept_lines.append(DROPPED_MARKER)
+        filtered = title + "\n".join(kept_lines)
+        # keep the blank lines separating the attachments
+        if section.endswith("\n\n") and not filtered.endswith("\n\n"):
+            filtered += "\n\n"
+        return filtered, hits
+
+    def apply(self, attachments_text: str, stats: dict = None) -> str:
+        """Returns the filtered text of the attachments of a ticket (FILE sections). Tokens before/after and fallbacks go to stats."""
+        tokens_before = count_tokens(attachments_text, self.model)
+        add_stat(stats, "relevance_tokens_before", tokens_before)
+        if tokens_before < self.min_tokens:
+            add_stat(stats, "relevance_tokens_after", tokens_before)
+            return attachments_text
+        starts = [m.start() for m in FILE_HEADER_PATTERN.finditer(attachments_text)] or [0]
+        if starts[0] != 0:
+            starts = [0] + starts
+        sections = [attachments_text[start:end] for start, end in zip(starts, starts[1:] + [len(attachments_text)])]
+        context_lines = self.context_lines
+        while True:
+            filtered_sections = [self.filter_section(section, context_lines) for section in sections]
+            total_hits = sum(hits for _, hits in filtered_sections)
+            filtered_text = "".join(filtered for filtered, _ in filtered_sections)
+            tokens_after = count_tokens(filtered_text, self.model)
+            # too few tokens left: widen the windows around the matches
+            if total_hits == 0 or tokens_after >= tokens_before * (1 - self.max_reduction) or context_lines >= 64:
+                break
+            context_lines = max(2 * context_lines, 1)
+        if total_hits == 0:
+            # safety fallback: nothing recognizable, better to pay for the full text than to lose the entities
+            add_stat(stats, "relevance_fallbacks")
+            add_stat(stats, "relevance_tokens_after", tokens_before)
+            return attachments_text
+        add_stat(stats, "relevance_tokens_after", tokens_after)
+        return filtered_text
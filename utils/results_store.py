@@ -0,0 +1,154 @@
+import sys
+from pathlib import Path
+# Set sys.path to include the project root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import argparse
+import glob
+import gzip
+import json
+import os
+import pandas as pd
+
+STORE_DIR = "results"
+PENDING_FILE = "pending.jsonl"
+INDEX_FILE = "index.jsonl"
+SHARD_EXTENSIONS = {"parquet": ".parquet", "jsonl": ".jsonl.gz"}
+
+def _read_jsonl(path: str, opener=open) -> list:
+    rows = []
+    if not os.path.exists(path):
+        return rows
+    with opener(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                # last line of a run killed while writing
+                continue
+    return rows
+
+def _read_shard(path: str, columns: list = None, ticket: str = None) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns, filters=[("ticket", "==", ticket)] if ticket is not None else None)
+    data = pd.DataFrame(_read_jsonl(path, opener=gzip.open))
+    if ticket is not None and not data.empty:
+        data = data[data["ticket"] == ticket]
+    return data[[column for column in columns if column in data.columns]] if columns is not None and not data.empty else data
+
+
+class ResultsStore:
+    """
+    Results of a run (extracted entities, LLM input/output and metrics of every ticket) in compressed columnar shards
+    in <run folder>/results, instead of one folder with text files per ticket.
+    Every ticket is first appended to pending.jsonl (flushed, so nothing is lost if the run is killed). Every shard_size tickets
+    the pending rows are written as a shard (part-00000.parquet with zstd, or part-00000.jsonl.gz) and their tickets added to
+    index.jsonl, so a single ticket can be loaded without reading the whole run (see load_ticket).
+    """
+    def __init__(self, results_path: str, format: str = "parquet", shard_size: int = 1000):
+        if format not in SHARD_EXTENSIONS:
+            raise ValueError(f"Unknown results store format {format}. Pick between {', '.join(SHARD_EXTENSIONS)}")
+        self.format = format
+        self.shard_size = shard_size
+        self.path = os.path.join(results_path, STORE_DIR)
+        os.makedirs(self.path, exist_ok=True)
+        self.pending_path = os.path.join(self.path, PENDING_FILE)
+        self.index_path = os.path.join(self.path, INDEX_FILE)
+        # resumed run: keep numbering the shards and keep the tickets not written to a shard yet
+        self.n_shards = len(glob.glob(os.path.join(self.path, "part-*")))
+        self.pending = _read_jsonl(self.pending_path)
+
+    def append(self, row: dict):
+        """Adds the row of a ticket (must have a "ticket" key). Writes a shard when shard_size rows are pending."""
+        with open(self.pending_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+            file.flush()
+        self.pending.append(row)
+        if len(self.pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending rows as a new shard and indexes their tickets."""
+        if not self.pending:
+            return
+        # a ticket re-processed after a crash keeps its last row
+        data = pd.DataFrame(self.pending).drop_duplicates(subset="ticket", keep="last")
+        shard_name = f"part-{self.n_shards:05d}{SHARD_EXTENSIONS[self.format]}"
+        shard_path = os.path.join(self.path, shard_name)
+        tmp_path = shard_path + ".tmp"
+        if self.format == "parquet":
+            # columns mixing types (e.g. 0 and "12, 40" for list stats) are stored as text
+            for column in data.columns[data.dtypes == object]:
+                data[column] = data[column].map(lambda value: value if value is None or isinstance(value, str) else str(value))
+            data.to_parquet(tmp_path, compression="zstd", index=False)
+        else:
+            data.to_json(tmp_path, orient="records", lines=True, force_ascii=False, compression="gzip")
+        os.replace(tmp_path, shard_path)
+        with open(self.index_path, "a", encoding="utf-8") as file:
+            file.write("".join(json.dumps({"ticket": ticket, "shard": shard_name}) + "\n" for ticket in data["ticket"]))
+            file.flush()
+        os.remove(self.pending_path)
+        self.pending = []
+        self.n_shards += 1
+
+    def close(self):
+        self.flush()
+
+
+def is_results_store(run_path: str) -> bool:
+    return os.path.isdir(os.path.join(run_path, STORE_DIR))
+
+def load_run(run_path: str, columns: list = None) -> pd.DataFrame:
+    """All the tickets of a run saved with ResultsStore (shards + pending rows), one row per ticket."""
+    store_path = os.path.join(run_path, STORE_DIR)
+    if not os.path.isdir(store_path):
+        raise FileNotFoundError(f"No results store in {run_path}")
+    if columns is not None and "ticket" not in columns:
+        columns = ["ticket"] + list(columns)
+    frames = [_read_shard(path, columns) for path in sorted(glob.glob(os.path.join(store_path, "part-*"))) if not path.endswith(".tmp")]
+    pending = pd.DataFrame(_read_jsonl(os.path.join(store_path, PENDING_FILE)))
+    if not pending.empty:
+        frames.append(pending[[column for column in columns if column in pending.columns]] if columns is not None else pending)
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True).drop_duplicates(subset="ticket", keep="last").reset_index(drop=True)
+
+def load_ticket(run_path: str, ticket_number: str) -> dict | None:
+    """Row of a single ticket, reading only the shard where index.jsonl says it is. None if the ticket is not in the run."""
+    store_path = os.path.join(run_path, STORE_DIR)
+    for row in reversed(_read_jsonl(os.path.join(store_path, PENDING_FILE))):
+        if row.get("ticket") == ticket_number:
+            return row
+    shard_name = None
+    for entry in _read_jsonl(os.path.join(store_path, INDEX_FILE)):
+        if entry["ticket"] == ticket_number:
+            shard_name = entry["shard"]
+    if shard_name is None:
+        return None
+    data = _read_shard(os.path.join(store_path, shard_name), ticket=ticket_number)
+    return data.iloc[-1].to_dict() if not data.empty else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the results of a run saved with --results_store.")
+    parser.add_argument("run_path", help="folder of the run. Example: data/outputs/entity_extraction/20250706_143022_run")
+    parser.add_argument("--ticket", default=None, help="print the results of a single ticket")
+    parser.add_argument("--export", default=None, help="save all the tickets of the run to this xlsx/csv file")
+    args = parser.parse_args()
+
+    if args.ticket is not None:
+        row = load_ticket(args.run_path, args.ticket)
+        if row is None:
+            print(f"Ticket {args.ticket} not found in {args.run_path}")
+        else:
+            for key in ["llm_input", "llm_output", "extracted_entities"]:
+                print(f"{key.upper()}:\n{row.pop(key, '')}\n")
+            print(json.dumps(row, indent=2, ensure_ascii=False, default=str))
+    else:
+        data = load_run(args.run_path)
+        print(f"{len(data)} tickets in {args.run_path}")
+        if args.export is not None:
+            data.to_csv(args.export, index=False) if args.export.endswith(".csv") else data.to_excel(args.export, index=False)
+            print(f"Saved in {args.export}")
+
+# example how to run: python utils/results_store.py data/outputs/entity_extraction/20250706_143022_run --ticket INC0123456
@@ -0,0 +1,91 @@
+import json
+import os
+
+
+class RunManifest:
+    """
+    Journal of the tickets completed in a run, stored as run_manifest.jsonl in the run folder.
+    The first line has the parameters of the run and every completed ticket appends one line with its metrics,
+    flushed to disk before the next ticket starts. A run interrupted at any point can be resumed from it:
+    a line cut in half by a crash is ignored when loading. Tickets that failed (e.g. LLM error, failed batch) are journaled
+    as failed and are processed again on resume.
+    """
+    FILE_NAME = "run_manifest.jsonl"
+
+    def __init__(self, results_path: str, params: dict = None):
+        """Starts the manifest of a new run when params are given, otherwise loads the manifest of an existing run."""
+        self.path = os.path.join(results_path, self.FILE_NAME)
+        self.params = params
+        self.completed = {}
+        self.failed = {}
+        if params is None:
+            self._load()
+        else:
+            with open(self.path, "w", encoding="utf-8"):
+                pass
+            self._append({"params": params})
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a run killed while writing
+                    continue
+                if "params" in entry:
+                    self.params = entry["params"]
+                elif "ticket" in entry and entry.get("failed"):
+                    self.failed[entry["ticket"]] = entry["metrics"]
+                    self.completed.pop(entry["ticket"], None)
+                elif "ticket" in entry:
+                    self.completed[entry["ticket"]] = entry["metrics"]
+                    self.failed.pop(entry["ticket"], None)
+
+    def _append(self, entry: dict):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def is_completed(self, ticket_number: str) -> bool:
+        return ticket_number in self.completed
+
+    def mark_completed(self, ticket_number: str, metrics_row: dict):
+        self.completed[ticket_number] = metrics_row
+        self.failed.pop(ticket_number, None)
+        self._append({"ticket": ticket_number, "metrics": metrics_row})
+
+    def mark_failed(self, ticket_number: str, metrics_row: dict):
+        self.failed[ticket_number] = metrics_row
+        self._append({"ticket": ticket_number, "metrics": metrics_row, "failed": True})
+
+    def metrics_rows(self) -> list:
+        """Metrics of the completed tickets, in the order they were completed."""
+        return list(self.completed.values())
+
+
+def load_watermark(path: str) -> str | None:
+    """Returns the sys_created_on of the last ticket processed by an incremental run, or None if there was none."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file).get("last_sys_created_on")
+
+def watermark_before_failures(seen_created_on, failed_created_on, watermark: str | None) -> str | None:
+    """
+    Watermark to save after a run: the newest sys_created_on seen, or, if some tickets failed, the newest one older than all of
+    them, so the next incremental run fetches the failed tickets again. watermark (the previous one) if there is none.
+    """
+    limit = min(failed_created_on, default=None)
+    candidates = [created_on for created_on in seen_created_on if limit is None or created_on < limit]
+    return max(candidates, default=watermark)
+
+def save_watermark(path: str, last_sys_created_on: str):
+    """Writes the watermark atomically (temporary file + rename), so a crash never leaves it half written."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"last_sys_created_on": last_sys_created_on}, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
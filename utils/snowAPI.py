@@ -2,8 +2,11 @@ import http.client
 import json
 import os
 import re
+import threading
 import unicodedata
+from contextlib import contextmanager
 from enum import Enum
+from utils.stats import timer
 
 def sanitize_filename(filename, replacement="_"):
     """
@@ -22,60 +25,179 @@ def sanitize_filename(filename, replacement="_"):
 
     return filename
 
-def get_tickets(start_date, end_date):
+class SnowConnectionPool:
+    """
+    Pool of keep-alive connections to the SNOW API shared by all threads, so consecutive calls reuse
+    the same TCP/TLS connection instead of doing a new handshake each time.
+    Host and scheme are read from the SNOW_API_HOST / SNOW_API_SCHEME env variables when set, e.g. to test against a local server.
+    """
+    def __init__(self, max_idle_per_host: int = 8, timeout: float = 120):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
 
-    """Get tickets from Accounts Payable (AP) category and Invoice Payment Status subcategory created after between start_date (YYYY-MM-DD) and end_date (YYYY-MM-DD)"""
-    # Get user_key for API
-    USER_KEY =  os.environ["SNOW_API_KEY"]
-    conn = http.client.HTTPSConnection("<vcc-api>")
-    payload = ''
-    headers = {
+    def _new_connection(self, host: str):
+        if os.environ.get("SNOW_API_SCHEME", "https") == "http":
+            return http.client.HTTPConnection(host, timeout=self.timeout)
+        return http.client.HTTPSConnection(host, timeout=self.timeout)
+
+    def _acquire(self, host: str):
+        with self.lock:
+            connections = self.idle.get(host, [])
+            if connections:
+                return connections.pop(), True
+        return self._new_connection(host), False
+
+    def _release(self, host: str, conn):
+        with self.lock:
+            connections = self.idle.setdefault(host, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def get_response(self, host: str, path: str, headers: dict):
+        """Sends a GET request and yields the response. The connection goes back to the pool if the body was fully read."""
+        conn, reused = self._acquire(host)
+        try:
+            conn.request("GET", path, '', headers)
+            res = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+            # the server closed the idle connection: retry once with a new one
+            conn = self._new_connection(host)
+            try:
+                conn.request("GET", path, '', headers)
+                res = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+        try:
+            yield res
+        finally:
+            if res.isclosed() and not res.will_close:
+                self._release(host, conn)
+            else:
+                conn.close()
+
+    def get(self, host: str, path: str, headers: dict) -> bytes:
+        """Sends a GET request and returns the body."""
+        with self.get_response(host, path, headers) as res:
+            return res.read()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle = {}
+
+# pool used by default by all the SNOW API calls of the process
+default_pool = SnowConnectionPool()
+# appended to the sysparm_query of the tickets endpoint (ending with the date range): a stable order, so offset paging neither skips
+# nor repeats tickets created or updated during the run
+TICKET_ORDER = "^ORDERBYsys_created_on^ORDERBYsys_id"
+
+def _api_host() -> str:
+    return os.environ.get("SNOW_API_HOST", "<vcc-api>")
+
+def _attachment_host() -> str:
+    return os.environ.get("SNOW_ATTACHMENT_HOST", os.environ.get("SNOW_API_HOST", "gw1.api.volvocars.biz"))
+
+def _headers() -> dict:
+    return {
     'Accept': 'application/json',
     'Content-Type': 'application/json',
     'Cookie': '<vcc-api-cookie>'
     }
-    conn.request("GET", f"<vcc-endpoint-with{USER_KEY}+{start_date}+{end_date}>", payload, headers)
-    res = conn.getresponse()
-    data = res.read().decode("utf-8")
-    json_data = json.loads(data)["result"]
-    return json_data
 
-def get_attachments_from_ticket(ticket_sys_id:str):
+def iter_tickets(start_date, end_date, page_size: int = 500, pool: SnowConnectionPool = None, stats: dict = None):
+    """
+    Generator version of get_tickets: pages through the Table API with sysparm_limit/sysparm_offset and yields
+    the tickets of each page as soon as it arrives, so processing can start before the whole date range is downloaded.
+    Tickets are ordered by sys_created_on and sys_id (TICKET_ORDER) so the pages stay consistent while tickets are created.
+    The time of every page request is appended to stats["time_snow_fetch"].
+    """
+    pool = pool or default_pool
     # Get user_key for API
     USER_KEY =  os.environ["SNOW_API_KEY"]
-    conn = http.client.HTTPSConnection("<vcc-api>")
-    payload = ''
-    headers = {
-    'Accept': 'application/json',
-    'Content-Type': 'application/json',
-    'Cookie': '<vcc-api-cookie>'
-    }
-    conn.request("GET", f"<vcc-endpoint-with{USER_KEY}+{ticket_sys_id}>", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
+    offset = 0
+    while True:
+        with timer(stats, "time_snow_fetch"):
+            data = pool.get(_api_host(), f"<vcc-endpoint-with{USER_KEY}+{start_date}+{end_date}{TICKET_ORDER}>&sysparm_limit={page_size}&sysparm_offset={offset}", _headers())
+        page = json.loads(data.decode("utf-8"))["result"]
+        yield from page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+def get_tickets(start_date, end_date, pool: SnowConnectionPool = None, stats: dict = None):
+
+    """Get tickets from Accounts Payable (AP) category and Invoice Payment Status subcategory created after between start_date (YYYY-MM-DD) and end_date (YYYY-MM-DD)"""
+    return list(iter_tickets(start_date, end_date, pool=pool, stats=stats))
+
+def get_ticket(ticket_sys_id: str, pool: SnowConnectionPool = None) -> dict:
+    """Single ticket by sys_id (Table API record), with the same fields as the tickets of iter_tickets."""
+    pool = pool or default_pool
+    # Get user_key for API
+    USER_KEY =  os.environ["SNOW_API_KEY"]
+    with pool.get_response(_api_host(), f"<vcc-ticket-endpoint-with{USER_KEY}+{ticket_sys_id}>", _headers()) as res:
+        data = res.read()
+        if res.status != 200:
+            raise LookupError(f"Ticket {ticket_sys_id} not found: HTTP {res.status}")
+    return json.loads(data.decode("utf-8"))["result"]
+
+def get_attachments_from_ticket(ticket_sys_id:str, pool: SnowConnectionPool = None):
+    pool = pool or default_pool
+    # Get user_key for API
+    USER_KEY =  os.environ["SNOW_API_KEY"]
+    data = pool.get(_api_host(), f"<vcc-endpoint-with{USER_KEY}+{ticket_sys_id}>", _headers())
     data = json.loads(data.decode("utf-8"))["result"]
     system_ids_atts = [d["sys_id"] for d in data]
     file_names_atts = [d["file_name"] for d in data]
     return system_ids_atts, file_names_atts
 
-def download_attachment_from_id(attachment_id:str, attachment_name:str, dir):
+class AttachmentDownloadError(Exception):
+    """Raised when an attachment is not downloaded: too large, truncated or failed request."""
 
+def download_attachment_from_id(attachment_id:str, attachment_name:str, dir, pool: SnowConnectionPool = None, chunk_size: int = 1 << 20, max_bytes: int = None):
+    """
+    Downloads an attachment streaming the body to disk in chunks, so large files are never held in memory.
+    Raises AttachmentDownloadError if the attachment is larger than max_bytes or the body does not match its Content-Length.
+    """
+    pool = pool or default_pool
     # Get user_key for API
     USER_KEY =  os.environ["SNOW_API_KEY"]
-    conn = http.client.HTTPSConnection("gw1.api.volvocars.biz")
-    payload = ''
-    headers = {
-    'Accept': 'application/json',
-    'Content-Type': 'application/json',
-    'Cookie': '<vcc-api-cookie>'
-    }
-    conn.request("GET", f"<vcc-endpoint-with{USER_KEY}+{attachment_id}>", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
     sanitized_att_name = sanitize_filename(attachment_name)
     filename = dir + f"/{sanitized_att_name}"
-    with open(filename, "wb") as file:
-        file.write(data)
+    # write to a temporary file first, so a failed download never leaves a partial attachment behind
+    tmp_filename = filename + ".part"
+    with pool.get_response(_attachment_host(), f"<vcc-endpoint-with{USER_KEY}+{attachment_id}>", _headers()) as res:
+        if res.status != 200:
+            raise AttachmentDownloadError(f"{attachment_name}: HTTP {res.status}")
+        content_length = res.getheader("Content-Length")
+        content_length = int(content_length) if content_length is not None else None
+        if max_bytes is not None and content_length is not None and content_length > max_bytes:
+            raise AttachmentDownloadError(f"{attachment_name}: {content_length} bytes, larger than the limit of {max_bytes} bytes")
+        n_bytes = 0
+        try:
+            with open(tmp_filename, "wb") as file:
+                for chunk in iter(lambda: res.read(chunk_size), b""):
+                    n_bytes += len(chunk)
+                    if max_bytes is not None and n_bytes > max_bytes:
+                        raise AttachmentDownloadError(f"{attachment_name}: larger than the limit of {max_bytes} bytes")
+                    file.write(chunk)
+            if content_length is not None and n_bytes != content_length:
+                raise AttachmentDownloadError(f"{attachment_name}: received {n_bytes} of {content_length} bytes")
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+    os.replace(tmp_filename, filename)
     return sanitized_att_name
 
 def filter_tickets(tickets:list, filter_key:str, filter_values:list):
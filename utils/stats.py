@@ -0,0 +1,40 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# stats dicts can be updated from several threads (e.g. attachments of a ticket processed in parallel)
+_lock = threading.Lock()
+
+def add_stat(stats: dict, key: str, value=1):
+    """Adds value to stats[key] (counters and timings). Does nothing if stats is None."""
+    if stats is None:
+        return
+    with _lock:
+        stats[key] = stats.get(key, 0) + value
+
+def append_stat(stats: dict, key: str, value):
+    """Appends value to the list stats[key]. Does nothing if stats is None."""
+    if stats is None:
+        return
+    with _lock:
+        stats.setdefault(key, []).append(value)
+
+def merge_stats(stats: dict, other: dict):
+    """Adds the stats of other (e.g. returned by a worker process) to stats: counters are added and lists are extended."""
+    if stats is None:
+        return
+    for key, value in other.items():
+        if isinstance(value, list):
+            for item in value:
+                append_stat(stats, key, item)
+        else:
+            add_stat(stats, key, value)
+
+@contextmanager
+def timer(stats: dict, key: str):
+    """Times the block and appends the seconds to the list stats[key], one value per event (e.g. per attachment download)."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        append_stat(stats, key, round(time.perf_counter() - start_time, 4))
@@ -0,0 +1,128 @@
+import json
+
+# JSON schema of the output of the entity extractor, sent as response_format so the model can only produce valid JSON.
+# Strict mode doesn't support tuples, so invoices are objects; to_legacy_format converts them to the
+# [reference, fiscal year, entity] lists of the system prompt, expected by post_process_extracted_text.
+ENTITIES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "vendor_code": {"type": "string"},
+        "vendor_name": {"type": "string"},
+        "invoices": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "invoice_reference_number": {"type": "string"},
+                    "invoice_fiscal_year": {"type": "string"},
+                    "volvo_cars_invoice_entity": {"type": "string"},
+                },
+                "required": ["invoice_reference_number", "invoice_fiscal_year", "volvo_cars_invoice_entity"],
+                "additionalProperties": False,
+            },
+        },
+        "po_numbers": {"type": "array", "items": {"type": "string"}},
+        "delivery_notes": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["vendor_code", "vendor_name", "invoices", "po_numbers", "delivery_notes"],
+    "additionalProperties": False,
+}
+
+ENTITIES_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "ticket_entities", "strict": True, "schema": ENTITIES_SCHEMA}}
+
+INVOICE_FIELDS = ["invoice_reference_number", "invoice_fiscal_year", "volvo_cars_invoice_entity"]
+
+
+class StreamingJSONParser:
+    """
+    Incremental parser of a JSON document received in pieces (streamed completion).
+    It only tracks the nesting of objects/arrays and strings, so it knows at any time whether the document is complete,
+    and remembers the last point where every value was complete, to close a truncated document there (see repair).
+    """
+    def __init__(self):
+        # pieces received, joined only when the text is read (appending to a string per character is quadratic)
+        self.pieces = []
+        self.length = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.complete = False
+        # end of the text and open containers the last time all the values seen were complete
+        self.safe_point = None
+
+    @property
+    def text(self) -> str:
+        if len(self.pieces) > 1:
+            self.pieces = ["".join(self.pieces)]
+        return self.pieces[0] if self.pieces else ""
+
+    def feed(self, piece: str):
+        self.pieces.append(piece)
+        start = self.length
+        self.length += len(piece)
+        if self.complete:
+            return
+        for i, char in enumerate(piece):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            # position in the text after the character
+            end = start + i + 1
+            if char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.stack.append("}" if char == "{" else "]")
+                self.started = True
+                if char == "[":
+                    # an empty list is a valid value
+                    self.safe_point = (end, list(self.stack))
+            elif char in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if self.started and not self.stack:
+                    self.complete = True
+                    return
+                self.safe_point = (end, list(self.stack))
+            elif char == ",":
+                self.safe_point = (end - 1, list(self.stack))
+
+    def repair(self) -> str | None:
+        """Closes a truncated document at the last safe point, dropping the value that was cut. Returns None if nothing can be kept."""
+        if self.complete:
+            return self.text
+        if self.safe_point is None:
+            return None
+        end, stack = self.safe_point
+        repaired = self.text[:end] + "".join(reversed(stack))
+        try:
+            json.loads(repaired)
+        except json.JSONDecodeError:
+            return None
+        return repaired
+
+
+def to_legacy_format(text: str) -> str:
+    """
+    Converts an output following ENTITIES_SCHEMA to the format of the system prompt (invoices as lists), so it can be
+    merged and post-processed like the outputs without schema. Missing fields (e.g. of a repaired output) are set to "NaN".
+    """
+    extracted = json.loads(text)
+    invoices = []
+    for invoice in extracted.get("invoices", []):
+        if isinstance(invoice, dict):
+            invoice = [invoice.get(field, "NaN") or "NaN" for field in INVOICE_FIELDS]
+        invoices.append(invoice)
+    legacy = {
+        "vendor_code": extracted.get("vendor_code", "NaN"),
+        "vendor_name": extracted.get("vendor_name", "NaN"),
+        "invoices": invoices,
+        "po_numbers": extracted.get("po_numbers", []),
+        "delivery_notes": extracted.get("delivery_notes", []),
+    }
+    return json.dumps(legacy, indent=4, ensure_ascii=False)
@@ -0,0 +1,106 @@
+import re
+from functools import lru_cache
+
+# attachments are added to the LLM input as "FILE {i} - {attachment_name}:" sections (see SnowTicket.process_attachments)
+FILE_HEADER_PATTERN = re.compile(r"^FILE \d+ - ", re.MULTILINE)
+FILE_TITLE_PATTERN = re.compile(r"FILE \d+ - [^\n]*:\n\n")
+
+@lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # tiktoken downloads the tokenizer files the first time, which can fail behind a proxy
+        print(f"WARNING: tiktoken tokenizer not available ({e}), approximating 4 characters per token")
+        return None
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Number of tokens of a text with the tokenizer of the model (tiktoken). Approximated with 4 characters per token if tiktoken is not installed."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def _split_on(text: str, separator: str) -> list:
+    # split keeping the separator at the end of each part, so joining the parts gives back the text
+    parts = text.split(separator)
+    parts = [part + separator for part in parts[:-1]] + [parts[-1]]
+    return [part for part in parts if part]
+
+def _split_to_fit(text: str, max_tokens: int, model: str) -> list:
+    """Splits a text in parts of at most max_tokens, cutting on blank lines, then lines, then tokens."""
+    if count_tokens(text, model) <= max_tokens:
+        return [text]
+    for separator in ["\n\n", "\n"]:
+        parts = _split_on(text, separator)
+        if len(parts) > 1:
+            return [piece for part in parts for piece in _split_to_fit(part, max_tokens, model)]
+    # a single huge line: cut it by characters, proportionally to its number of tokens
+    n_parts = count_tokens(text, model) // max_tokens + 1
+    part_len = len(text) // n_parts + 1
+    return [text[i:i + part_len] for i in range(0, len(text), part_len)]
+
+def split_into_chunks(text: str, max_tokens: int, model: str = "gpt-4o") -> list:
+    """
+    Splits a processed ticket into chunks of at most max_tokens.
+    The ticket header (description and vendor code) is repeated in every chunk, and the attachments are
+    split on FILE boundaries first, then on pages/paragraphs, so related text stays in the same chunk.
+    """
+    match = FILE_HEADER_PATTERN.search(text)
+    header, body = (text[:match.start()], text[match.start():]) if match else ("", text)
+    header_tokens = count_tokens(header, model)
+    if header_tokens > max_tokens // 2:
+        # very long description: split it like the rest of the text
+        header, body, header_tokens = "", text, 0
+    budget = max_tokens - header_tokens
+
+    # sections of the body: one per attachment
+    starts = [m.start() for m in FILE_HEADER_PATTERN.finditer(body)] or [0]
+    if starts[0] != 0:
+        starts = [0] + starts
+    sections = [body[start:end] for start, end in zip(starts, starts[1:] + [len(body)])]
+
+    # pack the sections (or pieces of the sections that do not fit) greedily in chunks.
+    # A section split over several chunks repeats its FILE title, so every piece keeps its attachment name
+    chunks = []
+    current, current_tokens = "", 0
+    for section in sections:
+        title_match = FILE_TITLE_PATTERN.match(section)
+        title = title_match.group(0) if title_match else ""
+        continued_title = title.rstrip(":\n") + " (continued):\n\n" if title else ""
+        title_tokens = count_tokens(continued_title, model)
+        for n, piece in enumerate(_split_to_fit(section[len(title):], budget - title_tokens, model)):
+            piece_tokens = count_tokens(piece, model) + title_tokens
+            if current and current_tokens + piece_tokens > budget:
+                chunks.append(header + current)
+                current, current_tokens = "", 0
+            if n == 0:
+                piece = title + piece
+            elif not current:
+                piece = continued_title + piece
+            current += piece
+            current_tokens += piece_tokens
+    if current or not chunks:
+        chunks.append(header + current)
+    return chunks
+
+def apportion(total, weights: list) -> list:
+    """Splits total (tokens or seconds) proportionally to the weights. Integer totals are split in integers that add up to the total."""
+    if not weights:
+        return []
+    weight_sum = sum(weights) or len(weights)
+    weights = weights if sum(weights) else [1] * len(weights)
+    if not isinstance(total, int):
+        return [total * weight / weight_sum for weight in weights]
+    shares = [total * weight // weight_sum for weight in weights]
+    # give the remainder of the integer division to the largest weights
+    for i in sorted(range(len(weights)), key=lambda i: -weights[i])[:total - sum(shares)]:
+        shares[i] += 1
+    return shares